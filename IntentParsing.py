@@ -1,14 +1,47 @@
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
 
 import nltk
 from nltk.corpus import wordnet as wn
 from nltk.corpus.reader import Synset
 from nltk.tokenize import sent_tokenize
 from google.cloud import dialogflow_v2beta1 as df
-import locationtagger
 import warnings
 import operator
 
+from single_flight import SingleFlight, TTLCache, cached_single_flight
+from kb_snapshot import document_text
+from common_functions import documents_policy, shared_client, CircuitOpenError, NUM_KB_DOCUMENTS
+from resilience import resilient_call
+import nlp_batcher
+from cache_checkpoint import register_checkpoint, kb_version
+from cache_invalidation import on_invalidation
+
+# documents only change when a knowledge base is rebuilt, so concurrent readers share one fetch
+doc_text_flight = SingleFlight()
+doc_text_cache = TTLCache(ttl=300, max_size=512, name='doc_text')
+# the same articles are tagged over and over, so keep the part-of-speech tags of recent texts
+tagged_text_cache = TTLCache(ttl=3600, max_size=256, name='tagged_text')
+# fetches every document of a knowledge base at once in get_kb_texts
+doc_fetch_pool = ThreadPoolExecutor(max_workers=NUM_KB_DOCUMENTS)
+# WordNet lookups never change, so they only leave the cache when memory is needed for something else
+hypernym_cache = TTLCache(ttl=None, max_size=65536, name='hypernyms')
+
+# warm caches survive restarts; WordNet synsets are saved by name since they belong to the corpus reader
+register_checkpoint(doc_text_cache, version_of=lambda doc_name: kb_version(doc_name.split('/documents/')[0]))
+register_checkpoint(tagged_text_cache)
+register_checkpoint(hypernym_cache, encode=lambda hypernyms: [synset.name() for synset in hypernyms],
+                    decode=lambda names: frozenset(wn.synset(name) for name in names))
+
+
+def _drop_kb_texts(message: dict) -> None:
+    # a rebuilt or refreshed knowledge base has new documents, the text of its old ones is no longer needed
+    if message.get("kb_id"):
+        doc_text_cache.pop_where(lambda doc_name: doc_name.startswith(message["kb_id"] + '/'))
+
+
+on_invalidation(_drop_kb_texts)
+
 
 def parse_synsets_from_kb(kb_response: str, kb_doc_name: str, synsets: List[Synset], banned_words: List[str]) -> List[
     str]:
@@ -46,14 +79,14 @@ def parse_locations_from_kb(kb_response: str, kb_doc_name: str, cities: bool = F
         banned_words = []
     location_names = []
     if kb_response and kb_response != '':
-        locations = locationtagger.find_locations(text=kb_response)
+        locations = nlp_batcher.find_locations(kb_response)
         if cities:
             location_names += locations.cities
         if regions:
             location_names += locations.regions
     if len(location_names) == 0:
         article = get_raw_kb_text(kb_doc_name)
-        locations = locationtagger.find_locations(text=article)
+        locations = nlp_batcher.find_locations(article)
         if cities:
             location_names += locations.cities
         if regions:
@@ -115,16 +148,105 @@ def parse_words_from_kb(kb_response: str, kb_doc_name: str, words: List[str], ba
     return result
 
 
-def get_raw_kb_text(doc_name: str) -> str:
+def get_raw_kb_text(doc_name: str, client: df.DocumentsClient = None) -> str:
     """
     Gets the raw bytes from the document in the knowledgebase
-    Args: str
+    Args: str, DocumentsClient
         doc_name: Name of the document to pull from
-    Returns: List[str]
-      the words that matched sysnets
+        client (optional): the client to fetch with, a new one is created otherwise
+    Returns: str
+      the text of the document
+    """
+    text = document_text(doc_name)
+    if text is not None:
+        return text
+    return cached_single_flight(doc_text_cache, doc_text_flight, doc_name, resilient_call, documents_policy,
+                                _fetch_kb_document, doc_name, client, fallback=lambda: _stale_kb_text(doc_name))
+
+
+def get_kb_texts(current_kbid_doc_mapping: dict, headers: Iterable[str] = None) -> Dict[str, str]:
+    """
+    Gets the text of several documents of a knowledge base at once, fetching the ones that are not cached
+    in parallel with one shared client, so loading a whole country costs a single round trip
+    Args: dict, Iterable[str]
+        current_kbid_doc_mapping: the knowledge base's header to document mapping
+        headers (optional): the headers to fetch, all of them by default
+    Returns: Dict[str, str]
+      the text of each header's document
+    """
+    wanted = {header: current_kbid_doc_mapping[header]
+              for header in (current_kbid_doc_mapping if headers is None else headers)
+              if header in current_kbid_doc_mapping}
+    texts = {}
+    missing = {}
+    for header, doc_name in wanted.items():
+        text = document_text(doc_name)
+        if text is None:
+            text = doc_text_cache.get(doc_name)
+        if text is None:
+            missing[header] = doc_name
+        else:
+            texts[header] = text
+
+    if len(missing) == 1:
+        header, doc_name = missing.popitem()
+        texts[header] = get_raw_kb_text(doc_name)
+    elif len(missing) > 1:
+        client = shared_client('DocumentsClient')
+        futures = {header: doc_fetch_pool.submit(get_raw_kb_text, doc_name, client)
+                   for header, doc_name in missing.items()}
+        for header, future in futures.items():
+            texts[header] = future.result()
+    return texts
+
+
+def _stale_kb_text(doc_name: str) -> str:
+    # while Dialogflow is unreachable, serve the last copy of the document that was fetched
+    text = doc_text_cache.get_stale(doc_name)
+    if text is None:
+        raise CircuitOpenError(f"cannot fetch {doc_name}")
+    return text
+
+
+def _fetch_kb_document(doc_name: str, client: df.DocumentsClient = None, timeout: float = None) -> str:
+    if client is None:
+        client = shared_client('DocumentsClient')
+    document = client.get_document(name=doc_name, timeout=timeout)
+    # match the snapshot text rather than the protobuf dump, which escapes every non-ascii byte
+    if document.raw_content:
+        return document.raw_content.decode('utf-8', errors='replace')
+    return str(document)
+
+
+def tag_text(text: str) -> List[tuple]:
+    """
+    Tokenizes and part-of-speech tags a body of text, reusing the tags if the text was tagged recently
+    Args: str
+        text: the text to be tagged
+    Returns: List[tuple]
+      (word, tag) pairs as returned by nltk.pos_tag
+    """
+    pos_tags = tagged_text_cache.get(text)
+    if pos_tags is None:
+        pos_tags = nlp_batcher.pos_tag(nltk.word_tokenize(text))
+        tagged_text_cache.set(text, pos_tags)
+    return pos_tags
+
+
+def get_word_hypernyms(word: str) -> frozenset:
+    """
+    Looks up every hypernym of the most common sense of a word
+    Args: str
+        word: the lowercased word
+    Returns: frozenset
+      the hypernym synsets (empty if WordNet does not know the word)
     """
-    client = df.DocumentsClient()
-    return str(client.get_document(name=doc_name))
+    hypernyms = hypernym_cache.get(word)
+    if hypernyms is None:
+        word_synsets = wn.synsets(word)
+        hypernyms = frozenset(word_synsets[0].closure(lambda s: s.hypernyms())) if len(word_synsets) > 0 else frozenset()
+        hypernym_cache.set(word, hypernyms)
+    return hypernyms
 
 
 def get_most_frequent_words_in_synsets(
@@ -151,10 +273,8 @@ def get_most_frequent_words_in_synsets(
     for word in text.split():
         word = word.lower()
         if word not in banned_words:
-            hyper = lambda s: s.hypernyms()
-            word_synsets = wn.synsets(word)
-            if len(word_synsets) > 0:
-                hypernyms = list(word_synsets[0].closure(hyper))
+            hypernyms = get_word_hypernyms(word)
+            if len(hypernyms) > 0:
                 for synset in synsets:
                     if synset in hypernyms:
                         total_count += 1
@@ -189,10 +309,8 @@ def get_words_in_synsets(text: str, synsets: List[str]) -> List[str]:
     words = []
     for word in text.split():
         word = word.lower()
-        hyper = lambda s: s.hypernyms()
-        word_synsets = wn.synsets(word)
-        if len(word_synsets) > 0:
-            hypernyms = list(word_synsets[0].closure(hyper))
+        hypernyms = get_word_hypernyms(word)
+        if len(hypernyms) > 0:
             for synset in synsets:
                 if synset in hypernyms:
                     if word not in words:
@@ -238,7 +356,7 @@ def get_proper_nouns(text: str, banned_words: List[str], max: int) -> List[str]:
     Returns: [str]
       a list of proper noun phrases
     """
-    pos_tags = nltk.pos_tag(nltk.word_tokenize(text))
+    pos_tags = tag_text(text)
     result = []
     x = 0
     while x < len(pos_tags):
@@ -472,7 +590,7 @@ def form_buy_intent_response(kb_response: str, country_name: str, dislikes: List
         'banknotes'
     ] + dislikes
     article = get_raw_kb_text(current_kbid_doc_mapping['Buy'])
-    pos_tags = nltk.pos_tag(nltk.word_tokenize(article))
+    pos_tags = tag_text(article)
     currency_word = ['dollar', 'pound', 'euro', 'yen', 'franc', 'rupee', 'ruble', 'yuan', 'yen', 'rand' 'baht', 'won',
                      'rial', 'lira', 'dinar', 'peso', 'real', 'shekel']
     result = []
@@ -649,19 +767,40 @@ def form_respect_intent_response(kb_response: str, country_name: str, dislikes:
             return sentence
 
 
-def kb_intent_response(kb_response: str, intent_name: str, country_name: str, user_dict: dict,
+# the inputs each intent handler reads: the knowledge base answer for the question and/or the raw article.
+# Handlers that only read the article as a fallback declare just "kb_response", the article is fetched if needed.
+KB_RESPONSE = 'kb_response'
+ARTICLE = 'article'
+HANDLER_INPUTS = {
+    "Regions": {KB_RESPONSE},
+    "Cities": {KB_RESPONSE},
+    "Other_destinations": {KB_RESPONSE},
+    "Get_in": {ARTICLE},
+    "See": {KB_RESPONSE},
+    "Do": {KB_RESPONSE},
+    "Talk": {ARTICLE},
+    "Buy": {ARTICLE, KB_RESPONSE},
+    "Eat": {KB_RESPONSE},
+    "Drink": {KB_RESPONSE},
+    "Stay_healthy": {KB_RESPONSE},
+    "Stay_safe": {KB_RESPONSE},
+    "Connect": {KB_RESPONSE},
+    "Respect": {KB_RESPONSE},
+}
+
+
+def kb_intent_response(kb_response: str, intent_name: str, country_name: str, dislikes: List[str],
                        current_kbid_doc_mapping: dict) -> str:
     """
     Maps the intent to the correct function to build a response
-        Args: str, str, str, dict
+        Args: str, str, str, List[str]
             kb_response: the response from dialog flow
             intent: name of the triggered intent
             country_name: the name of the current country
-            user_dict: the current knowledge about the user
+            dislikes: list of forbidden words to suggest
         Returns: str
      a response to give to the user (either client created or dialogflow created)
     """
-    dislikes = user_dict["dislikes"]
     result = ''
 
     if intent_name == "Regions":
@@ -1,9 +1,39 @@
 import requests
 from bs4 import BeautifulSoup
+from bs4.element import CData, NavigableString, Tag
 import re
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 from nltk import sent_tokenize, word_tokenize, pos_tag
 
+from kb_snapshot import write_snapshot
+from kb_scheduler import document_rate_limiter, wikivoyage_limiter
+from cache_invalidation import publish_invalidation
+
 HEADER_LIST = ["Regions", "Cities", "Other_destinations", "Get_in", "See", "Do", "Talk", "Buy", "Eat", "Drink","Stay_healthy", "Stay_safe", "Connect","Respect"]
+# the sections listing places that have their own Wikivoyage page
+PLACE_SECTIONS = ["Cities", "Other_destinations"]
+
+# image captions, sub-headings, listings and abbreviations skew the scraped text, so their text is skipped
+SKIPPED_TAGS = {'figcaption', 'h3', 'dl', 'abbr'}
+TEXT_TYPES = (NavigableString, CData)
+WORD_PATTERN = re.compile(r'\w+')
+MIN_SENTENCE_WORDS = 5
+# links to other articles, not to files, categories or special pages
+ARTICLE_LINK = re.compile(r'^/wiki/[^:#]+$')
+
+
+def is_valid_sentence(sentence: str) -> bool:
+    """
+    Checks that a "sentence" is not a label or a one word fragment
+    Args: str
+        sentence: the sentence to check
+    Returns: bool
+      whether the sentence has at least MIN_SENTENCE_WORDS words
+    """
+    # stop counting as soon as enough words were seen
+    return next(islice(WORD_PATTERN.finditer(sentence), MIN_SENTENCE_WORDS - 1, None), None) is not None
+
 
 def validate_sentence_length(sentences: list) -> list:
     """
@@ -13,66 +43,123 @@ def validate_sentence_length(sentences: list) -> list:
     Returns: list
       the valid sentences
     """
-    for sent in sentences:
-        num_words= len(re.findall(r'\w+', sent))
-        if num_words < 5:
-            sentences.remove(sent)
-    return sentences
+    return [sent for sent in sentences if is_valid_sentence(sent)]
+
+
+def section_nodes(soup: BeautifulSoup, key: str) -> Iterator[Tag]:
+    """Yields the elements under a header, up to the next top level header"""
+    header = soup.find('span', {'id': key})
+    if not header or not header.parent:
+        return
+    for sibling in header.parent.next_siblings:
+        if sibling.name == 'h2':
+            break
+        if sibling.name is not None:
+            yield sibling
+
+
+def visible_strings(node) -> Iterator[str]:
+    """Yields the text inside an element, leaving out the SKIPPED_TAGS, comments and inline styles and scripts"""
+    if isinstance(node, NavigableString):
+        # like get_text(), only plain text and CDATA; comments and the contents of <style> and <script> are
+        # NavigableString subclasses too
+        if type(node) in TEXT_TYPES:
+            yield str(node)
+        return
+    if node.name in SKIPPED_TAGS:
+        return
+    for child in node.children:
+        yield from visible_strings(child)
+
+
+def section_sentences(nodes: Iterable[Tag]) -> Iterator[str]:
+    """Yields the valid sentences of a section, one element at a time"""
+    for node in nodes:
+        text = ''.join(visible_strings(node))
+        for sentence in sent_tokenize(text):
+            if is_valid_sentence(sentence):
+                yield sentence
+
+
+def section_document(soup: BeautifulSoup, key: str) -> str:
+    """
+    Extracts the cleaned text under one header of a parsed page
+    Args: BeautifulSoup, str
+        soup: the parsed country page
+        key: the header to extract
+    Returns: str
+      the valid sentences of the section, one per line
+    """
+    return '\n'.join(section_sentences(section_nodes(soup, key)))
+
+
+def section_places(soup: BeautifulSoup, key: str) -> List[str]:
+    """
+    Finds the places a section lists, e.g. the cities under "Cities"
+    Args: BeautifulSoup, str
+        soup: the parsed country page
+        key: the header to look under
+    Returns: List[str]
+      the Wikivoyage page titles of the places, in the order the page lists them
+    """
+    places = []
+    for node in section_nodes(soup, key):
+        for item in node.find_all('li'):
+            # the place itself is the first article link of a list item, the rest are mentioned in its description
+            link = item.find('a', href=ARTICLE_LINK)
+            if link is not None and link['href'][len('/wiki/'):] not in places:
+                places.append(link['href'][len('/wiki/'):])
+    return places
 
 
-def scrape(country: str, knowledge_base_id: str) -> None:
+def scrape(country: str, knowledge_base_id: str, sections: Optional[List[str]] = None,
+           on_section: Optional[Callable[[str], None]] = None,
+           should_stop: Optional[Callable[[], bool]] = None, page: Optional[str] = None) -> List[str]:
     """
     Scrapes the wikipedia page of a country and organizes it by header
-     Args: str, str
+     Args: str, str, List[str], Callable, Callable, str
         country: the name of the country to scrape
         knowledge_base_id: the name of the knowledge base to write to (1 kb per country)
-    Returns: None
+        sections (optional): the headers to scrape, defaults to the full HEADER_LIST
+        on_section (optional): called with each header once its document has been created
+        should_stop (optional): checked before each header, stops the scrape early when it returns True
+        page (optional): the Wikivoyage page title when it is not the country name (e.g. a city's page)
+    Returns: List[str]
+        the headers that were uploaded
 
     """
+    if sections is None:
+        sections = HEADER_LIST
     if country.find(" "):
         country = country.replace(" ", "_")
     # Specify the URL of the Wikivoyage page you want to scrape
-    url = f'https://en.m.wikivoyage.org/wiki/{country}'
+    url = f'https://en.m.wikivoyage.org/wiki/{page or country}'
 
     # Send a GET request to the URL and store the response
-    response = requests.get(url)
+    with wikivoyage_limiter.acquire(url):
+        response = requests.get(url)
 
-    # Use Beautiful Soup to parse the HTML content of the page
+    # Use Beautiful Soup to parse the HTML content of the page, once for every section
     soup = BeautifulSoup(response.content, 'html.parser')
 
-    # Find the header you're interested in (in this case, the "See" header)
-    for key in HEADER_LIST:
-        html_content = ''
-        header = soup.find('span', {'id': key})
-
-        #Get all the content under the header (i.e. everything until the next header)
-        if header and header.parent:
-            for sibling in header.parent.next_siblings:
-                if sibling.name == 'h2': #or (sibling.name == 'span' and 'id' in sibling.attrs):
-                    break
-                if sibling.name is not None:
-                    html_content += str(sibling)
-
-        # Remove unwanted tags
-        html_content = re.sub(r'<figcaption\b[^>]*>.*?</figcaption>', '', html_content, flags=re.DOTALL)
-        html_content = re.sub(r'<h3\b[^>]*>.*?</h3>', '', html_content, flags=re.DOTALL)
-        html_content = re.sub(r'<dl\b[^>]*>.*?</dl>', '', html_content, flags=re.DOTALL)
-        
-        soup = BeautifulSoup(html_content, 'html.parser')
-        for abbr in soup.find_all('abbr'):
-            abbr.decompose()
-        text = soup.get_text()
-        sents = sent_tokenize(text)
-        sents = validate_sentence_length(sents)
-        content ='\n'.join(sents)
-
-        content = bytes(content, 'utf-8')
-        create_document(knowledge_base_id, key, 'text/plain', 'EXTRACTIVE_QA', content)
-        # reset parse
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-
-def create_document(knowledge_base_id: str, display_name: str, mime_type: str, knowledge_type: str, content: bytes) -> None:
+    # everything uploaded is also written to the local snapshot, so nothing has to be read back from Dialogflow
+    snapshot_sections = {}
+    places = [place for key in PLACE_SECTIONS if key in sections for place in section_places(soup, key)] or None
+
+    for key in sections:
+        if should_stop and should_stop():
+            break
+        content = section_document(soup, key)
+        doc_name = create_document(knowledge_base_id, key, 'text/plain', 'EXTRACTIVE_QA', bytes(content, 'utf-8'))
+        snapshot_sections[key] = (content, doc_name)
+        if on_section:
+            on_section(key)
+
+    write_snapshot(country.replace("_", " "), knowledge_base_id, snapshot_sections, places=places)
+    return list(snapshot_sections)
+
+
+def create_document(knowledge_base_id: str, display_name: str, mime_type: str, knowledge_type: str, content: bytes) -> str:
     """
     Creates a Document.
     Args: str, str, str, str, bytes
@@ -81,16 +168,20 @@ def create_document(knowledge_base_id: str, display_name: str, mime_type: str, k
         mime_type: type of data recieved
         knowledge_type: The Knowledge type of the Document
         content: the bytes of the scraped content under that header
-    Returns: None
+    Returns: str
+        the name of the created Document
     """
     from google.cloud import dialogflow_v2beta1 as dialogflow
+    from common_functions import shared_client
 
-    client = dialogflow.DocumentsClient()
+    client = shared_client('DocumentsClient')
 
     # create document
     document = dialogflow.Document(display_name=display_name, mime_type=mime_type, raw_content=content)
     document.knowledge_types.append(getattr(dialogflow.Document.KnowledgeType, knowledge_type))
 
+    # Dialogflow limits how fast documents may be created, so uploads are paced rather than rejected
+    document_rate_limiter.acquire()
     response = client.create_document(parent=knowledge_base_id, document=document)
     print("Waiting for results...")
     document = response.result(timeout=120)
@@ -99,28 +190,43 @@ def create_document(knowledge_base_id: str, display_name: str, mime_type: str, k
     print(" - Knowledge ID: {}".format(document.name))
     print(" - MIME Type: {}".format(document.mime_type))
     print(" - Knowledge Types:")
+    return document.name
 
 
-def create_knowledge_base(country: str) -> str:
+def delete_document(document_name: str) -> None:
     """
-    Creates a Knowledge base for the given country.
+    Deletes a Document, e.g. one replaced by a refreshed scrape
+    Args: str
+        document_name: the name of the Document
+    Returns: None
+    """
+    from common_functions import shared_client
+
+    client = shared_client('DocumentsClient')
+    client.delete_document(name=document_name).result(timeout=120)
+    print("Deleted Document: {}".format(document_name))
+
+
+def create_empty_knowledge_base(country: str) -> Tuple[str, bool]:
+    """
+    Creates a Knowledge base for the given country without scraping any documents into it.
 
     Args: str
         country: The name of the country for which to create the Knowledge base.
-    Returns: str
-        the name of the newly created knowledge base
-    
+    Returns: Tuple[str, bool]
+        the name of the knowledge base and whether it already existed
     """
     from google.cloud import dialogflow_v2beta1 as dialogflow
+    from common_functions import shared_client
 
-    client = dialogflow.KnowledgeBasesClient()
+    client = shared_client('KnowledgeBasesClient')
     project_path = client.common_project_path("s4395-travel-agent-bapg")
 
     # if a knowledge base has already been created for the country, return the existing ID
     existing_kb_list = client.list_knowledge_bases(parent='projects/s4395-travel-agent-bapg')
     for kb in existing_kb_list:
         if kb.display_name == country:
-            return kb.name
+            return kb.name, True
 
     knowledge_base = dialogflow.KnowledgeBase(display_name=country)
 
@@ -128,10 +234,24 @@ def create_knowledge_base(country: str) -> str:
         parent=project_path, knowledge_base=knowledge_base
     )
 
-    dialogflow.CreateKnowledgeBaseRequest()
-
     print("Knowledge Base created for country {}:\n".format(country))
     print("Display Name: {}\n".format(response.display_name))
     print("Name: {}\n".format(response.name))
-    scrape(country,response.name)
-    return response.name
\ No newline at end of file
+    return response.name, False
+
+
+def create_knowledge_base(country: str) -> str:
+    """
+    Creates a Knowledge base for the given country.
+
+    Args: str
+        country: The name of the country for which to create the Knowledge base.
+    Returns: str
+        the name of the newly created knowledge base
+    
+    """
+    kb_name, existed = create_empty_knowledge_base(country)
+    if not existed:
+        scrape(country, kb_name)
+        publish_invalidation(country, kb_name, ready=True)
+    return kb_name
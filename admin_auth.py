@@ -0,0 +1,49 @@
+"""
+Guards the admin endpoints of the webhook and the session router, which change how a worker runs, what it
+writes and which conversations it holds.
+
+With ADMIN_TOKEN set, an admin call has to send the same token in the X-Admin-Token header. Without it, the
+admin endpoints only answer calls from the machine itself (set ADMIN_TOKEN when a proxy on the same machine
+forwards outside calls to the webhook, since those would look local).
+"""
+import hmac
+import os
+from functools import wraps
+from typing import Callable, Optional
+
+from flask import request
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+
+def is_admin_request(token: Optional[str], remote_addr: Optional[str], admin_token: Optional[str] = None) -> bool:
+    """
+    Checks whether a call may use the admin endpoints
+    Args: str, str, str
+        token: the X-Admin-Token header of the call, if any
+        remote_addr: the address the call came from
+        admin_token (optional): the expected token, defaults to ADMIN_TOKEN
+    Returns: bool
+      whether the call is allowed
+    """
+    admin_token = admin_token if admin_token is not None else ADMIN_TOKEN
+    if admin_token:
+        return token is not None and hmac.compare_digest(token.encode('utf-8'), admin_token.encode('utf-8'))
+    return remote_addr in LOCAL_ADDRESSES
+
+
+def admin_only(view: Callable) -> Callable:
+    """Rejects calls to a Flask view that is_admin_request does not allow with a 403"""
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        if not is_admin_request(request.headers.get(ADMIN_TOKEN_HEADER), request.remote_addr):
+            return {"error": "admin endpoints need a valid " + ADMIN_TOKEN_HEADER}, 403
+        return view(*args, **kwargs)
+    return guarded
+
+
+def admin_headers() -> dict:
+    """The headers to send with a call to another process's admin endpoints"""
+    return {ADMIN_TOKEN_HEADER: ADMIN_TOKEN} if ADMIN_TOKEN else {}
@@ -0,0 +1,75 @@
+"""
+Counts the Dialogflow round trips each chat turn costs under every KB_QUERY_MODE, using the fake backend.
+Usage: python bench_round_trips.py [--latency 0.05]
+"""
+import argparse
+import time
+
+import common_functions
+import IntentParsing
+from fake_dialogflow import FakeBackend
+from response_cache import response_cache
+
+SCRIPT = [
+    "Hello",
+    "I want to visit Italy",
+    "What kind of food should I eat there?",
+    "What should I drink?",
+    "How do I stay safe there?",
+    "Where can I get internet?",
+    "What languages do they speak?",
+    "Tell me something about the weather",
+]
+
+
+def clear_caches() -> None:
+    response_cache.entries.clear()
+    common_functions.kb_search_cache.clear()
+    common_functions.doc_mapping_cache.clear()
+    IntentParsing.doc_text_cache.clear()
+
+
+def run_script(mode: str, latency: float) -> list:
+    """
+    Plays the scripted conversation against a fresh fake backend
+    Args: str, float
+        mode: the KB_QUERY_MODE to use
+        latency: the simulated round trip time of each RPC in seconds
+    Returns: list
+        one (input, detect_intent calls, total RPCs, network waves, milliseconds) row per turn
+    """
+    from chatbot import new_conversation, handle_turn
+
+    common_functions.KB_QUERY_MODE = mode
+    clear_caches()
+    backend = FakeBackend(latency=latency)
+    restore = backend.install()
+    try:
+        session_client = common_functions.dialogflow.SessionsClient()
+        conversation = new_conversation(session_client.session_path(common_functions.PROJECT_ID, 'bench'))
+        rows = []
+        for user_input in SCRIPT:
+            backend.reset_calls()
+            start = time.perf_counter()
+            handle_turn(conversation, session_client, user_input)
+            elapsed = (time.perf_counter() - start) * 1000
+            rows.append((user_input, backend.calls['detect_intent'], sum(backend.calls.values()),
+                         backend.network_waves(), elapsed))
+        return rows
+    finally:
+        restore()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated RPC round trip in seconds')
+    args = parser.parse_args()
+
+    for mode in ['sequential', 'parallel', 'single']:
+        print(f"\nKB_QUERY_MODE={mode}")
+        print(f"{'turn':<45}{'detect':>8}{'rpcs':>6}{'waves':>7}{'ms':>9}")
+        total_waves = 0
+        for user_input, detect_calls, rpcs, waves, elapsed in run_script(mode, args.latency):
+            total_waves += waves
+            print(f"{user_input:<45}{detect_calls:>8}{rpcs:>6}{waves:>7}{elapsed:>9.1f}")
+        print(f"total network waves: {total_waves}")
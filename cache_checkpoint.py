@@ -0,0 +1,258 @@
+"""
+Checkpoints the contents of the in-process caches to a local file, periodically and on shutdown, and loads
+them again at startup so a restart or deploy does not start cold.
+
+Entries tied to a knowledge base are saved with a version of that knowledge base (a digest of its document
+names, from the local snapshot or, for a knowledge base without one, from listing its documents in Dialogflow).
+A rebuilt knowledge base gets new documents, so on restore its old entries no longer match and are dropped, and
+so are entries whose version was not known when they were saved or cannot be found out now, since nothing shows
+they are current. Entries whose TTL ran out while the process was down are dropped too.
+
+The checkpoint is signed with an HMAC and only unpickled when the signature matches, so a file planted by
+another local user is ignored instead of run. The key comes from CACHE_CHECKPOINT_KEY, or else from a random
+key file next to the checkpoint (<file>.key) that only the owner can read.
+
+Settings: CACHE_CHECKPOINT (file, default "cache_checkpoint.pkl"), CACHE_CHECKPOINT_INTERVAL (seconds, default 300)
+"""
+import atexit
+import hashlib
+import hmac
+import os
+import pickle
+import threading
+import time
+from typing import Callable, Hashable, Optional
+
+from kb_snapshot import country_kb_id, knowledge_base_doc_mapping
+
+CHECKPOINT_FORMAT = 1
+CHECKPOINT_PATH = os.environ.get('CACHE_CHECKPOINT', 'cache_checkpoint.pkl')
+CHECKPOINT_INTERVAL = float(os.environ.get('CACHE_CHECKPOINT_INTERVAL', '300'))
+CHECKPOINT_KEY = os.environ.get('CACHE_CHECKPOINT_KEY')
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+# name -> (cache, encode, decode, version_of)
+_checkpointed = {}
+_save_lock = threading.Lock()
+_started = False
+# where versions come from for knowledge bases without a local snapshot, see set_version_source
+_live_doc_mapping = None
+_live_kb_id = None
+# the versions already looked up by the save or restore running on this thread
+_memo = threading.local()
+
+
+def register_checkpoint(cache, encode: Callable = None, decode: Callable = None,
+                        version_of: Callable[[Hashable], Optional[str]] = None) -> None:
+    """
+    Includes a cache in the checkpoints
+    Args: cache, Callable, Callable, Callable
+        cache: a cache with `name`, `export_entries()` and `import_entry(key, value, expires_at)`
+        encode (optional): turns a value into something picklable
+        decode (optional): the inverse of encode
+        version_of (optional): the version of the knowledge base content an entry was built from
+    Returns: None
+    """
+    _checkpointed[cache.name] = (cache, encode, decode, version_of)
+
+
+def set_version_source(doc_mapping: Callable[[str], dict], kb_id_of: Callable[[str], Optional[str]]) -> None:
+    """
+    Sets where the versions of knowledge bases without a local snapshot come from
+    Args: Callable, Callable
+        doc_mapping: maps a knowledge base to its documents (header -> document name)
+        kb_id_of: finds the knowledge base of a country
+    Returns: None
+    """
+    global _live_doc_mapping, _live_kb_id
+    _live_doc_mapping = doc_mapping
+    _live_kb_id = kb_id_of
+
+
+def _memoized(kind: str, key: str, look_up: Callable[[str], Optional[str]]) -> Optional[str]:
+    # every entry asks for the version of its knowledge base, one lookup per knowledge base is enough
+    memo = getattr(_memo, 'versions', None)
+    if memo is None:
+        return look_up(key)
+    if (kind, key) not in memo:
+        memo[(kind, key)] = look_up(key)
+    return memo[(kind, key)]
+
+
+def _look_up_kb_version(kb_id: str) -> Optional[str]:
+    mapping = knowledge_base_doc_mapping(kb_id)
+    if not mapping and _live_doc_mapping is not None:
+        try:
+            mapping = _live_doc_mapping(kb_id)
+        except Exception as e:
+            # a version that cannot be found out is unknown, which only costs the entries that depend on it
+            print("LOG - Could not look up the version of " + kb_id + ": " + str(e))
+            return None
+    if not mapping:
+        return None
+    return hashlib.sha1(repr(sorted(mapping.items())).encode('utf-8')).hexdigest()[:16]
+
+
+def _look_up_country_kb_id(country: str) -> Optional[str]:
+    kb_id = country_kb_id(country)
+    if kb_id is None and _live_kb_id is not None:
+        try:
+            kb_id = _live_kb_id(country)
+        except Exception as e:
+            print("LOG - Could not look up the knowledge base of " + country + ": " + str(e))
+            return None
+    return kb_id
+
+
+def kb_version(kb_id: Optional[str]) -> Optional[str]:
+    """
+    A digest of a knowledge base's documents, which changes whenever the knowledge base is rebuilt
+    Args: str
+        kb_id: the knowledge base name
+    Returns: str
+      the version, or None if neither a local snapshot nor the version source can tell
+    """
+    if not kb_id:
+        return None
+    return _memoized('kb', kb_id, _look_up_kb_version)
+
+
+def country_version(country: str) -> Optional[str]:
+    """The version of the knowledge base a country currently has"""
+    return kb_version(_memoized('country', country, _look_up_country_kb_id))
+
+
+def _checkpoint_key(path: str, create: bool) -> Optional[bytes]:
+    if CHECKPOINT_KEY:
+        return CHECKPOINT_KEY.encode('utf-8')
+    key_path = path + '.key'
+    try:
+        with open(key_path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        if not create:
+            return None
+    key = os.urandom(32)
+    try:
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # another worker created it first
+        with open(key_path, 'rb') as f:
+            return f.read()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+def save_checkpoint(path: str = None) -> int:
+    """
+    Writes every registered cache to the checkpoint file
+    Args: str
+        path (optional): the checkpoint file
+    Returns: int
+      the number of entries written
+    """
+    path = path or CHECKPOINT_PATH
+    data = {"format": CHECKPOINT_FORMAT, "saved_at": time.time(), "caches": {}}
+    count = 0
+    _memo.versions = {}
+    try:
+        for name, (cache, encode, _, version_of) in list(_checkpointed.items()):
+            entries = [(key, encode(value) if encode else value, expires_at, version_of(key) if version_of else None)
+                       for key, value, expires_at in cache.export_entries()]
+            data["caches"][name] = entries
+            count += len(entries)
+    finally:
+        _memo.versions = None
+    payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    with _save_lock:
+        signature = hmac.new(_checkpoint_key(path, create=True), payload, hashlib.sha256).digest()
+        # write then rename, so a crash mid-write never leaves a truncated checkpoint behind
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(signature + payload)
+        os.replace(path + '.tmp', path)
+    return count
+
+
+def restore_checkpoint(path: str = None) -> int:
+    """
+    Loads the checkpoint file into the registered caches, dropping expired and outdated entries
+    Args: str
+        path (optional): the checkpoint file
+    Returns: int
+      the number of entries restored
+    """
+    path = path or CHECKPOINT_PATH
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, 'rb') as f:
+            signature = f.read(SIGNATURE_SIZE)
+            payload = f.read()
+        key = _checkpoint_key(path, create=False)
+        # nothing is unpickled unless this process's key signed it
+        if key is None or not hmac.compare_digest(signature, hmac.new(key, payload, hashlib.sha256).digest()):
+            print("LOG - Ignoring cache checkpoint: its signature does not match")
+            return 0
+        data = pickle.loads(payload)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        print("LOG - Ignoring cache checkpoint: " + str(e))
+        return 0
+    if not isinstance(data, dict) or data.get("format") != CHECKPOINT_FORMAT:
+        print("LOG - Ignoring cache checkpoint written by another version")
+        return 0
+
+    now = time.time()
+    restored = 0
+    dropped = 0
+    _memo.versions = {}
+    try:
+        for name, entries in data["caches"].items():
+            if name not in _checkpointed:
+                continue
+            cache, _, decode, version_of = _checkpointed[name]
+            for key, value, expires_at, version in entries:
+                if expires_at is not None and expires_at <= now:
+                    dropped += 1
+                    continue
+                # an entry of a versioned cache is only known to be current when both versions are known and match
+                if version_of is not None and (version is None or version_of(key) != version):
+                    dropped += 1
+                    continue
+                cache.import_entry(key, decode(value) if decode else value, expires_at)
+                restored += 1
+    finally:
+        _memo.versions = None
+    print(f"LOG - Restored {restored} cache entries ({dropped} expired or outdated)")
+    return restored
+
+
+def start_checkpointing(path: str = None, interval: float = CHECKPOINT_INTERVAL) -> None:
+    """
+    Restores the caches, then checkpoints them every `interval` seconds and when the process exits
+    Args: str, float
+        path (optional): the checkpoint file
+        interval: seconds between checkpoints
+    Returns: None
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+    restore_checkpoint(path)
+
+    def checkpoint() -> None:
+        try:
+            save_checkpoint(path)
+        except (OSError, pickle.PicklingError, TypeError) as e:
+            print("LOG - Could not checkpoint the caches: " + str(e))
+
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            checkpoint()
+
+    threading.Thread(target=run, name='cache-checkpoint', daemon=True).start()
+    atexit.register(checkpoint)
@@ -0,0 +1,143 @@
+"""
+Tells every worker process on this machine when a country's knowledge base changed, so each one drops the
+cached knowledge base names, document mappings, document text and answers it holds for that country instead
+of serving them until a TTL runs out.
+
+Changes are appended as JSON lines to a shared log file that every worker polls. A message is applied in the
+process that publishes it straight away and in the others within one poll interval. Applying a message twice
+is harmless, so when the log is rotated a worker simply reads the new file from the start.
+
+Settings: CACHE_INVALIDATION_LOG (file, default "cache_invalidations.log"), CACHE_INVALIDATION_POLL
+(seconds between polls, default 0.5), CACHE_INVALIDATION_LOG_MAX (bytes before the log is rotated, default 1 MB)
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional
+
+INVALIDATION_LOG = os.environ.get('CACHE_INVALIDATION_LOG', 'cache_invalidations.log')
+INVALIDATION_POLL = float(os.environ.get('CACHE_INVALIDATION_POLL', '0.5'))
+INVALIDATION_LOG_MAX = int(os.environ.get('CACHE_INVALIDATION_LOG_MAX', str(1024 * 1024)))
+
+# tells this process's own messages apart from those of other workers
+ORIGIN = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_handlers: List[Callable[[dict], None]] = []
+_write_lock = threading.Lock()
+_started = False
+_counts = {"published": 0, "received": 0}
+
+
+def on_invalidation(handler: Callable[[dict], None]) -> None:
+    """
+    Registers a function that drops a process's cached entries for a changed country
+    Args: Callable
+        handler: called with each message, a dict with "country", "kb_id" and "ready"
+    Returns: None
+    """
+    _handlers.append(handler)
+
+
+def publish_invalidation(country: str, kb_id: Optional[str] = None, ready: bool = False, path: str = None) -> None:
+    """
+    Announces that a country's knowledge base changed, to this process and every other worker
+    Args: str, str, bool, str
+        country: the country whose knowledge base changed
+        kb_id (optional): the knowledge base name, when known
+        ready (optional): whether the knowledge base is now complete and can be served
+        path (optional): the invalidation log
+    Returns: None
+    """
+    message = {"origin": ORIGIN, "time": time.time(), "country": country, "kb_id": kb_id, "ready": ready}
+    _apply(message)
+    _counts["published"] += 1
+    path = path or INVALIDATION_LOG
+    line = (json.dumps(message) + '\n').encode('utf-8')
+    with _write_lock:
+        try:
+            stat = os.stat(path) if os.path.exists(path) else None
+            if stat and stat.st_size > INVALIDATION_LOG_MAX and time.time() - stat.st_mtime > 10 * INVALIDATION_POLL:
+                # every reader has caught up with a log that has been quiet for a while, and notices the new file
+                with open(path + '.tmp', 'wb'):
+                    pass
+                os.replace(path + '.tmp', path)
+            # one write on a file opened for appending, so lines from concurrent workers never interleave
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print("LOG - Could not publish a cache invalidation: " + str(e))
+
+
+def _apply(message: dict) -> None:
+    for handler in _handlers:
+        try:
+            handler(message)
+        except Exception as e:
+            print("LOG - Cache invalidation handler failed: " + str(e))
+
+
+def _read_new(path: str, position: tuple) -> tuple:
+    # position is (inode, offset), a different inode or a shorter file means the log was rotated
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return position
+    inode, offset = position
+    if stat.st_ino != inode or stat.st_size < offset:
+        offset = 0
+    if stat.st_size == offset:
+        return stat.st_ino, offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    # a line still being written is left for the next poll
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].splitlines():
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if message.get("origin") != ORIGIN:
+            _counts["received"] += 1
+            _apply(message)
+    return stat.st_ino, offset + end
+
+
+def start_listening(path: str = None, interval: float = INVALIDATION_POLL) -> None:
+    """
+    Applies the invalidations other workers publish from now on, polling the log on a daemon thread
+    Args: str, float
+        path (optional): the invalidation log
+        interval: seconds between polls
+    Returns: None
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+    path = path or INVALIDATION_LOG
+    try:
+        stat = os.stat(path)
+        # older messages were already reflected in whatever this process loaded at startup
+        position = (stat.st_ino, stat.st_size)
+    except FileNotFoundError:
+        position = (None, 0)
+
+    def run(position: tuple) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                position = _read_new(path, position)
+            except OSError as e:
+                print("LOG - Could not read cache invalidations: " + str(e))
+
+    threading.Thread(target=run, args=(position,), name='cache-invalidation', daemon=True).start()
+
+
+def stats() -> dict:
+    return dict(_counts, origin=ORIGIN, listening=_started)
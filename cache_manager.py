@@ -0,0 +1,178 @@
+"""
+One memory budget shared by every in-process cache (document text, tagged text, WordNet lookups, knowledge
+base searches, document mappings and formatted answers).
+
+Every entry is sized when it is stored. While the caches are under budget everything is admitted; once they
+are full, a new entry only gets in if it has been asked for at least as often as the least recently used
+entries it would push out (TinyLFU admission, with frequencies kept in a count-min sketch that is halved
+periodically so old popularity fades). Eviction is least recently used across all caches together.
+State that cannot be fetched again, like the webhook's conversations (see session_store.py), is always admitted
+and takes its share of the budget, but only ever makes way for other such state, never for a cached entry.
+
+The budget is set with the CACHE_BUDGET_MB environment variable (default 256).
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Hashable, List
+
+CACHE_BUDGET = int(float(os.environ.get('CACHE_BUDGET_MB', '256')) * 1024 * 1024)
+
+_HALVE = bytes(value >> 1 for value in range(256))
+
+
+def estimate_size(value, depth: int = 0) -> int:
+    """
+    Estimates the memory held by a cached value, following containers and strings but not shared objects
+    Args: Any
+        value: the key or value to size
+    Returns: int
+      the approximate size in bytes
+    """
+    size = sys.getsizeof(value)
+    if depth > 3 or isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        return size
+    if isinstance(value, dict):
+        return size + sum(estimate_size(k, depth + 1) + estimate_size(v, depth + 1) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(estimate_size(item, depth + 1) for item in value)
+    return size
+
+
+class CountMinSketch:
+    """Approximate access counts in fixed memory, 4 bit style counters capped at 15"""
+
+    def __init__(self, width: int = 1 << 16, depth: int = 4, sample_size: int = 500000):
+        self.width = width
+        self.mask = width - 1
+        self.depth = depth
+        self.rows = [bytearray(width) for _ in range(depth)]
+        self.sample_size = sample_size
+        self.additions = 0
+
+    def _indexes(self, item: Hashable) -> List[int]:
+        h = hash(item)
+        return [hash((h, row)) & self.mask for row in range(self.depth)]
+
+    def add(self, item: Hashable) -> None:
+        for row, index in zip(self.rows, self._indexes(item)):
+            if row[index] < 15:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._age()
+
+    def frequency(self, item: Hashable) -> int:
+        return min(row[index] for row, index in zip(self.rows, self._indexes(item)))
+
+    def _age(self) -> None:
+        # halving every counter lets yesterday's popular entries make way for today's
+        for row in self.rows:
+            row[:] = row.translate(_HALVE)
+        self.additions //= 2
+
+
+class CacheManager:
+    """Accounts the size of every entry of the registered caches and decides what is admitted and evicted"""
+
+    def __init__(self, budget: int = CACHE_BUDGET):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.caches = {}
+        self.entries = OrderedDict()
+        # entries admitted with force, which an ordinary entry may never push out
+        self.forced = set()
+        self.used = 0
+        self.sketch = CountMinSketch()
+        self.rejected = 0
+        self.evicted = 0
+
+    def register(self, cache) -> None:
+        """Adds a cache, it must have a `name`, a `discard(key)` method and a `stats()` method"""
+        with self.lock:
+            self.caches[cache.name] = cache
+
+    def record_access(self, cache_name: str, key: Hashable, hit: bool) -> None:
+        """Counts a lookup towards the entry's frequency and, on a hit, makes the entry most recently used"""
+        entry = (cache_name, key)
+        with self.lock:
+            self.sketch.add(entry)
+            if hit and entry in self.entries:
+                self.entries.move_to_end(entry)
+
+    def admit(self, cache_name: str, key: Hashable, size: int, force: bool = False) -> bool:
+        """
+        Decides whether a new entry may be stored, evicting the least recently used entries to make room
+        Args: str, Hashable, int, bool
+            cache_name: the cache storing the entry
+            key: the entry's key
+            size: the entry's size in bytes
+            force (optional): always store it, for state that cannot be fetched again (e.g. a conversation);
+                              such an entry is only ever evicted to make room for another forced one
+        Returns: bool
+          whether the cache should store the entry
+        """
+        entry = (cache_name, key)
+        victims = []
+        with self.lock:
+            if size > self.budget // 8 and not force:
+                # a single huge entry would push out too many others
+                self.rejected += 1
+                return False
+            # replacing an entry frees its old size
+            used = self.used - self.entries.get(entry, 0)
+            if used + size > self.budget:
+                freed = 0
+                frequency = self.sketch.frequency(entry)
+                for victim, victim_size in self.entries.items():
+                    if victim == entry or (victim in self.forced and not force):
+                        continue
+                    if self.sketch.frequency(victim) > frequency and not force:
+                        self.rejected += 1
+                        return False
+                    victims.append(victim)
+                    freed += victim_size
+                    if used - freed + size <= self.budget:
+                        break
+                if used - freed + size > self.budget and not force:
+                    # the rest of the budget is held by forced entries
+                    self.rejected += 1
+                    return False
+                for victim in victims:
+                    self.used -= self.entries.pop(victim)
+                    self.forced.discard(victim)
+                self.evicted += len(victims)
+            self.used += size - self.entries.pop(entry, 0)
+            self.entries[entry] = size
+            if force:
+                self.forced.add(entry)
+            else:
+                self.forced.discard(entry)
+            caches = dict(self.caches)
+
+        # the caches are told outside the manager's lock, so the manager never waits for a cache's lock
+        for victim_cache, victim_key in victims:
+            caches[victim_cache].discard(victim_key)
+        return True
+
+    def forget(self, cache_name: str, keys: List[Hashable]) -> None:
+        """Stops accounting for entries a cache dropped by itself"""
+        with self.lock:
+            for key in keys:
+                self.used -= self.entries.pop((cache_name, key), 0)
+                self.forced.discard((cache_name, key))
+
+    def stats(self) -> dict:
+        with self.lock:
+            caches = dict(self.caches)
+            stats = {"budget_bytes": self.budget, "used_bytes": self.used, "entries": len(self.entries),
+                     "rejected": self.rejected, "evicted": self.evicted}
+            used_by = dict.fromkeys(caches, 0)
+            for (cache_name, _), size in self.entries.items():
+                used_by[cache_name] = used_by.get(cache_name, 0) + size
+        stats["caches"] = {name: dict(cache.stats(), used_bytes=used_by[name]) for name, cache in caches.items()}
+        return stats
+
+
+cache_manager = CacheManager()
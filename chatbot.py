@@ -1,25 +1,49 @@
+import argparse
 import re
-from typing import Union
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, TextIO
 
-from google.cloud.dialogflow_v2beta1 import SessionsClient
+from google.cloud.dialogflow_v2beta1 import SessionsClient, DetectIntentResponse
 from google.protobuf.json_format import MessageToDict
-from KnowledgeBase import create_knowledge_base, HEADER_LIST
+from KnowledgeBase import HEADER_LIST
 from IntentParsing import *
 from common_functions import *
+from kb_job_queue import kb_job_queue, READY
+from response_cache import response_cache, answer_cache_key
+from prefetcher import prefetcher
+from user_profile import UserProfile
+from fetch_planner import fetch_intent_inputs
+import nlp_batcher
+from cache_checkpoint import start_checkpointing
+from cache_invalidation import start_listening
+from country_aliases import canonical_country, has_knowledge_base
+from comparison import countries_in_text, strip_countries, comparison_session, compare_countries, format_comparison
+from city_kb import city_knowledge_base, prebuild_popular_cities
+from request_profiler import request_profiler, stage, annotate
 
 
-def default_kb_search(session: str, session_client: SessionsClient, user_input: str, current_kbid: str) -> str:
+def default_kb_search(session: str, session_client: SessionsClient, user_input: str, current_kbid: str,
+                      kb_detect_response: DetectIntentResponse = None) -> str:
     """
     returns a Dialogflow knowledge base response from the entire country knowledge base
-    Args: str, SessionsClient, str, str
+    Args: str, SessionsClient, str, str, DetectIntentResponse
         session: the name of the ongoing Dialogflow session
         session_client: the client accepting Dialogflow requests
         user_input: the input the user typed in
         current_kbid: the knowledge base you want to query
+        kb_detect_response (optional): a knowledge base query for this input that was already made
     Returns: str
         the response that was found from the knowledge base (or a default fallback)
     """
-    response = make_dialogflow_request(session, session_client, user_input, current_kbid)
+    if kb_detect_response is not None:
+        response = kb_detect_response
+    else:
+        response = make_dialogflow_request(session, session_client, user_input, current_kbid)
+    if response is None:
+        return "Sorry, I didn't get that."
     answers = response.query_result.knowledge_answers.answers
     if len(answers) > 0:
         answer = answers[0].answer
@@ -41,139 +65,353 @@ def default_kb_search(session: str, session_client: SessionsClient, user_input:
         return "Sorry, I didn't get that."
 
 
-def add_disliked_item(disliked_input: str, user_dict: dict[str, Union[str, list, dict]]) -> None:
+def answer_header_intent(session: str, session_client: SessionsClient, user_input: str, country: str,
+                         current_kbid: str, intent_name: str, user_profile: UserProfile,
+                         current_kbid_doc_mapping: dict, kb_future: Future = None) -> str:
+    """
+    Builds the knowledge base answer for a header intent, reusing a cached answer when one exists
+    Args: str, SessionsClient, str, str, str, str, UserProfile, dict, Future
+        session: the name of the ongoing Dialogflow session
+        session_client: the client accepting Dialogflow requests
+        user_input: the input the user typed in
+        country: the current country
+        current_kbid: the knowledge base you want to query
+        intent_name: the header intent that was detected
+        user_profile: the current knowledge about the user
+        current_kbid_doc_mapping: to use knowledge base documents
+        kb_future (optional): a knowledge base query for this input that is already in flight
+    Returns: str
+        the formatted answer (empty if nothing useful was found)
     """
-    adds a user dislike to their dictionary
-    Args: str, dict[str, Union[str, list, dict]]
+    dislikes = user_profile.dislikes
+    key = answer_cache_key(country, intent_name, dislikes, user_input)
+    answer = response_cache.get(key)
+    if answer is not None:
+        return answer
+
+    # only the inputs this intent's handler reads are fetched
+    kb_response, current_kbid_doc_mapping = fetch_intent_inputs(session, session_client, user_input, current_kbid,
+                                                                intent_name, current_kbid_doc_mapping, kb_future)
+    with stage("form_" + intent_name.lower() + "_intent_response"):
+        answer = kb_intent_response(kb_response or '', intent_name, country, dislikes, current_kbid_doc_mapping)
+    # an answer formed while the knowledge base could not be queried is only kept until this reply is sent
+    if kb_response is not None:
+        response_cache.set(key, answer)
+    return answer
+
+
+def answer_comparison(session: str, session_client: SessionsClient, user_input: str, countries: List[str],
+                      user_profile: UserProfile, intent_name: str = None) -> str:
+    """
+    Answers a question about several countries at once, e.g. "should I go to Italy or Spain for food"
+    Args: str, SessionsClient, str, List[str], UserProfile, str
+        session: the name of the ongoing Dialogflow session
+        session_client: the client accepting Dialogflow requests
+        user_input: the input the user typed in
+        countries: the countries mentioned in the input
+        user_profile: the current knowledge about the user
+        intent_name (optional): the header intent, if Dialogflow already detected one
+    Returns: str
+        one answer per country, the most useful first
+    """
+    question = strip_countries(user_input, countries)
+    if intent_name not in HEADER_LIST:
+        # with the country names gone, Dialogflow sees what is being compared rather than a country switch
+        response = make_dialogflow_request(comparison_session(session, 'intent'), session_client, question, None)
+        intent_name = response.query_result.intent.display_name
+    if intent_name not in HEADER_LIST:
+        return "What would you like me to compare, for example the food, the sights or the languages?"
+    user_profile.record_interest(intent_name)
+
+    def answer_for_country(country: str) -> str:
+        kb_id = get_kb_name_of_country(country)
+        if kb_id is None:
+            return ''
+        return answer_header_intent(comparison_session(session, country), session_client, question, country,
+                                    kb_id, intent_name, user_profile, map_doc_name_to_id(kb_id))
+
+    return format_comparison(compare_countries(countries, question, answer_for_country))
+
+
+def add_disliked_item(disliked_input: str, user_profile: UserProfile) -> None:
+    """
+    adds a user dislike to their profile
+    Args: str, UserProfile
         disliked_input: the string including the item the user dislikes
-        user_dict: the user's dictionary which includes their dislikes
+        user_profile: the user's profile which includes their dislikes
     Returns: None
     """
-    for word in disliked_input.lower().split():
-        pos_tags = nltk.pos_tag([word])
-        if 'N' in pos_tags[0][1] and word not in user_dict["dislikes"]:
-            user_dict["dislikes"].append(word)
+    words = [word for word in disliked_input.lower().split() if not user_profile.dislikes_word(word)]
+    # every word is tagged on its own, as before, but all of them go into the same tagging batch
+    for word, pos_tags in zip(words, nlp_batcher.pos_tag_batcher.run_many([(word,) for word in words])):
+        if 'N' in pos_tags[0][1]:
+            user_profile.add_dislike(word)
 
 
-if __name__ == '__main__':
-    session_client = dialogflow.SessionsClient()
-    session = session_client.session_path(PROJECT_ID, 'current-user-id')
-    user_dict = {"name": "", "countries": [], "interests": {}, "dislikes": []}
+def new_conversation(session: str, profile_dir: str = '') -> dict:
+    """
+    Creates the state that is carried between the turns of one conversation
+    Args: str, str
+        session: the name of the ongoing Dialogflow session
+        profile_dir (optional): where the user's {name}.json profile is kept, defaults to the current directory
+    Returns: dict
+        the conversation state
+    """
+    return {
+        "session": session,
+        "profile_dir": profile_dir,
+        "user_profile": UserProfile(),
+        "current_kbid": None,
+        "current_kbid_doc_mapping": None,
+        "filename": None,
+        "country": None,
+        "is_first_request": True,
+        "finished": False
+    }
 
-    current_kbid = None
-    current_kbid_doc_mapping = None
-    user_input = 'Hello'
-    filename = None
-    country = None
 
-    is_first_request = True
+def handle_turn(conversation: dict, session_client: SessionsClient, user_input: str) -> str:
+    """
+    Answers one line of user input and updates the conversation state
+    Args: dict, SessionsClient, str
+        conversation: the state created by new_conversation
+        session_client: the client accepting Dialogflow requests
+        user_input: the input the user typed in
+    Returns: str
+        everything the chatbot says in response (one message per line)
+    """
+    session = conversation["session"]
+    user_profile = conversation["user_profile"]
+    current_kbid = conversation["current_kbid"]
+    current_kbid_doc_mapping = conversation["current_kbid_doc_mapping"]
+    filename = conversation["filename"]
+    country = conversation["country"]
+    output = []
+
+    # "Italy or Spain for food?" is answered for every country at once, without switching the active country
+    compared = countries_in_text(user_input)
+    if len(compared) > 1:
+        with stage("compare"):
+            reply = answer_comparison(session, session_client, user_input, compared, user_profile)
+        if filename:
+            save_user_data(filename, user_profile.to_dict())
+        return reply
 
-    while user_input != 'exit':
-        user_input = user_input.lower()
-        if country and country.lower() in user_input:
-            user_input = re.sub(country.lower(), "", user_input)
-        response = make_dialogflow_request(session, session_client, user_input, None)
-
-        # convert response to a dictionary for parsing
-        response_dict = MessageToDict(response.query_result._pb)
-
-        # collect information about the user
-        parameters_dict = response_dict['parameters']
-
-        # case where we are loading the user context for the first time
-        if 'person' in parameters_dict and is_first_request and 'name' in parameters_dict['person']:
-            user_name = parameters_dict['person']['name']
-            filename = f"{user_name}.json"
-            if not os.path.exists(filename):
-                user_dict["name"] = user_name
-                save_user_data(filename, user_dict)
-                print(
-                    f"Nice to meet you {user_name}, what country are you interested in visiting?")
-            else:
-                user_dict = load_user_data(filename)
+    user_input = user_input.lower()
+    if country and country.lower() in user_input:
+        user_input = re.sub(country.lower(), "", user_input)
 
-                # user has previous countries in their JSON
-                if len(user_dict["countries"]) > 0:
-                    last_country = user_dict["countries"][-1]
-                    print(
-                        f"Welcome back {user_name}, let's continue researching your trip to {last_country}!")
+    # once a country is known, the knowledge base query is issued alongside (or as part of) the intent request
+    with stage("detect_intent"):
+        query_result, kb_future = detect_intent_with_knowledge(session, session_client, user_input, current_kbid)
+    # the knowledge base queries of this turn never change the contexts of the conversation itself
+    kb_session = kb_query_session(session)
 
-                    # load the current country context into Dialogflow
-                    user_input = f"I want to go to {last_country}"
-                    make_dialogflow_request(session, session_client, user_input, None)
+    # convert response to a dictionary for parsing
+    response_dict = MessageToDict(query_result._pb)
 
-                    # avoid showing the response from this extra request to the user
-                    response = {}
-                    response_dict = {}
-                    parameters_dict = {'geo-country': last_country}
+    # collect information about the user
+    parameters_dict = response_dict['parameters']
 
-                # existing user has never indicated interest in a country
-                else:
-                    print(f"Welcome back {user_name}, please let me know the name of a country you are interested in.")
-            is_first_request = False
+    # case where we are loading the user context for the first time
+    if 'person' in parameters_dict and conversation["is_first_request"] and 'name' in parameters_dict['person']:
+        user_name = parameters_dict['person']['name']
+        filename = os.path.join(conversation["profile_dir"], f"{user_name}.json")
+        if not os.path.exists(filename):
+            user_profile.name = user_name
+            save_user_data(filename, user_profile.to_dict())
+            output.append(f"Nice to meet you {user_name}, what country are you interested in visiting?")
+        else:
+            user_profile = UserProfile.from_dict(load_user_data(filename))
 
-        # new country detected, so you should switch context
-        if 'geo-country' in parameters_dict and parameters_dict['geo-country'] != '':
-            country = parameters_dict['geo-country']
+            # user has previous countries in their JSON
+            last_country = user_profile.last_country
+            if last_country is not None:
+                output.append(f"Welcome back {user_name}, let's continue researching your trip to {last_country}!")
 
-            if country in CURRENT_COUNTRIES:
+                # load the current country context into Dialogflow
+                user_input = f"I want to go to {last_country}"
+                make_dialogflow_request(session, session_client, user_input, None)
+
+                # avoid showing the response from this extra request to the user
+                query_result = None
+                response_dict = {}
+                parameters_dict = {'geo-country': last_country}
+
+            # existing user has never indicated interest in a country
+            else:
+                output.append(f"Welcome back {user_name}, please let me know the name of a country you are interested in.")
+        conversation["is_first_request"] = False
+
+    # new country detected, so you should switch context
+    if 'geo-country' in parameters_dict and parameters_dict['geo-country'] != '':
+        country = canonical_country(parameters_dict['geo-country'])
+        annotate(country=country)
+
+        with stage("switch_country"):
+            if has_knowledge_base(country):
                 current_kbid = get_kb_name_of_country(country)
             else:
-                # build a knowledge base for that country if it does not already exist
-                current_kbid = create_knowledge_base(country)
-                CURRENT_COUNTRIES.append(country)
-                print("Generating knowledge base for " + country + ". Note: this may take several minutes.")
-            current_kbid_doc_mapping = map_doc_name_to_id(current_kbid)
-
-            # update the user dict so this country is now the most recent
-            if country in user_dict["countries"]:
-                user_dict["countries"].remove(country)
-            user_dict["countries"].append(country)
-
-        # extract what information the user would like to know
-        if 'intent' in response_dict and 'displayName' in response_dict['intent']:
-            intent_name = response_dict['intent']['displayName']
-
-            # if you are in the Dislike flow, add the disliked item
-            if intent_name == "Dislike":
-                add_disliked_item(parameters_dict['Disliked'], user_dict)
-                print(response.query_result.fulfillment_text)
-
-            # if no intent was detected, go to the default knowledge base flow
-            elif intent_name == "Default Fallback":
-                print(default_kb_search(session, session_client, user_input, current_kbid))
-
-            # if an article header intent is detected, call the intent-specific parsing logic
-            elif intent_name in HEADER_LIST and country:
-
-                # update the user dict with their interests
-                if intent_name in user_dict["interests"]:
-                    user_dict["interests"][intent_name] += 1
+                # build a knowledge base for that country in the background so the conversation can continue
+                current_kbid = kb_job_queue.submit(country)["kb_id"]
+                output.append("Generating knowledge base for " + country + ". Note: this may take several minutes.")
+            current_kbid_doc_mapping = map_doc_name_to_id(current_kbid) if current_kbid else {}
+
+        # the speculative query was made against the previous country's knowledge base
+        kb_future = None
+
+        # update the user profile so this country is now the most recent
+        user_profile.visit_country(country)
+
+        # get ready for the questions this user usually asks while they read the reply
+        prefetcher.prefetch(country, current_kbid, user_profile)
+        prebuild_popular_cities(country)
+
+    # extract what information the user would like to know
+    if 'intent' in response_dict and 'displayName' in response_dict['intent']:
+        intent_name = response_dict['intent']['displayName']
+        annotate(intent=intent_name)
+
+        # if you are in the Dislike flow, add the disliked item
+        if intent_name == "Dislike":
+            add_disliked_item(parameters_dict['Disliked'], user_profile)
+            output.append(query_result.fulfillment_text)
+
+        # if no intent was detected, go to the default knowledge base flow
+        elif intent_name == "Default Fallback":
+            output.append(default_kb_search(kb_session, session_client, user_input, current_kbid,
+                                            kb_future.result() if kb_future else None))
+
+        # if an article header intent is detected, call the intent-specific parsing logic
+        elif intent_name in HEADER_LIST and country:
+
+            # update the user profile with their interests
+            user_profile.record_interest(intent_name)
+
+            # while a knowledge base is still being built, only answer from sections that are uploaded
+            section_ready = True
+            if current_kbid is None or not has_knowledge_base(country):
+                job = kb_job_queue.submit(country)
+                current_kbid = job["kb_id"]
+                section_ready = job["status"] == READY or intent_name in job["sections"]
+
+            if not section_ready or current_kbid is None:
+                output.append(f"I'm still gathering information about that for {country}, please ask me again in a minute.")
+            else:
+                # a question naming one of the country's cities is answered from the city's knowledge base once built
+                city = city_knowledge_base(country, user_input, intent_name)
+                if city is not None:
+                    place, place_kbid, place_mapping = city
+                    content = answer_header_intent(kb_session, session_client, user_input, place, place_kbid,
+                                                   intent_name, user_profile, place_mapping)
                 else:
-                    user_dict["interests"][intent_name] = 1
-
-                # check whether the entire knowledge base has been loaded
-                if len(current_kbid_doc_mapping) < 16:
-                    current_kbid_doc_mapping = map_doc_name_to_id(current_kbid)
-
-                kb_response = search_knowledge_base_by_intent(session, session_client, user_input, current_kbid,
-                                                              intent_name, current_kbid_doc_mapping)
-                if kb_response is None:
-                    kb_response = ''
-                result = response.query_result.fulfillment_text + ' ' + kb_intent_response(kb_response, intent_name,
-                                                                                  country, user_dict,
-                                                                                  current_kbid_doc_mapping)
+                    content = answer_header_intent(kb_session, session_client, user_input, country, current_kbid,
+                                                   intent_name, user_profile, current_kbid_doc_mapping, kb_future)
+                result = query_result.fulfillment_text + ' ' + content
                 if result == '':
-                    print("Sorry, I didn't get that.")
+                    output.append("Sorry, I didn't get that.")
                 else:
-                    print(result)
+                    output.append(result)
 
-            elif intent_name == "Goodbye":
-                print("Goodbye!")
-                exit(0)
-            else:
-                print(response.query_result.fulfillment_text)
+        elif intent_name == "Goodbye":
+            output.append("Goodbye!")
+            conversation["finished"] = True
+        else:
+            output.append(query_result.fulfillment_text)
 
-        if filename:
-            save_user_data(filename, user_dict)
+    if filename:
+        save_user_data(filename, user_profile.to_dict())
+
+    conversation.update({
+        "user_profile": user_profile,
+        "current_kbid": current_kbid,
+        "current_kbid_doc_mapping": current_kbid_doc_mapping,
+        "filename": filename,
+        "country": country
+    })
+    return '\n'.join(output)
+
+
+def run_batch(input_file: str, output: TextIO, workers: int = 8, profile_dir: str = '') -> None:
+    """
+    Answers a JSONL file of {"user": ..., "utterance": ...} records, streaming one JSONL answer per record
+    Args: str, TextIO, int, str
+        input_file: the file of records to answer
+        output: where the answers are written as soon as they are ready
+        workers: how many users are served at the same time
+        profile_dir (optional): where the profiles of the users who give their name are written
+    Returns: None
+    """
+    # each user's records are answered in file order, different users run concurrently
+    records_by_user = {}
+    with open(input_file, 'r') as f:
+        for line_number, line in enumerate(f):
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            records_by_user.setdefault(str(record["user"]), []).append((line_number, record["utterance"]))
+
+    # every user gets their own Dialogflow session (make_dialogflow_request and the knowledge base queries use
+    # the session they are given), all of them multiplexed over one client, so users can run concurrently
+    session_client = shared_client('SessionsClient')
+    output_lock = threading.Lock()
+
+    def run_user(user: str) -> None:
+        conversation = new_conversation(session_name(session_client, f"batch-{user}"), profile_dir)
+        for line_number, utterance in records_by_user[user]:
+            if conversation["finished"]:
+                conversation = new_conversation(conversation["session"], profile_dir)
+            result = {"line": line_number, "user": user, "utterance": utterance}
+            start = time.perf_counter()
+            try:
+                with request_profiler.request(country=conversation["country"]):
+                    result["answer"] = handle_turn(conversation, session_client, utterance)
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["ms"] = round((time.perf_counter() - start) * 1000, 2)
+            with output_lock:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(run_user, user) for user in records_by_user]:
+            future.result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chat with the travel agent, or answer a batch of questions")
+    parser.add_argument('--batch', help='JSONL file of {"user": ..., "utterance": ...} records to answer')
+    parser.add_argument('--output', help='where to write the JSONL answers (defaults to stdout)')
+    parser.add_argument('--workers', type=int, default=8, help='number of users answered concurrently')
+    args = parser.parse_args()
+
+    # start from the caches the previous run left behind
+    start_checkpointing()
+    # knowledge bases built or refreshed by other workers on this machine
+    start_listening()
+
+    if args.batch:
+        if args.output:
+            # the profiles of named users go next to the answers rather than wherever the batch was started
+            with open(args.output, 'w') as out:
+                run_batch(args.batch, out, args.workers, os.path.dirname(os.path.abspath(args.output)))
+        else:
+            run_batch(args.batch, sys.stdout, args.workers)
+        exit(0)
+
+    session_client = shared_client('SessionsClient')
+    conversation = new_conversation(session_name(session_client, 'current-user-id'))
+    user_input = 'Hello'
+
+    while user_input != 'exit':
+        try:
+            with request_profiler.request(country=conversation["country"]):
+                reply = handle_turn(conversation, session_client, user_input)
+        except UNAVAILABLE_ERRORS as e:
+            print("LOG - Dialogflow unavailable: " + str(e))
+            reply = UNAVAILABLE_REPLY
+        if reply:
+            print(reply)
+        if conversation["finished"]:
+            exit(0)
         user_input = input()
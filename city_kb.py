@@ -0,0 +1,163 @@
+"""
+Knowledge bases for the cities and destinations a country lists under Cities and Other_destinations.
+
+A city's page is scraped into its own knowledge base the first time a user asks about it, and from then on
+questions naming the city are answered from that knowledge base instead of the country's. The first few
+places a country lists (Wikivoyage orders them by importance) are built in the background as soon as
+someone starts talking about the country.
+
+Settings: CITY_PREBUILD (places built in the background per country, default 3)
+"""
+import os
+import re
+import threading
+from typing import List, Optional, Tuple
+from urllib.parse import unquote
+
+from KnowledgeBase import HEADER_LIST, PLACE_SECTIONS
+from common_functions import map_doc_name_to_id
+from cache_invalidation import on_invalidation
+from kb_job_queue import kb_job_queue, READY
+from kb_scheduler import BACKGROUND, INTERACTIVE
+from kb_snapshot import country_kb_id, knowledge_base_doc_mapping, load_snapshot
+
+CITY_PREBUILD = int(os.environ.get('CITY_PREBUILD', '3'))
+# a city page has no cities or regions of its own worth a document
+CITY_HEADERS = [header for header in HEADER_LIST if header not in PLACE_SECTIONS + ["Regions"]]
+
+# country -> [(city name, page title)]
+_places = {}
+_prebuilt = set()
+_lock = threading.Lock()
+
+
+def place_name(page: str) -> str:
+    """The name users say for a Wikivoyage page, e.g. "Naples_(Italy)" -> "Naples" """
+    return re.sub(r'\s*\(.*\)$', '', unquote(page).replace('_', ' '))
+
+
+def place_key(city: str, country: str) -> str:
+    """The name a city's knowledge base, job and snapshot go by, e.g. "Rome, Italy" """
+    return f"{city}, {country}"
+
+
+def places_of(country: str) -> List[Tuple[str, str]]:
+    """
+    The cities and destinations a country lists, read from its snapshot
+    Args: str
+        country: the country
+    Returns: List[Tuple[str, str]]
+      (name, Wikivoyage page) pairs, in the order the country page lists them
+    """
+    with _lock:
+        if country in _places:
+            return _places[country]
+    snapshot = load_snapshot(country)
+    if snapshot is None:
+        return []
+    pages = snapshot.places
+    if not pages:
+        # snapshots written before places were recorded: list items read "Rome — the Eternal City ..."
+        pages = []
+        for header in PLACE_SECTIONS:
+            if header in snapshot.sections:
+                for sentence in snapshot.sentences(header):
+                    match = re.match(r"([A-Z][\w'.]*(?: [A-Z][\w'.]*){0,3}) [-–—] ", sentence)
+                    if match:
+                        pages.append(match.group(1).replace(' ', '_'))
+    places = list(dict.fromkeys((place_name(page), page) for page in pages))
+    with _lock:
+        _places[country] = places
+    return places
+
+
+def city_in_text(text: str, country: str) -> Optional[Tuple[str, str]]:
+    """
+    Finds the first of a country's cities mentioned in a piece of text
+    Args: str, str
+        text: what the user typed
+        country: the country being talked about
+    Returns: Tuple[str, str]
+      (name, Wikivoyage page) of the city, or None
+    """
+    text = text.lower()
+    found = []
+    for city, page in places_of(country):
+        match = re.search(r'\b' + re.escape(city.lower()) + r'\b', text)
+        if match:
+            found.append((match.start(), city, page))
+    if not found:
+        return None
+    _, city, page = min(found)
+    return city, page
+
+
+def build_city(city: str, page: str, country: str, priority: int = INTERACTIVE) -> dict:
+    """Queues the build of a city's knowledge base, returning its job"""
+    return kb_job_queue.submit(place_key(city, country), priority, parent=country, page=page, headers=CITY_HEADERS)
+
+
+def city_knowledge_base(country: str, user_input: str, intent_name: str) -> Optional[Tuple[str, str, dict]]:
+    """
+    Routes a question to the narrowest knowledge base that can answer it, building a city's on first mention
+    Args: str, str, str
+        country: the country being talked about
+        user_input: what the user typed
+        intent_name: the header intent that was detected
+    Returns: Tuple[str, str, dict]
+      the city's name (e.g. "Rome, Italy"), knowledge base and document mapping, or None to answer from the
+      country while the city's knowledge base (or the asked section) is not built yet
+    """
+    if intent_name not in CITY_HEADERS:
+        return None
+    mentioned = city_in_text(user_input, country)
+    if mentioned is None:
+        return None
+    city, page = mentioned
+    key = place_key(city, country)
+
+    # another worker may have built it already, but a build that was paused or is still running has only
+    # written a snapshot of the sections it got to, so the asked section has to be in it
+    kb_id = country_kb_id(key)
+    if kb_id is None or intent_name not in (knowledge_base_doc_mapping(kb_id) or {}):
+        # resumes a paused background build ahead of the queue
+        job = build_city(city, page, country)
+        kb_id = job["kb_id"]
+        if kb_id is None or (job["status"] != READY and intent_name not in job["sections"]):
+            return None
+    return key, kb_id, map_doc_name_to_id(kb_id)
+
+
+def prebuild_popular_cities(country: str) -> int:
+    """
+    Builds the knowledge bases of the first CITY_PREBUILD places a country lists, in the background
+    Args: str
+        country: the country a user started talking about
+    Returns: int
+      the number of builds queued
+    """
+    with _lock:
+        if country in _prebuilt:
+            return 0
+    places = places_of(country)
+    if not places:
+        # the country's own knowledge base is not built yet, try again next time
+        return 0
+    with _lock:
+        _prebuilt.add(country)
+    queued = 0
+    for city, page in places[:CITY_PREBUILD]:
+        if country_kb_id(place_key(city, country)) is None:
+            build_city(city, page, country, BACKGROUND)
+            queued += 1
+    return queued
+
+
+def _forget_places(message: dict) -> None:
+    # a rebuilt or refreshed country may list different places
+    with _lock:
+        _places.pop(message["country"], None)
+        _prebuilt.discard(message["country"])
+
+
+on_invalidation(_forget_places)
@@ -1,13 +1,87 @@
 import os
+import re
 import json
-from typing import Optional
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
 
+from google.api_core import exceptions as api_exceptions
 from google.cloud import dialogflow_v2beta1 as dialogflow
-from google.cloud.dialogflow_v2beta1 import DetectIntentResponse
+from google.cloud.dialogflow_v2beta1 import DetectIntentResponse, QueryResult
+
+from single_flight import SingleFlight, TTLCache, cached_single_flight
+from kb_snapshot import country_kb_id, knowledge_base_doc_mapping
+from resilience import CallPolicy, CircuitOpenError, resilient_call
+from cache_checkpoint import register_checkpoint, kb_version, country_version, set_version_source
+from cache_invalidation import on_invalidation
 
 PROJECT_ID = 's4395-travel-agent-bapg'
+NUM_KB_DOCUMENTS = 14
+# the characters and length Dialogflow accepts in a session ID
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,36}$')
+
+# how the knowledge base query for a turn is made once a country is known:
+#   sequential - after the intent is classified, only for intents that read it (the default)
+#   parallel   - speculatively, at the same time as the intent request, wasted whenever the turn turns out to be
+#                a greeting, a dislike, a country switch or an intent answered without the knowledge base
+#   single     - as part of the intent request itself (one round trip)
+KB_QUERY_MODE = os.environ.get('KB_QUERY_MODE', 'sequential')
+KNOWLEDGE_INTENT_PREFIX = 'Knowledge.KnowledgeBase'
+speculation_pool = ThreadPoolExecutor(max_workers=16)
+
+# every Dialogflow RPC gets a deadline, bounded retries and a circuit breaker (one per API, so a slow
+# document listing cannot trip the breaker for intent detection). Reads are hedged; detect_intent is not,
+# because a duplicate request would advance the session's contexts twice. For the same reason detect_intent is
+# only retried when Dialogflow turned it away without running it, never after a timeout or an internal error.
+DIALOGFLOW_DEADLINE = float(os.environ.get('DIALOGFLOW_DEADLINE', '5'))
+RETRYABLE_ERRORS = (api_exceptions.ServiceUnavailable, api_exceptions.DeadlineExceeded,
+                    api_exceptions.InternalServerError, api_exceptions.TooManyRequests, api_exceptions.Aborted,
+                    ConnectionError)
+NOT_RUN_ERRORS = (api_exceptions.ServiceUnavailable, api_exceptions.ResourceExhausted)
+detect_intent_policy = CallPolicy('detect_intent', deadline=DIALOGFLOW_DEADLINE, hedge=False,
+                                  retry_on=RETRYABLE_ERRORS, safe_to_retry=NOT_RUN_ERRORS)
+documents_policy = CallPolicy('documents', deadline=DIALOGFLOW_DEADLINE, retry_on=RETRYABLE_ERRORS)
+knowledge_bases_policy = CallPolicy('knowledge_bases', deadline=DIALOGFLOW_DEADLINE, retry_on=RETRYABLE_ERRORS)
+UNAVAILABLE_ERRORS = RETRYABLE_ERRORS + (CircuitOpenError,)
+UNAVAILABLE_REPLY = "Sorry, I'm having trouble reaching my travel guide right now. Please try again in a moment."
+# what a knowledge base search returns when the query fell back because Dialogflow could not be reached,
+# so answers formed during an outage are never cached
+KB_UNAVAILABLE = object()
+
+# one client (and so one gRPC channel) per kind of Dialogflow client, see shared_client
+_clients = {}
+_clients_lock = threading.Lock()
+
+# identical lookups from concurrent users share one RPC, and popular answers are kept for a short while
+doc_mapping_flight = SingleFlight()
+doc_mapping_cache = TTLCache(ttl=300, name='doc_mappings')
+kb_search_flight = SingleFlight()
+kb_search_cache = TTLCache(ttl=60, max_size=4096, name='kb_search')
+kb_name_flight = SingleFlight()
+kb_name_cache = TTLCache(ttl=600, name='kb_names')
+
+# warm caches survive restarts (see cache_checkpoint.py), as long as the knowledge base they came from is unchanged
+register_checkpoint(doc_mapping_cache, version_of=kb_version)
+register_checkpoint(kb_search_cache, version_of=lambda key: kb_version(key[0]))
+register_checkpoint(kb_name_cache, version_of=country_version)
+
 CURRENT_COUNTRIES = ['United States', 'Canada', 'Mexico', 'Brazil', 'Argentina', 'United Kingdom', 'France', 'Germany', 'Italy', 'Spain', 'Russia', 'China', 'Japan', 'South Korea', 'India', 'Australia', 'New Zealand', 'Egypt', 'South Africa', 'Nigeria', 'Croatia']
 
+
+def _drop_country_entries(message: dict) -> None:
+    # another worker (or this one) rebuilt or refreshed a country, see cache_invalidation.py
+    country, kb_id = message["country"], message.get("kb_id")
+    kb_name_cache.pop(country)
+    if kb_id:
+        doc_mapping_cache.pop(kb_id)
+        kb_search_cache.pop_where(lambda key: key[0] == kb_id)
+    if message.get("ready") and country not in CURRENT_COUNTRIES:
+        CURRENT_COUNTRIES.append(country)
+
+
+on_invalidation(_drop_country_entries)
+
 def save_user_data(file_name: str, data: dict) -> None:
     """
     Saves user information in their personal user file
@@ -41,16 +115,74 @@ def get_kb_name_of_country(country: str) -> str:
     Returns: str
       the knowledgebase ID of that country
     """
-    # Create a client
-    client = dialogflow.KnowledgeBasesClient()
+    return cached_single_flight(kb_name_cache, kb_name_flight, country, resilient_call, knowledge_bases_policy,
+                                _find_knowledge_base, country, fallback=lambda: _local_kb_name(country),
+                                should_cache=lambda kb_id: kb_id is not None)
+
+
+def shared_client(name: str):
+    """
+    Returns the process-wide Dialogflow client of a kind. A client's gRPC channel multiplexes concurrent calls
+    over one HTTP/2 connection, so every thread and every user session shares it instead of connecting per request
+    Args: str
+        name: the client class, e.g. "SessionsClient"
+    Returns: the client
+    """
+    # looked up on every call so a fake backend installed later (see fake_dialogflow.py) gets its own client
+    factory = getattr(dialogflow, name)
+    with _clients_lock:
+        entry = _clients.get(name)
+        if entry is None or entry[0] is not factory:
+            entry = _clients[name] = (factory, factory())
+        return entry[1]
+
+
+def session_name(session_client, session: Optional[str]) -> str:
+    """
+    Resolves the Dialogflow session a request belongs to, so every user keeps their own contexts
+    Args: SessionsClient, str
+        session_client: the client accepting Dialogflow requests
+        session: a full session path, a bare session ID, or None for the shared 'test' session
+    Returns: str
+      the full session path, with IDs Dialogflow would reject (too long, spaces) replaced by a digest
+    """
+    prefix, session_id = session.rsplit('/', 1) if session and '/sessions/' in session else (None, session or 'test')
+    if not SESSION_ID_PATTERN.match(session_id):
+        session_id = hashlib.sha1(session_id.encode('utf-8')).hexdigest()[:32]
+    return f"{prefix}/{session_id}" if prefix else session_client.session_path(PROJECT_ID, session_id)
+
+
+def kb_query_session(session: str) -> str:
+    """
+    The Dialogflow session the knowledge base queries made for a user run on
+    Args: str
+        session: the user's Dialogflow session (a path or an ID)
+    Returns: str
+        a session derived from it, so the queries never change the contexts of the conversation itself
+    """
+    digest = hashlib.sha1(f"{session}|kb".encode('utf-8')).hexdigest()[:24]
+    prefix = session.rsplit('/', 1)[0] + '/' if '/' in session else ''
+    return prefix + 'kb-' + digest
+
+
+def _find_knowledge_base(country: str, timeout: float = None) -> str:
+    client = shared_client('KnowledgeBasesClient')
     request = dialogflow.ListKnowledgeBasesRequest(parent=f"projects/{PROJECT_ID}")
-    page_result = client.list_knowledge_bases(request=request)
+    page_result = client.list_knowledge_bases(request=request, timeout=timeout)
 
     # Handle the response
     for response in page_result:
        if response.display_name == country:
            return response.name
 
+
+def _local_kb_name(country: str) -> str:
+    # used while Dialogflow is unreachable, a country's snapshot remembers which knowledge base it belongs to
+    kb_id = country_kb_id(country)
+    if kb_id is None:
+        raise CircuitOpenError(f"cannot look up the knowledge base of {country}")
+    return kb_id
+
 def map_doc_name_to_id(kb_id) -> dict:
     """
     Returns a dict of a knowledge base's documents and their ID values
@@ -59,28 +191,66 @@ def map_doc_name_to_id(kb_id) -> dict:
     Returns: dict
       maps a document's display name (e.g. "Cities") to its ID
     """
+    local_mapping = knowledge_base_doc_mapping(kb_id)
+    if local_mapping is not None and len(local_mapping) >= NUM_KB_DOCUMENTS:
+        return local_mapping
+
+    # a partially built knowledge base is not cached so newly uploaded sections show up straight away
+    return cached_single_flight(doc_mapping_cache, doc_mapping_flight, kb_id, resilient_call, documents_policy,
+                                _list_kb_documents, kb_id,
+                                fallback=lambda: _fallback_doc_mapping(kb_id, local_mapping),
+                                should_cache=lambda mapping: len(mapping) >= NUM_KB_DOCUMENTS)
+
+
+def _fallback_doc_mapping(kb_id, local_mapping: Optional[dict]) -> dict:
+    # while Dialogflow is unreachable, an expired mapping or a partial snapshot is better than no answer
+    mapping = doc_mapping_cache.get_stale(kb_id) or local_mapping
+    if mapping is None:
+        raise CircuitOpenError(f"cannot list the documents of {kb_id}")
+    return mapping
+
+
+def _list_kb_documents(kb_id, timeout: float = None) -> dict:
     mapping = {}
-    client = dialogflow.DocumentsClient()
+    client = shared_client('DocumentsClient')
     request = dialogflow.ListDocumentsRequest(
         parent=kb_id,
     )
-    page_result = client.list_documents(request=request)
+    page_result = client.list_documents(request=request, timeout=timeout)
 
     # Handle the response
     for response in page_result:
         mapping[response.display_name] = response.name
     return mapping
 
+
+# knowledge bases without a local snapshot are versioned by their documents in Dialogflow, so the checkpointed
+# answers about the preloaded countries survive a restart too
+set_version_source(map_doc_name_to_id, get_kb_name_of_country)
+
+def normalize_query(user_input: str) -> str:
+    """
+    Reduces a question to a canonical form so trivially different wordings share cache entries
+    Args: str
+        user_input: the string that the user typed to the agent
+    Returns: str
+      the lowercased question without punctuation or repeated whitespace
+    """
+    return ' '.join(re.sub(r'[^\w\s]', ' ', user_input.lower()).split())
+
+
 def make_dialogflow_request(session, session_client, user_input: str, kb_id: str = None) -> DetectIntentResponse:
     """
     Makes a basic request to the Google Dialogflow agent
     Args:
+        session: the user's Dialogflow session (a path or an ID), so concurrent users never share contexts
+        session_client: the client accepting Dialogflow requests
         user_input: the string that the user typed to the agent
         kb_id (optional): knowledge base id you want to reference for the response
     Returns: dict
       the raw response from Dialogflow
     """
-    session = session_client.session_path(PROJECT_ID, 'test')
+    session = session_name(session_client, session)
     if user_input == '':
         user_input = 'Null'
     text_input = dialogflow.types.TextInput(text=user_input, language_code='en-US')
@@ -96,25 +266,87 @@ def make_dialogflow_request(session, session_client, user_input: str, kb_id: str
     request = dialogflow.DetectIntentRequest(
         session=session, query_input=query_input, query_params=query_params
     )
-    result = session_client.detect_intent(request=request)
+    # a failed knowledge base query only costs the answer its extra detail, so it falls back to no answers
+    result = resilient_call(detect_intent_policy, session_client.detect_intent, request=request,
+                            fallback=(lambda: None) if kb_id else None)
     if result is None:
         return None
     else:
         return result
 
-def search_knowledge_base_by_intent(session, session_client, user_input, kb_id, intent, current_kbid_doc_mapping) -> Optional[str]:
+def intent_query_result(response: DetectIntentResponse) -> QueryResult:
+    """
+    Finds the intent classification in a response to a request that had a knowledge base attached
+    Args: DetectIntentResponse
+        response: the raw response from Dialogflow
+    Returns: QueryResult
+      the result for the matched intent, even when a knowledge answer outranked it
+    """
+    if not response.query_result.intent.display_name.startswith(KNOWLEDGE_INTENT_PREFIX):
+        return response.query_result
+    for result in response.alternative_query_results:
+        if result.intent.display_name and not result.intent.display_name.startswith(KNOWLEDGE_INTENT_PREFIX):
+            return result
+    return response.query_result
+
+
+def detect_intent_with_knowledge(session, session_client, user_input: str,
+                                 kb_id: str = None) -> Tuple[QueryResult, Optional[Future]]:
+    """
+    Classifies the user's intent and, when a knowledge base is known, queries it in the same round of requests
+    Args:
+        user_input: the string that the user typed to the agent
+        kb_id (optional): knowledge base id to query alongside the intent request
+    Returns: Tuple[QueryResult, Future]
+      the intent classification and a future for the knowledge base response (None if it was not queried)
+    """
+    if not kb_id or KB_QUERY_MODE == 'sequential':
+        return make_dialogflow_request(session, session_client, user_input, None).query_result, None
+
+    if KB_QUERY_MODE == 'single':
+        response = make_dialogflow_request(session, session_client, user_input, kb_id)
+        if response is None:
+            # the combined request failed, so classify the intent on its own
+            return make_dialogflow_request(session, session_client, user_input, None).query_result, None
+        kb_future = Future()
+        kb_future.set_result(response)
+        return intent_query_result(response), kb_future
+
+    # the speculative query runs on a session of its own, so it never races the intent request for the contexts
+    kb_future = speculation_pool.submit(make_dialogflow_request, kb_query_session(session), session_client,
+                                        user_input, kb_id)
+    response = make_dialogflow_request(session, session_client, user_input, None)
+    return response.query_result, kb_future
+
+
+def search_knowledge_base_by_intent(session, session_client, user_input, kb_id, intent, current_kbid_doc_mapping,
+                                    kb_detect_response: DetectIntentResponse = None) -> Optional[str]:
     """
     Queries a specific Dialogflow knowledge base document
     Args:
         user_input: the string that the user typed to the agent
         kb_id: knowledge base id you want to reference for the response
         intent: the name of the intent the user had (maps to a knowledge base document)
+        kb_detect_response (optional): a knowledge base query for this input that was already made
     Returns: str
-      the raw response from the Dialogflow knowledge base query
+      the raw response from the Dialogflow knowledge base query, or KB_UNAVAILABLE if the query failed
     """
-    response = make_dialogflow_request(session, session_client, user_input, kb_id)
-    if response is None or current_kbid_doc_mapping is None:
+    if current_kbid_doc_mapping is None:
         return None
+    key = (kb_id, intent, normalize_query(user_input))
+    return cached_single_flight(kb_search_cache, kb_search_flight, key, _search_knowledge_base_document,
+                                session, session_client, user_input, kb_id, intent, current_kbid_doc_mapping,
+                                kb_detect_response, should_cache=lambda answer: answer is not KB_UNAVAILABLE)
+
+
+def _search_knowledge_base_document(session, session_client, user_input, kb_id, intent,
+                                    current_kbid_doc_mapping, kb_detect_response=None) -> Optional[str]:
+    if kb_detect_response is not None:
+        response = kb_detect_response
+    else:
+        response = make_dialogflow_request(session, session_client, user_input, kb_id)
+    if response is None:
+        return KB_UNAVAILABLE
     knowledge_base_answers = response.query_result.knowledge_answers.answers
     for result in response.alternative_query_results:
         knowledge_base_answers += result.knowledge_answers.answers
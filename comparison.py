@@ -0,0 +1,85 @@
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+from common_functions import CURRENT_COUNTRIES
+from country_aliases import alias_index
+
+# the most countries answered for one question, more would make the reply too long to read
+MAX_COMPARED = 4
+
+# every compared country is answered on its own thread, so a comparison takes about as long as one answer
+compare_pool = ThreadPoolExecutor(max_workers=2 * MAX_COMPARED)
+
+
+def countries_in_text(text: str) -> List[str]:
+    """
+    Finds the known countries mentioned in a piece of text, by any of their names ("USA", "the UK", "Korea")
+    Args: str
+        text: what the user typed
+    Returns: List[str]
+      the countries, in the order they were mentioned
+    """
+    found = [country for _, _, country in alias_index.spans(text) if country in CURRENT_COUNTRIES]
+    return list(dict.fromkeys(found))
+
+
+def strip_countries(text: str, countries: List[str]) -> str:
+    """Removes the country names from a question, leaving what is being compared (e.g. "for food")"""
+    # from the end, so the earlier spans stay where they are
+    for start, end, country in reversed(alias_index.spans(text)):
+        if country in countries:
+            text = text[:start] + ' ' + text[end:]
+    return ' '.join(text.split())
+
+
+def comparison_session(session: str, country: str) -> str:
+    """
+    A separate Dialogflow session for the part of a comparison about one country,
+    so the parallel knowledge base queries do not disturb the contexts of the user's own session
+    Args: str, str
+        session: the name of the user's Dialogflow session
+        country: the country being answered
+    Returns: str
+      the name of the session to query with
+    """
+    digest = hashlib.sha1(f"{session}|{country}".encode('utf-8')).hexdigest()[:24]
+    return session.rsplit('/', 1)[0] + '/cmp-' + digest
+
+
+def _relevance(question: str, answer: str) -> Tuple[int, int, int]:
+    words = {word for word in re.findall(r'[a-z]+', question.lower()) if len(word) > 3}
+    answer_lower = answer.lower()
+    return (answer != '', sum(word in answer_lower for word in words), len(answer))
+
+
+def compare_countries(countries: List[str], question: str,
+                      answer_for_country: Callable[[str], str]) -> List[Tuple[str, str]]:
+    """
+    Answers the same question for several countries at once and ranks the answers
+    Args: List[str], str, Callable
+        countries: the countries to compare
+        question: the question without the country names
+        answer_for_country: builds the answer for one country
+    Returns: List[Tuple[str, str]]
+      (country, answer) pairs, the most useful answer first
+    """
+    futures = [(country, compare_pool.submit(answer_for_country, country)) for country in countries[:MAX_COMPARED]]
+    answers = []
+    for country, future in futures:
+        try:
+            answers.append((country, future.result() or ''))
+        except Exception as e:
+            # one country failing should not spoil the answers for the others
+            print("LOG - Comparison failed for " + country + ": " + str(e))
+            answers.append((country, ''))
+    # sorted is stable, so equally useful answers keep the order the user mentioned the countries in
+    return sorted(answers, key=lambda pair: _relevance(question, pair[1]), reverse=True)
+
+
+def format_comparison(answers: List[Tuple[str, str]]) -> str:
+    lines = ["Here's how they compare:"]
+    for country, answer in answers:
+        lines.append(f"{country}: {answer.strip()}" if answer.strip() else f"{country}: I couldn't find anything about that.")
+    return '\n'.join(lines)
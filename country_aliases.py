@@ -0,0 +1,220 @@
+"""
+Resolves the ways users name a country ("USA", "the UK", "Korea", "italian", "España") to the one name its
+knowledge base is built under, so a different spelling never starts a second, minutes-long build.
+
+The names, abbreviations, Wikivoyage redirects and demonyms live in country_aliases.json and are loaded once
+into a dict keyed by a normalized form, so resolving a name is one normalization and one dict lookup.
+Demonyms ("Italian food") and ambiguous names ("America", "the States", "US") resolve a name Dialogflow
+extracted, but are not taken as a country mentioned in free text, where "South America" or "what states should
+I visit" would otherwise read as the United States. Short abbreviations ("UK", "NZ") only match in their upper
+case form.
+
+Usage: python country_aliases.py --redirects adds the Wikivoyage redirects of every country to the file
+Settings: COUNTRY_ALIASES (file, default the country_aliases.json next to this module)
+"""
+import json
+import os
+import re
+import sys
+import threading
+import unicodedata
+from typing import Dict, List, Tuple
+
+import requests
+
+from common_functions import CURRENT_COUNTRIES, NUM_KB_DOCUMENTS
+from kb_scheduler import wikivoyage_limiter
+from kb_snapshot import country_kb_id, knowledge_base_doc_mapping
+
+ALIAS_FILE = os.environ.get('COUNTRY_ALIASES',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'country_aliases.json'))
+WIKIVOYAGE_API = 'https://en.wikivoyage.org/w/api.php'
+# matched case-sensitively, since in lower case they are ordinary words
+ABBREVIATION_PATTERN = re.compile(r'^[A-Z]{2,5}$|^[A-Z][a-z]$')
+WORD = re.compile(r"[^\W_]+(?:['.][^\W_]+)*\.?")
+
+
+def normalize_key(name: str) -> str:
+    """
+    The form every alias is indexed under: no accents, punctuation or leading "the", lower case
+    Args: str
+        name: a country name or alias
+    Returns: str
+      the normalized name, e.g. "the U.K." -> "uk", "España" -> "espana"
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char)).lower()
+    name = re.sub(r"[.']", '', name)
+    name = ' '.join(re.sub(r'[^\w]+', ' ', name).split())
+    return name[4:] if name.startswith('the ') else name
+
+
+class CountryAliasIndex:
+    """Every known name of every country, mapped to the name its knowledge base is built under"""
+
+    def __init__(self, path: str = ALIAS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        # normalized name -> country, for names Dialogflow extracted (demonyms and ambiguous names included)
+        self.names = {}
+        # normalized name -> country, for names mentioned in free text (no demonyms, ambiguous names or abbreviations)
+        self.text_names = {}
+        # abbreviation -> country, matched case-sensitively in free text
+        self.abbreviations = {}
+        self.max_words = 1
+        self.known_countries = 0
+        self._load()
+
+    def _load(self) -> None:
+        entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        for country, entry in entries.items():
+            self._add(country, country, text=True)
+            for alias in entry.get("aliases", []):
+                self._add(alias, country, text=True)
+            for name in entry.get("demonyms", []) + entry.get("ambiguous", []):
+                self._add(name, country, text=False)
+        self._add_known_countries()
+
+    def _add(self, name: str, country: str, text: bool) -> None:
+        key = normalize_key(name)
+        if not key:
+            return
+        # an earlier entry wins, so a country's own name is never taken over by another country's alias
+        self.names.setdefault(key, country)
+        if not text:
+            return
+        if ABBREVIATION_PATTERN.match(name.replace('.', '')):
+            # as written, so "U.S." is matched but the ambiguous "US" is not
+            self.abbreviations.setdefault(name, country)
+        else:
+            self.text_names.setdefault(key, country)
+            self.max_words = max(self.max_words, len(key.split()))
+
+    def _add_known_countries(self) -> None:
+        # countries built since startup (CURRENT_COUNTRIES only grows) resolve in any casing too
+        if len(CURRENT_COUNTRIES) == self.known_countries:
+            return
+        with self.lock:
+            for country in CURRENT_COUNTRIES[self.known_countries:]:
+                self._add(country, country, text=True)
+            self.known_countries = len(CURRENT_COUNTRIES)
+
+    def canonical(self, name: str) -> str:
+        """
+        Resolves a country name or alias
+        Args: str
+            name: what the user or Dialogflow called the country
+        Returns: str
+          the name the country's knowledge base is built under, or the name itself if it is not known
+        """
+        self._add_known_countries()
+        return self.names.get(normalize_key(name), name.strip())
+
+    def spans(self, text: str) -> List[Tuple[int, int, str]]:
+        """
+        Finds the countries named in a piece of text, preferring the longest name ("South Korea" over "Korea")
+        Args: str
+            text: what the user typed
+        Returns: List[Tuple[int, int, str]]
+          (start, end, country) for every mention, in order
+        """
+        self._add_known_countries()
+        words = [(match.start(), match.end(), match.group()) for match in WORD.finditer(text)]
+        found = []
+        x = 0
+        while x < len(words):
+            for count in range(min(self.max_words, len(words) - x), 0, -1):
+                key = normalize_key(' '.join(word for _, _, word in words[x:x + count]))
+                country = self.text_names.get(key)
+                if country is None and count == 1:
+                    word = words[x][2]
+                    country = self.abbreviations.get(word) or self.abbreviations.get(word.rstrip('.'))
+                if country is not None:
+                    found.append((words[x][0], words[x + count - 1][1], country))
+                    x += count - 1
+                    break
+            x += 1
+        return found
+
+
+alias_index = CountryAliasIndex()
+
+
+def canonical_country(name: str) -> str:
+    """The name a country's knowledge base is built under, see CountryAliasIndex.canonical"""
+    return alias_index.canonical(name)
+
+
+def has_knowledge_base(country: str) -> bool:
+    """
+    Checks whether a (canonical) country already has a complete knowledge base, so no build is needed
+    Args: str
+        country: the country, as returned by canonical_country
+    Returns: bool
+      True if this worker knows the country or a snapshot of its whole knowledge base exists
+    """
+    if country in CURRENT_COUNTRIES:
+        return True
+    kb_id = country_kb_id(country)
+    # a build that was paused or is still running leaves a snapshot of only the sections it got to
+    return kb_id is not None and len(knowledge_base_doc_mapping(kb_id) or {}) >= NUM_KB_DOCUMENTS
+
+
+def _redirects(title: str) -> List[str]:
+    # the page a name leads to, then every redirect to that page
+    params = {'action': 'query', 'format': 'json', 'titles': title, 'redirects': 1}
+    with wikivoyage_limiter.acquire(WIKIVOYAGE_API):
+        pages = requests.get(WIKIVOYAGE_API, params=params, timeout=30).json()['query']['pages']
+    target = next(iter(pages.values()))['title']
+    params = {'action': 'query', 'format': 'json', 'list': 'backlinks', 'bltitle': target,
+              'blfilterredir': 'redirects', 'bllimit': 500}
+    with wikivoyage_limiter.acquire(WIKIVOYAGE_API):
+        backlinks = requests.get(WIKIVOYAGE_API, params=params, timeout=30).json()['query']['backlinks']
+    return [target] + [link['title'] for link in backlinks]
+
+
+def add_redirects(path: str = ALIAS_FILE) -> Dict[str, int]:
+    """
+    Adds the Wikivoyage redirects of every country in the alias file and CURRENT_COUNTRIES to the file
+    Args: str
+        path: the alias file
+    Returns: Dict[str, int]
+      the number of aliases added per country
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    for country in CURRENT_COUNTRIES:
+        entries.setdefault(country, {"aliases": [], "demonyms": []})
+
+    added = {}
+    for country, entry in entries.items():
+        known = {normalize_key(name)
+                 for name in [country] + entry["aliases"] + entry["demonyms"] + entry.get("ambiguous", [])}
+        new = []
+        for title in _redirects(country):
+            # redirects like "Italy/Cities" or "Italy (country)" are sub-pages and disambiguations, not names
+            if '/' not in title and normalize_key(title) not in known:
+                known.add(normalize_key(title))
+                new.append(title)
+        entry["aliases"].extend(new)
+        added[country] = len(new)
+
+    # one country per line keeps the file reviewable; write then rename so a failure never truncates it
+    lines = [f"  {json.dumps(country, ensure_ascii=False)}: {json.dumps(entry, ensure_ascii=False)}"
+             for country, entry in entries.items()]
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('{\n' + ',\n'.join(lines) + '\n}\n')
+    os.replace(path + '.tmp', path)
+    return added
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--redirects']:
+        for name, count in add_redirects().items():
+            print(f"{name}: {count} new aliases")
+    else:
+        for name in sys.argv[1:]:
+            print(f"{name} -> {canonical_country(name)}")
@@ -0,0 +1,307 @@
+"""
+An in-process stand-in for the Dialogflow API, used by the benchmarks and load tests.
+It returns real dialogflow_v2beta1 messages so the chatbot code runs unchanged, but never touches the network.
+"""
+import itertools
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Callable, List, Optional
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud import dialogflow_v2beta1 as dialogflow
+
+from common_functions import PROJECT_ID, CURRENT_COUNTRIES
+from KnowledgeBase import HEADER_LIST
+
+REAL_SESSIONS_CLIENT = dialogflow.SessionsClient
+REAL_DOCUMENTS_CLIENT = dialogflow.DocumentsClient
+REAL_KNOWLEDGE_BASES_CLIENT = dialogflow.KnowledgeBasesClient
+
+# (intent, words that trigger it), checked in order
+INTENT_KEYWORDS = [
+    ("Eat", ["eat", "food", "meal", "dish", "restaurant"]),
+    ("Drink", ["drink", "beer", "wine", "bar"]),
+    ("See", ["see", "sight", "landmark", "museum"]),
+    ("Do", ["do", "activities", "activity", "fun"]),
+    ("Talk", ["language", "speak", "talk"]),
+    ("Buy", ["buy", "currency", "money", "shopping"]),
+    ("Get_in", ["get there", "get in", "fly", "airport", "reach"]),
+    ("Stay_healthy", ["healthy", "health", "sick"]),
+    ("Stay_safe", ["safe", "crime", "danger"]),
+    ("Connect", ["internet", "phone", "connect", "online"]),
+    ("Respect", ["respect", "customs", "etiquette", "rude"]),
+    ("Cities", ["cities", "city", "towns"]),
+    ("Regions", ["regions", "region", "areas"]),
+    ("Other_destinations", ["destinations", "other places", "spots"]),
+]
+
+SECTION_TEXT = {
+    "Regions": "{country} is divided into several regions with their own traditions. The Northern Highlands and "
+               "the Coastal Lowlands are the regions most visitors choose to explore first.",
+    "Cities": "The capital is the largest city in {country} and has excellent museums and markets. Other "
+              "major cities such as Springfield and Riverton are easy to reach by train from the capital.",
+    "Other_destinations": "Beyond the cities, {country} has national parks, quiet islands and mountain villages "
+                          "that are well worth the trip for travellers with more time.",
+    "Get_in": "Most visitors arrive through the Capital International Airport, which has flights from every "
+              "continent. The Northern Express Train connects {country} with its neighbours several times a day.",
+    "See": "Visitors should not miss the Royal Palace of the Old Town, the National Museum of Modern Art and "
+           "the Cathedral of Saint Mary when they travel around {country}.",
+    "Do": "Some of the most popular events are the Summer Festival of Lights and the Grand Harbour Regatta, "
+          "which draw visitors from all over {country} every year.",
+    "Talk": "The official language of {country} is English, although Spanish and French are widely spoken in "
+            "the border regions. Learning a few basic phrases will always be appreciated.",
+    "Buy": "The currency of {country} is the local dollar, and cards are accepted in most shops. Markets in "
+           "the old town are the best places to buy souvenirs.",
+    "Eat": "Food in {country} is hearty and varied, and pasta, cheese, sausage and bread appear at almost every "
+           "meal. Street stalls sell chocolate, pastry and fresh fruit late into the evening.",
+    "Drink": "Locals enjoy beer, wine and coffee, and every town has a bar on the main square. Tap water is "
+             "safe to drink in most of {country}.",
+    "Stay_healthy": "Tap water is safe to drink in the cities of {country}, and pharmacies are easy to find. "
+                    "Travellers should carry sunscreen during the summer months.",
+    "Stay_safe": "{country} is generally safe for visitors, but pickpockets operate in crowded tourist areas. "
+                 "Keep valuables out of sight on public transport.",
+    "Connect": "Mobile coverage is good throughout {country}, and free wifi is common in cafes and hotels. "
+               "Prepaid SIM cards can be bought at the airport.",
+    "Respect": "People in {country} value punctuality and polite greetings. Dress modestly when visiting "
+               "churches and other religious sites.",
+}
+
+
+class FakeOperation:
+    """Mimics the long-running operation returned by create_document"""
+
+    def __init__(self, document):
+        self.document = document
+
+    def result(self, timeout=None):
+        return self.document
+
+
+class FakeBackend:
+    """
+    Holds the fake agent's knowledge bases and counts every RPC made against it.
+    Every RPC sleeps for `latency` seconds to stand in for the network round trip.
+    Faults can be injected: `error_rate` of RPCs fail as unavailable and `slow_rate` take `slow_latency` instead.
+    """
+
+    def __init__(self, latency: float = 0.0, countries: Optional[List[str]] = None, error_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_latency: float = 2.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.calls = Counter()
+        # detect_intent calls per session, to check concurrent users never share one
+        self.sessions = Counter()
+        self.intervals = []
+        self.knowledge_bases = {}
+        self.documents = {}
+        for country in (CURRENT_COUNTRIES if countries is None else countries):
+            kb_name = self.add_knowledge_base(country)
+            for header in HEADER_LIST:
+                self.add_document(kb_name, header, SECTION_TEXT[header].format(country=country).encode('utf-8'))
+
+    def add_knowledge_base(self, display_name: str) -> str:
+        name = f"projects/{PROJECT_ID}/knowledgeBases/fake{next(self.ids)}"
+        with self.lock:
+            self.knowledge_bases[name] = display_name
+            self.documents[name] = {}
+        return name
+
+    def add_document(self, kb_name: str, display_name: str, content: bytes) -> dialogflow.Document:
+        document = dialogflow.Document(
+            name=f"{kb_name}/documents/doc{next(self.ids)}",
+            display_name=display_name,
+            mime_type='text/plain',
+            raw_content=content
+        )
+        with self.lock:
+            self.documents[kb_name][document.name] = document
+        return document
+
+    def rpc(self, method: str, timeout: Optional[float] = None) -> None:
+        """Records an RPC and waits out the simulated network latency, raising like gRPC on injected faults"""
+        start = time.perf_counter()
+        latency = self.slow_latency if random.random() < self.slow_rate else self.latency
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+        elif latency > 0:
+            time.sleep(latency)
+        with self.lock:
+            self.calls[method] += 1
+            self.intervals.append((start, time.perf_counter()))
+        if timeout is not None and latency > timeout:
+            raise api_exceptions.DeadlineExceeded(f"{method} exceeded its {timeout:.3f}s deadline")
+        if random.random() < self.error_rate:
+            raise api_exceptions.ServiceUnavailable(f"{method} is unavailable")
+
+    def reset_calls(self) -> None:
+        with self.lock:
+            self.calls.clear()
+            self.sessions.clear()
+            self.intervals.clear()
+
+    def network_waves(self) -> int:
+        """
+        Counts how many sequential round trips the recorded RPCs cost, treating overlapping calls as one
+        Returns: int
+            the number of non-overlapping groups of RPCs
+        """
+        with self.lock:
+            intervals = sorted(self.intervals)
+        waves = 0
+        wave_end = None
+        for start, end in intervals:
+            if wave_end is None or start >= wave_end:
+                waves += 1
+                wave_end = end
+            else:
+                wave_end = max(wave_end, end)
+        return waves
+
+    def install(self) -> Callable[[], None]:
+        """
+        Points the dialogflow client classes at this backend
+        Returns: Callable
+            restores the real clients when called
+        """
+        backend = self
+        dialogflow.SessionsClient = lambda *args, **kwargs: FakeSessionsClient(backend)
+        dialogflow.DocumentsClient = lambda *args, **kwargs: FakeDocumentsClient(backend)
+        dialogflow.KnowledgeBasesClient = lambda *args, **kwargs: FakeKnowledgeBasesClient(backend)
+
+        def restore():
+            dialogflow.SessionsClient = REAL_SESSIONS_CLIENT
+            dialogflow.DocumentsClient = REAL_DOCUMENTS_CLIENT
+            dialogflow.KnowledgeBasesClient = REAL_KNOWLEDGE_BASES_CLIENT
+        return restore
+
+    def classify(self, text: str) -> dialogflow.QueryResult:
+        """Matches the input against the agent's intents with simple keyword rules"""
+        lowered = text.lower()
+        parameters = {"geo-country": ""}
+        intent = "Default Fallback"
+        fulfillment = ""
+
+        name_match = re.search(r"\b(?:my name is|i am|i'm)\s+([a-z]+)", lowered)
+        dislike_match = re.search(r"\b(?:don't|do not|dont) like\s+(.+)", lowered)
+        countries = sorted(set(self.knowledge_bases.values()) | set(CURRENT_COUNTRIES), key=len, reverse=True)
+        country = next((c for c in countries if c.lower() in lowered), None)
+
+        if name_match:
+            intent = "Prompt for user's name"
+            parameters["person"] = {"name": name_match.group(1).title()}
+        elif dislike_match:
+            intent = "Dislike"
+            parameters["Disliked"] = dislike_match.group(1)
+            fulfillment = "Noted, I will avoid that."
+        elif country:
+            intent = "Country"
+            parameters["geo-country"] = country
+            fulfillment = f"I can help you research a trip to {country}."
+        elif re.search(r"\b(bye|goodbye)\b", lowered):
+            intent = "Goodbye"
+        else:
+            for header, keywords in INTENT_KEYWORDS:
+                if any(re.search(r"\b" + re.escape(keyword) + r"\b", lowered) for keyword in keywords):
+                    intent = header
+                    break
+        if text.lower() in ('hello', 'hi'):
+            intent = "Welcome Intent"
+            fulfillment = "Hi! What is your name?"
+
+        return dialogflow.QueryResult(
+            query_text=text,
+            parameters=parameters,
+            intent=dialogflow.Intent(display_name=intent),
+            fulfillment_text=fulfillment
+        )
+
+    def knowledge_answers(self, text: str, kb_names: List[str], intent: str) -> dialogflow.KnowledgeAnswers:
+        """Answers from the document for the detected intent, or the document sharing the most words with the input"""
+        words = set(re.findall(r'\w{4,}', text.lower()))
+        answers = []
+        with self.lock:
+            documents = [document for kb_name in kb_names for document in self.documents.get(kb_name, {}).values()]
+        for document in documents:
+            content = document.raw_content.decode('utf-8')
+            overlap = len(words & set(re.findall(r'\w{4,}', content.lower())))
+            if document.display_name == intent or overlap > 0:
+                confidence = 1.0 if document.display_name == intent else overlap / (len(words) or 1)
+                answers.append(dialogflow.KnowledgeAnswers.Answer(
+                    source=document.name,
+                    answer=content,
+                    match_confidence=min(confidence, 1.0)
+                ))
+        answers.sort(key=lambda answer: answer.match_confidence, reverse=True)
+        return dialogflow.KnowledgeAnswers(answers=answers[:3])
+
+
+class FakeSessionsClient:
+    session_path = staticmethod(REAL_SESSIONS_CLIENT.session_path)
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    def detect_intent(self, request=None, **kwargs) -> dialogflow.DetectIntentResponse:
+        self.backend.rpc('detect_intent', kwargs.get('timeout'))
+        with self.backend.lock:
+            self.backend.sessions[request.session] += 1
+        text = request.query_input.text.text
+        query_result = self.backend.classify(text)
+        kb_names = list(request.query_params.knowledge_base_names) if request.query_params else []
+        if kb_names:
+            query_result.knowledge_answers = self.backend.knowledge_answers(text, kb_names,
+                                                                            query_result.intent.display_name)
+        return dialogflow.DetectIntentResponse(query_result=query_result)
+
+
+class FakeDocumentsClient:
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    def list_documents(self, request=None, parent=None, **kwargs) -> List[dialogflow.Document]:
+        self.backend.rpc('list_documents', kwargs.get('timeout'))
+        parent = request.parent if request is not None else parent
+        with self.backend.lock:
+            return list(self.backend.documents.get(parent, {}).values())
+
+    def get_document(self, request=None, name=None, **kwargs) -> dialogflow.Document:
+        self.backend.rpc('get_document', kwargs.get('timeout'))
+        name = request.name if request is not None else name
+        kb_name = name.split('/documents/')[0]
+        with self.backend.lock:
+            return self.backend.documents[kb_name][name]
+
+    def create_document(self, request=None, parent=None, document=None, **kwargs) -> FakeOperation:
+        self.backend.rpc('create_document', kwargs.get('timeout'))
+        if request is not None:
+            parent, document = request.parent, request.document
+        return FakeOperation(self.backend.add_document(parent, document.display_name, document.raw_content))
+
+
+class FakeKnowledgeBasesClient:
+    common_project_path = staticmethod(REAL_KNOWLEDGE_BASES_CLIENT.common_project_path)
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    def list_knowledge_bases(self, request=None, parent=None, **kwargs) -> List[dialogflow.KnowledgeBase]:
+        self.backend.rpc('list_knowledge_bases', kwargs.get('timeout'))
+        with self.backend.lock:
+            return [dialogflow.KnowledgeBase(name=name, display_name=display_name)
+                    for name, display_name in self.backend.knowledge_bases.items()]
+
+    def create_knowledge_base(self, request=None, parent=None, knowledge_base=None,
+                              **kwargs) -> dialogflow.KnowledgeBase:
+        self.backend.rpc('create_knowledge_base', kwargs.get('timeout'))
+        if request is not None:
+            knowledge_base = request.knowledge_base
+        name = self.backend.add_knowledge_base(knowledge_base.display_name)
+        return dialogflow.KnowledgeBase(name=name, display_name=knowledge_base.display_name)
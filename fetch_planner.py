@@ -0,0 +1,67 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import FrozenSet, Tuple
+
+from common_functions import KB_UNAVAILABLE, map_doc_name_to_id, search_knowledge_base_by_intent
+from IntentParsing import get_raw_kb_text, HANDLER_INPUTS, KB_RESPONSE, ARTICLE
+from request_profiler import stage
+
+# fetches a handler's article while its knowledge base query is in flight
+planner_pool = ThreadPoolExecutor(max_workers=8)
+
+
+def planned_inputs(intent_name: str) -> FrozenSet[str]:
+    """
+    The inputs the handler of an intent reads
+    Args: str
+        intent_name: the header intent
+    Returns: FrozenSet[str]
+      KB_RESPONSE and/or ARTICLE
+    """
+    return frozenset(HANDLER_INPUTS.get(intent_name, {KB_RESPONSE}))
+
+
+def needs_kb_response(intent_name: str) -> bool:
+    """Whether answering an intent needs a knowledge base query, so callers only speculate on useful ones"""
+    return KB_RESPONSE in planned_inputs(intent_name)
+
+
+def fetch_intent_inputs(session: str, session_client, user_input: str, kb_id: str, intent_name: str,
+                        current_kbid_doc_mapping: dict, kb_future: Future = None) -> Tuple[str, dict]:
+    """
+    Fetches exactly the inputs the intent's handler reads, the knowledge base answer and the article in parallel
+    Args: str, SessionsClient, str, str, str, dict, Future
+        session: the name of the ongoing Dialogflow session
+        session_client: the client accepting Dialogflow requests
+        user_input: the input the user typed in
+        kb_id: the knowledge base of the current country
+        intent_name: the header intent that was detected
+        current_kbid_doc_mapping: the document mapping known so far (may be incomplete or None)
+        kb_future (optional): a knowledge base query for this input that is already in flight
+    Returns: Tuple[str, dict]
+      the knowledge base answer ('' if the handler does not read it, None if Dialogflow could not be reached)
+      and the document mapping
+    """
+    needs = planned_inputs(intent_name)
+
+    # the mapping is served from the snapshot or the cache, it only costs an RPC the first time
+    mapping = current_kbid_doc_mapping or {}
+    if intent_name not in mapping:
+        with stage("doc_mapping"):
+            mapping = map_doc_name_to_id(kb_id)
+
+    article_future = None
+    if ARTICLE in needs and intent_name in mapping:
+        # the handler reads the article from the document cache this fills
+        article_future = planner_pool.submit(get_raw_kb_text, mapping[intent_name])
+
+    kb_response = ''
+    if KB_RESPONSE in needs:
+        with stage("kb_search"):
+            kb_response = search_knowledge_base_by_intent(session, session_client, user_input, kb_id, intent_name,
+                                                          mapping, kb_future.result() if kb_future else None)
+        kb_response = None if kb_response is KB_UNAVAILABLE else kb_response or ''
+
+    if article_future is not None:
+        with stage("article"):
+            article_future.result()
+    return kb_response, mapping
@@ -0,0 +1,213 @@
+"""
+The cold tier of the knowledge base snapshots: every country's snapshot compressed on disk with one zlib
+dictionary shared by all countries, so the phrasing Wikivoyage articles have in common is stored once.
+
+Layout of the store directory:
+    dictionary.zdict    the shared dictionary (at most 32 KB, zlib's window size)
+    catalog.json        per country its knowledge base and document names, so lookups by document or knowledge
+                        base name never decompress anything
+    <Country>.takbz     prefix b'TAKZ', u16 format version, 8 byte id of the dictionary, then the zlib stream
+
+Another process may rebuild the store (python kb_snapshot.py --compact) while workers read it, so a store
+loads the dictionary and catalog again whenever either file on disk was replaced.
+"""
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+COLD_MAGIC = b'TAKZ'
+COLD_FORMAT_VERSION = 1
+COLD_PREFIX = struct.Struct('<4sH8s')
+DICTIONARY_SIZE = 32 * 1024
+# sentences split into runs of this many words, the runs several countries share go into the dictionary
+PHRASE_WORDS = 4
+
+
+def train_dictionary(texts: Iterable[str], samples: Iterable[bytes] = (), size: int = DICTIONARY_SIZE) -> bytes:
+    """
+    Builds a compression dictionary from the phrases that recur across countries
+    Args: Iterable[str], Iterable[bytes], int
+        texts: the section text of each country
+        samples (optional): raw snapshot prefixes whose structure recurs (e.g. the JSON header)
+        size: the largest dictionary to build
+    Returns: bytes
+      the dictionary, most useful phrases last since zlib reaches the end of its window most cheaply
+    """
+    counts = Counter()
+    for text in texts:
+        words = re.findall(r'\S+', text)
+        counts.update({' '.join(words[x:x + PHRASE_WORDS]) for x in range(0, len(words) - PHRASE_WORDS + 1)})
+    phrases = [phrase for phrase, count in counts.most_common() if count > 1]
+
+    chosen = []
+    used = 0
+    for sample in samples:
+        chosen.append(sample[:size // 8])
+        used += len(chosen[-1])
+    for phrase in phrases:
+        encoded = phrase.encode('utf-8') + b' '
+        if used + len(encoded) > size:
+            break
+        chosen.append(encoded)
+        used += len(encoded)
+    return b''.join(reversed(chosen))
+
+
+class ColdStore:
+    """Compressed snapshots of every country, decompressed on demand"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.dictionary = None
+        self.dictionary_id = None
+        self.catalog = {}
+        # (inode, mtime, size) of the dictionary and catalog files as last loaded
+        self.stamps = None
+        self._load()
+
+    def _path(self, country: str) -> str:
+        return os.path.join(self.directory, country.replace(' ', '_') + '.takbz')
+
+    def _stamps(self) -> tuple:
+        stamps = []
+        for name in ('dictionary.zdict', 'catalog.json'):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                stamps.append(None)
+                continue
+            stamps.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return tuple(stamps)
+
+    def _load(self) -> None:
+        # stamped before reading, so a file replaced while it is read is loaded again next time
+        self.stamps = self._stamps()
+        dictionary_path = os.path.join(self.directory, 'dictionary.zdict')
+        if os.path.exists(dictionary_path):
+            with open(dictionary_path, 'rb') as f:
+                self._set_dictionary(f.read())
+        catalog_path = os.path.join(self.directory, 'catalog.json')
+        if os.path.exists(catalog_path):
+            with open(catalog_path, 'r') as f:
+                self.catalog = json.load(f)
+
+    def _refresh(self) -> None:
+        # called with the lock held, picks up a rebuild made by another process
+        if self._stamps() != self.stamps:
+            self._load()
+
+    def _set_dictionary(self, dictionary: bytes) -> None:
+        self.dictionary = dictionary
+        self.dictionary_id = hashlib.sha1(dictionary).digest()[:8]
+
+    def _write(self, name: str, data: bytes) -> None:
+        # write then rename, so readers never see a half-written file
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def countries(self) -> List[str]:
+        with self.lock:
+            self._refresh()
+            return list(self.catalog)
+
+    def entry(self, country: str) -> Optional[dict]:
+        """The catalog entry of a country: {"kb_id": ..., "docs": {header: document name}}"""
+        with self.lock:
+            self._refresh()
+            return self.catalog.get(country)
+
+    def get(self, country: str) -> Optional[bytes]:
+        """
+        Decompresses a country's snapshot
+        Args: str
+            country: the country to read
+        Returns: bytes
+          the snapshot in the .takb format, or None if the store does not have it
+        """
+        with self.lock:
+            self._refresh()
+            if country not in self.catalog:
+                return None
+            dictionary, dictionary_id = self.dictionary, self.dictionary_id
+        try:
+            with open(self._path(country), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        magic, version, file_dictionary_id = COLD_PREFIX.unpack_from(data, 0)
+        if magic == COLD_MAGIC and version == COLD_FORMAT_VERSION and file_dictionary_id != dictionary_id:
+            # the file was rewritten with a dictionary replaced since the check above
+            with self.lock:
+                self._refresh()
+                dictionary, dictionary_id = self.dictionary, self.dictionary_id
+        if magic != COLD_MAGIC or version != COLD_FORMAT_VERSION or file_dictionary_id != dictionary_id:
+            raise ValueError(f"{self._path(country)} does not match this store's dictionary")
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        return decompressor.decompress(data[COLD_PREFIX.size:]) + decompressor.flush()
+
+    def put(self, country: str, data: bytes, kb_id: Optional[str], docs: Dict[str, str]) -> int:
+        """
+        Compresses a country's snapshot into the store
+        Args: str, bytes, str, Dict[str, str]
+            country: the country of the snapshot
+            data: the snapshot in the .takb format
+            kb_id: its knowledge base
+            docs: maps each header to its document name
+        Returns: int
+          the compressed size in bytes
+        """
+        with self.lock:
+            if self.dictionary is None:
+                raise ValueError("the cold store has no dictionary yet, rebuild it first")
+            compressor = zlib.compressobj(level=9, zdict=self.dictionary)
+            compressed = COLD_PREFIX.pack(COLD_MAGIC, COLD_FORMAT_VERSION, self.dictionary_id) + \
+                compressor.compress(data) + compressor.flush()
+            self._write(os.path.basename(self._path(country)), compressed)
+            self.catalog[country] = {"kb_id": kb_id, "docs": docs}
+            self._write('catalog.json', json.dumps(self.catalog).encode('utf-8'))
+            self.stamps = self._stamps()
+        return len(compressed)
+
+    def remove(self, country: str) -> None:
+        with self.lock:
+            if self.catalog.pop(country, None) is None:
+                return
+            self._write('catalog.json', json.dumps(self.catalog).encode('utf-8'))
+            self.stamps = self._stamps()
+            try:
+                os.remove(self._path(country))
+            except FileNotFoundError:
+                pass
+
+    def rebuild(self, snapshots: Dict[str, tuple]) -> Dict[str, int]:
+        """
+        Trains a new dictionary on the given snapshots and recompresses all of them with it
+        Args: Dict[str, tuple]
+            snapshots: maps each country to (snapshot bytes, section texts, kb_id, docs)
+        Returns: Dict[str, int]
+          the compressed size of each country
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        dictionary = train_dictionary((text for _, texts, _, _ in snapshots.values() for text in texts),
+                                      samples=[data[:2048] for data, _, _, _ in list(snapshots.values())[:1]])
+        with self.lock:
+            # countries not being recompressed were compressed with the old dictionary, so they go
+            for country in set(self.catalog) - set(snapshots):
+                try:
+                    os.remove(self._path(country))
+                except FileNotFoundError:
+                    pass
+            self.catalog = {}
+            self._write('dictionary.zdict', dictionary)
+            self._set_dictionary(dictionary)
+            self.stamps = self._stamps()
+        return {country: self.put(country, data, kb_id, docs) for country, (data, _, kb_id, docs) in snapshots.items()}
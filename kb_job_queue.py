@@ -0,0 +1,346 @@
+import argparse
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from KnowledgeBase import HEADER_LIST, create_empty_knowledge_base, delete_document, scrape
+from common_functions import CURRENT_COUNTRIES, documents_policy, get_kb_name_of_country, map_doc_name_to_id, \
+    _list_kb_documents
+from cache_invalidation import publish_invalidation
+from kb_scheduler import BACKGROUND, INTERACTIVE, PriorityJobQueue, document_rate_limiter
+from resilience import resilient_call
+
+JOB_STATE_FILE = 'kb_jobs.json'
+
+BUILDING = 'building'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class KnowledgeBaseJobQueue:
+    """
+    Builds country knowledge bases on a local worker thread so a user's request never waits on a scrape.
+    Job state is persisted to disk, so builds interrupted by a restart resume where they stopped.
+
+    Builds a user asked for run before background refreshes, and a running background job steps aside
+    between sections when one is queued, resuming from the next section afterwards.
+    """
+
+    def __init__(self, state_file: str = JOB_STATE_FILE, num_workers: int = 1):
+        self.state_file = state_file
+        self.num_workers = num_workers
+        self.lock = threading.Lock()
+        self.pending = PriorityJobQueue()
+        self.running = set()
+        self.workers = []
+        self.jobs = self._load()
+
+        for country, job in self.jobs.items():
+            if job["status"] == READY and job.get("parent") is None and country not in CURRENT_COUNTRIES:
+                CURRENT_COUNTRIES.append(country)
+            if job["status"] == BUILDING or job.get("refresh"):
+                # the process stopped mid-build, so pick up from the last finished section
+                self.pending.put(country, job.get("priority", INTERACTIVE))
+                self._start_workers()
+
+    def submit(self, country: str, priority: int = INTERACTIVE, parent: Optional[str] = None,
+               page: Optional[str] = None, headers: Optional[List[str]] = None) -> dict:
+        """
+        Requests a knowledge base build for a country, returning immediately
+        Args: str, int, str, str, List[str]
+            country: the country to build a knowledge base for
+            priority (optional): INTERACTIVE when a user is waiting for it, BACKGROUND otherwise
+            parent (optional): for a city, the country it belongs to (cities are not added to CURRENT_COUNTRIES)
+            page (optional): the Wikivoyage page to scrape, when it is not named after the country
+            headers (optional): the sections to scrape, defaults to HEADER_LIST
+        Returns: dict
+            a snapshot of the job (concurrent requests for the same country share one build)
+        """
+        with self.lock:
+            job = self.jobs.get(country)
+            if job is not None and job["status"] == FAILED:
+                # a retry picks up after the sections the failed attempt already uploaded
+                job.update(status=BUILDING, error=None, finished=None, priority=priority)
+                self._save()
+                self.pending.put(country, priority)
+            elif job is None:
+                job = {
+                    "country": country,
+                    "status": BUILDING,
+                    "kb_id": None,
+                    "sections": [],
+                    "error": None,
+                    "submitted": time.time(),
+                    "finished": None,
+                    "priority": priority,
+                    "refresh": None,
+                    "parent": parent,
+                    "page": page,
+                    "headers": headers
+                }
+                self.jobs[country] = job
+                self._save()
+                self.pending.put(country, priority)
+            elif job["status"] == BUILDING and priority < job.get("priority", INTERACTIVE):
+                # a user now waits on a build queued in the background, so it moves up the queue
+                job["priority"] = priority
+                self._save()
+                self.pending.put(country, priority)
+            snapshot = self._snapshot(job)
+        self._start_workers()
+        return snapshot
+
+    def refresh(self, country: str) -> dict:
+        """
+        Queues a background rescrape of a country. The current documents keep being served and are only
+        deleted once their replacements are uploaded. Countries without a knowledge base get a background build.
+        Args: str
+            country: the country to refresh
+        Returns: dict
+            a snapshot of the job
+        """
+        with self.lock:
+            job = self.jobs.get(country)
+            build = job["status"] == FAILED if job is not None else country not in CURRENT_COUNTRIES
+            if not build:
+                if job is None:
+                    # preloaded countries were built before the job queue existed
+                    job = {
+                        "country": country,
+                        "status": READY,
+                        "kb_id": None,
+                        "sections": list(HEADER_LIST),
+                        "error": None,
+                        "submitted": time.time(),
+                        "finished": None
+                    }
+                    self.jobs[country] = job
+                if job["status"] == READY and not job.get("refresh"):
+                    job["priority"] = BACKGROUND
+                    job["refresh"] = {"sections": [], "old_docs": None, "submitted": time.time()}
+                    self._save()
+                    self.pending.put(country, BACKGROUND)
+                snapshot = self._snapshot(job)
+        if build:
+            return self.submit(country, BACKGROUND)
+        self._start_workers()
+        return snapshot
+
+    def status(self, country: str) -> Optional[dict]:
+        """
+        Polls the state of a country's build
+        Args: str
+            country: the country to check
+        Returns: dict
+            a snapshot of the job, or None if no build was ever requested
+        """
+        with self.lock:
+            job = self.jobs.get(country)
+            if job is None:
+                return None
+            return self._snapshot(job)
+
+    def metrics(self) -> dict:
+        """Queue depths and wait times per priority, plus the jobs being worked on"""
+        with self.lock:
+            running = sorted(self.running)
+        return {"queues": self.pending.metrics(), "running": running,
+                "document_rate_wait_s": round(document_rate_limiter.waited, 3)}
+
+    def wait(self, country: str, timeout: Optional[float] = None) -> Optional[dict]:
+        """
+        Blocks until a country's build finishes (used by scripts, never by the chat loop)
+        Args: str, float
+            country: the country to wait for
+            timeout (optional): the maximum number of seconds to wait
+        Returns: dict
+            the final job snapshot, or the current one if the timeout passed first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            job = self.status(country)
+            if job is None or job["status"] != BUILDING:
+                return job
+            if deadline is not None and time.time() >= deadline:
+                return job
+            time.sleep(0.5)
+
+    def _start_workers(self) -> None:
+        with self.lock:
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            while len(self.workers) < self.num_workers:
+                worker = threading.Thread(target=self._run, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def _run(self) -> None:
+        while True:
+            country, priority = self.pending.get()
+            with self.lock:
+                job = self.jobs[country]
+                # a job upgraded to a higher priority is queued twice, whichever copy comes second has nothing left
+                if country in self.running or (job["status"] != BUILDING and not job.get("refresh")):
+                    continue
+                self.running.add(country)
+                building = job["status"] == BUILDING
+
+            def current_priority() -> int:
+                # a user may start waiting on the job while it runs, upgrading it after it was taken off the queue
+                with self.lock:
+                    return self.jobs[country].get("priority", priority)
+
+            def should_stop() -> bool:
+                current = current_priority()
+                return current > INTERACTIVE and self.pending.has_waiting(current)
+
+            try:
+                finished = self._build(country, should_stop) if building else self._refresh(country, should_stop)
+                if not finished:
+                    print("LOG - Pausing background work on " + country + " for a build a user is waiting on")
+                    self.pending.put(country, current_priority())
+            except Exception as e:
+                with self.lock:
+                    job = self.jobs[country]
+                    job["error"] = str(e)
+                    if building:
+                        job["status"] = FAILED
+                        job["finished"] = time.time()
+                    else:
+                        # the existing documents are still there, so the country keeps being served
+                        job["refresh"] = None
+                    self._save()
+                print("LOG - Knowledge base " + ("build" if building else "refresh") + " failed for " + country + ": " + str(e))
+            finally:
+                with self.lock:
+                    self.running.discard(country)
+
+    def _build(self, country: str, should_stop) -> bool:
+        kb_id, existed = create_empty_knowledge_base(country)
+        # another worker, or an attempt that failed part way, may have uploaded sections this job has no record of
+        uploaded = resilient_call(documents_policy, _list_kb_documents, kb_id) if existed else {}
+        with self.lock:
+            job = self.jobs[country]
+            job["kb_id"] = kb_id
+            job["sections"] += [key for key in self._headers(job) if key in uploaded and key not in job["sections"]]
+            remaining = [key for key in self._headers(job) if key not in job["sections"]]
+            page = job.get("page")
+            self._save()
+
+        scrape(country, kb_id, sections=remaining, on_section=lambda key: self._section_done(country, key),
+               should_stop=should_stop, page=page)
+
+        with self.lock:
+            job = self.jobs[country]
+            if any(key not in job["sections"] for key in self._headers(job)):
+                return False
+            job["status"] = READY
+            job["finished"] = time.time()
+            is_country = job.get("parent") is None
+            if is_country and country not in CURRENT_COUNTRIES:
+                CURRENT_COUNTRIES.append(country)
+            self._save()
+        # every worker drops what it cached for the country and starts serving it
+        publish_invalidation(country, kb_id, ready=is_country)
+        return True
+
+    def _refresh(self, country: str, should_stop) -> bool:
+        with self.lock:
+            job = self.jobs[country]
+            kb_id = job["kb_id"]
+        if kb_id is None:
+            kb_id = get_kb_name_of_country(country)
+            if kb_id is None:
+                raise ValueError("no knowledge base to refresh")
+        with self.lock:
+            job["kb_id"] = kb_id
+            refresh = job["refresh"]
+            if refresh["old_docs"] is None:
+                refresh["old_docs"] = dict(map_doc_name_to_id(kb_id))
+            remaining = [key for key in self._headers(job) if key not in refresh["sections"]]
+            page = job.get("page")
+            self._save()
+
+        scrape(country, kb_id, sections=remaining, on_section=lambda key: self._section_refreshed(country, key),
+               should_stop=should_stop, page=page)
+        # the snapshot now points at the new documents, so the ones they replace can go
+        self._delete_replaced(country, kb_id)
+
+        with self.lock:
+            if any(key not in refresh["sections"] for key in self._headers(job)):
+                return False
+            job["refresh"] = None
+            job["finished"] = time.time()
+            self._save()
+        print("LOG - Refreshed the knowledge base of " + country)
+        return True
+
+    def _section_refreshed(self, country: str, section: str) -> None:
+        with self.lock:
+            self.jobs[country]["refresh"]["sections"].append(section)
+            self._save()
+
+    def _delete_replaced(self, country: str, kb_id: str) -> None:
+        with self.lock:
+            refresh = self.jobs[country]["refresh"]
+            replaced = [key for key in refresh["sections"] if key in refresh["old_docs"]]
+        for key in replaced:
+            delete_document(refresh["old_docs"][key])
+            with self.lock:
+                del refresh["old_docs"][key]
+                self._save()
+        if replaced:
+            publish_invalidation(country, kb_id)
+
+    def _section_done(self, country: str, section: str) -> None:
+        with self.lock:
+            self.jobs[country]["sections"].append(section)
+            kb_id = self.jobs[country]["kb_id"]
+            self._save()
+        # answers formed before this section existed may have fallen back to a less useful response
+        publish_invalidation(country, kb_id)
+
+    @staticmethod
+    def _headers(job: dict) -> List[str]:
+        return job.get("headers") or HEADER_LIST
+
+    @staticmethod
+    def _snapshot(job: dict) -> dict:
+        return dict(job, sections=list(job["sections"]))
+
+    def _load(self) -> dict:
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def _save(self) -> None:
+        # write to a temporary file first so a crash never leaves a half-written state file
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.jobs, f)
+        os.replace(tmp_file, self.state_file)
+
+
+kb_job_queue = KnowledgeBaseJobQueue()
+
+
+def main(countries: List[str]) -> None:
+    # e.g. a nightly job: python kb_job_queue.py --refresh (every preloaded country) or --refresh Italy Japan
+    for country in countries or list(CURRENT_COUNTRIES):
+        kb_job_queue.refresh(country)
+    for country in countries or list(CURRENT_COUNTRIES):
+        job = kb_job_queue.wait(country)
+        while job is not None and job.get("refresh"):
+            time.sleep(0.5)
+            job = kb_job_queue.status(country)
+        print(country + ": " + (job["status"] if job else READY))
+    print(json.dumps(kb_job_queue.metrics(), indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rescrape country knowledge bases in the background')
+    parser.add_argument('--refresh', nargs='*', metavar='COUNTRY', required=True,
+                        help='the countries to refresh, every known country when none are given')
+    main(parser.parse_args().refresh)
@@ -0,0 +1,131 @@
+"""
+Scheduling for knowledge base builds and refreshes: a priority queue so builds a user is waiting for run
+before background refreshes (which step aside between sections when such a build is queued), politeness
+limits per scraped host, and a rate limit on Dialogflow document creation.
+
+Settings: SCRAPE_MIN_INTERVAL (seconds between requests to one host, default 1), SCRAPE_MAX_PER_HOST
+(concurrent requests to one host, default 2), DOCUMENT_CREATE_RATE (documents per second, default 2)
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Hashable, Optional, Tuple
+from urllib.parse import urlparse
+
+INTERACTIVE = 0
+BACKGROUND = 10
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+
+class PriorityJobQueue:
+    """A blocking queue that hands out the most urgent job first (first come first served within a priority)"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.order = itertools.count()
+        self.waits = {priority: deque(maxlen=200) for priority in PRIORITY_NAMES}
+        self.started = {priority: 0 for priority in PRIORITY_NAMES}
+
+    def put(self, item: Hashable, priority: int = BACKGROUND) -> None:
+        with self.condition:
+            heapq.heappush(self.heap, (priority, next(self.order), time.monotonic(), item))
+            self.condition.notify()
+
+    def get(self) -> Tuple[Hashable, int]:
+        """Blocks until a job is available, returning it with its priority"""
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.heap) > 0)
+            priority, _, queued, item = heapq.heappop(self.heap)
+            self.waits.setdefault(priority, deque(maxlen=200)).append(time.monotonic() - queued)
+            self.started[priority] = self.started.get(priority, 0) + 1
+            return item, priority
+
+    def has_waiting(self, more_urgent_than: int) -> bool:
+        """Whether a job more urgent than the given priority is queued, so a running job should step aside"""
+        with self.condition:
+            return len(self.heap) > 0 and self.heap[0][0] < more_urgent_than
+
+    def metrics(self) -> dict:
+        with self.condition:
+            now = time.monotonic()
+            metrics = {}
+            for priority, name in PRIORITY_NAMES.items():
+                queued = [entry for entry in self.heap if entry[0] == priority]
+                waits = sorted(self.waits.get(priority, []))
+                metrics[name] = {
+                    "depth": len(queued),
+                    "oldest_wait_s": round(max((now - entry[2] for entry in queued), default=0.0), 3),
+                    "started": self.started.get(priority, 0),
+                    "avg_wait_s": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                    "p95_wait_s": round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else 0.0
+                }
+            return metrics
+
+
+class HostLimiter:
+    """Keeps at most `max_concurrent` requests in flight per host, starting at most one every `min_interval` seconds"""
+
+    def __init__(self, min_interval: float = 1.0, max_concurrent: int = 2):
+        self.min_interval = min_interval
+        self.max_concurrent = max_concurrent
+        self.condition = threading.Condition()
+        self.in_flight = {}
+        self.next_start = {}
+
+    @contextmanager
+    def acquire(self, url: str):
+        host = urlparse(url).netloc
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.in_flight.get(host, 0) < self.max_concurrent and self.next_start.get(host, 0) <= now:
+                    break
+                delay = max(0.0, self.next_start.get(host, 0) - now)
+                self.condition.wait(timeout=delay if delay > 0 else None)
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+            self.next_start[host] = now + self.min_interval
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight[host] -= 1
+                self.condition.notify_all()
+
+
+class RateLimiter:
+    """A token bucket: `rate` operations per second on average, bursts of up to `burst`"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = (1 - self.tokens) / self.rate
+            if deadline is not None and now + delay > deadline:
+                return False
+            with self.lock:
+                self.waited += delay
+            time.sleep(delay)
+
+
+wikivoyage_limiter = HostLimiter(float(os.environ.get('SCRAPE_MIN_INTERVAL', '1')),
+                                 int(os.environ.get('SCRAPE_MAX_PER_HOST', '2')))
+document_rate_limiter = RateLimiter(float(os.environ.get('DOCUMENT_CREATE_RATE', '2')), burst=4)
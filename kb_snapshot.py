@@ -0,0 +1,517 @@
+"""
+A versioned, memory-mappable snapshot of a country's scraped knowledge base (one .takb file per country).
+
+File layout:
+    prefix      magic b'TAKB', u16 format version, u32 header length
+    header      JSON describing the country, its knowledge base and where each block lives
+    data        4-byte aligned blocks, addressed relative to the start of the data:
+                  - the UTF-8 text of every HEADER_LIST section (sentences separated by newlines)
+                  - per section, u32 (start, end) character offsets of every sentence
+
+All arrays are read in place through memoryviews over the mmap, so opening a snapshot only parses the header.
+
+Snapshots are tiered so memory follows the countries being asked about rather than the size of the catalog:
+at most KB_HOT_SNAPSHOTS (default 32) of the most popular ones stay mapped, and the rest live compressed in
+the cold store (see kb_cold_store.py) and are decompressed when asked for. The last KB_RECENT_COLD_SNAPSHOTS
+(default 4) of those stay decoded, so one question does not decompress a country once per document it reads.
+Lookups by document or knowledge base name are answered from a small index that never loads a snapshot.
+
+Usage: python kb_snapshot.py <country> [<country> ...] to export existing knowledge bases,
+       python kb_snapshot.py --compact to move every snapshot into the cold store
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from cache_invalidation import on_invalidation
+from kb_cold_store import ColdStore
+
+MAGIC = b'TAKB'
+FORMAT_VERSION = 2
+# version 1 also stored token offsets and an inverted index; its other blocks are laid out the same, so it is
+# read as is and those blocks are skipped
+READABLE_VERSIONS = (1, 2)
+PREFIX = struct.Struct('<4sHI')
+SNAPSHOT_DIR = os.environ.get('KB_SNAPSHOT_DIR', 'kb_snapshots')
+# how many snapshots stay mapped and decoded, the rest of the catalog only takes disk space
+HOT_SNAPSHOTS = int(os.environ.get('KB_HOT_SNAPSHOTS', '32'))
+# how many cold snapshots that were not promoted stay decoded, so a question about a rare country
+# decompresses it once rather than once per document it reads
+RECENT_COLD_SNAPSHOTS = int(os.environ.get('KB_RECENT_COLD_SNAPSHOTS', '4'))
+# accesses between halvings of the popularity counts
+POPULARITY_WINDOW = 10000
+
+assert array('I').itemsize == 4
+
+
+def _align(offset: int) -> int:
+    return (offset + 3) & ~3
+
+
+def snapshot_path(country: str, snapshot_dir: str = None) -> str:
+    """
+    Returns the file a country's snapshot is stored in
+    Args: str, str
+        country: the country of the snapshot
+        snapshot_dir (optional): the directory holding the snapshots
+    Returns: str
+      the path of the snapshot file
+    """
+    return os.path.join(snapshot_dir or SNAPSHOT_DIR, country.replace(' ', '_') + '.takb')
+
+
+def encode_snapshot(country: str, kb_id: Optional[str], sections: Dict[str, Tuple[str, Optional[str]]],
+                    places: Optional[List[str]] = None) -> bytes:
+    """
+    Serializes a country's sections into the snapshot format
+    Args: str, str, Dict[str, Tuple[str, str]], List[str]
+        country: the country the sections were scraped for
+        kb_id: the knowledge base the sections were uploaded to
+        sections: maps each header to its text (one sentence per line) and its document name
+        places (optional): the Wikivoyage pages of the cities and destinations the country lists
+    Returns: bytes
+      the encoded snapshot
+    """
+    data = bytearray()
+
+    def add_block(block: bytes) -> int:
+        data.extend(b'\0' * (_align(len(data)) - len(data)))
+        offset = len(data)
+        data.extend(block)
+        return offset
+
+    section_entries = []
+    for header, (text, doc_name) in sections.items():
+        sentence_spans = array('I')
+        start = 0
+        for sentence in text.split('\n'):
+            sentence_spans.extend((start, start + len(sentence)))
+            start += len(sentence) + 1
+
+        encoded = text.encode('utf-8')
+        section_entries.append({
+            "header": header,
+            "doc_name": doc_name,
+            "text": [add_block(encoded), len(encoded)],
+            "sentences": [add_block(sentence_spans.tobytes()), len(sentence_spans)]
+        })
+
+    header = {
+        "country": country,
+        "kb_id": kb_id,
+        "created": time.time(),
+        "sections": section_entries,
+        "places": places or []
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    prefix = PREFIX.pack(MAGIC, FORMAT_VERSION, len(header_bytes)) + header_bytes
+    return prefix + b'\0' * (_align(len(prefix)) - len(prefix)) + bytes(data)
+
+
+def write_snapshot(country: str, kb_id: Optional[str], sections: Dict[str, Tuple[str, Optional[str]]],
+                   snapshot_dir: str = None, places: Optional[List[str]] = None) -> str:
+    """
+    Writes (or replaces) a country's snapshot, keeping sections of an existing snapshot that were not rescraped
+    Args: str, str, Dict[str, Tuple[str, str]], str, List[str]
+        country: the country the sections were scraped for
+        kb_id: the knowledge base the sections were uploaded to
+        sections: maps each header to its text (one sentence per line) and its document name
+        snapshot_dir (optional): the directory holding the snapshots
+        places (optional): the pages the country lists, kept from the existing snapshot when not given
+    Returns: str
+      the path of the snapshot file
+    """
+    path = snapshot_path(country, snapshot_dir)
+    existing = load_snapshot(country, snapshot_dir)
+    if existing is not None and existing.kb_id == kb_id:
+        merged = {header: (existing.section_text(header), existing.doc_name(header))
+                  for header in existing.headers if header not in sections}
+        merged.update(sections)
+        sections = merged
+        if places is None:
+            places = existing.places
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_snapshot(country, kb_id, sections, places))
+    forget_snapshot(country, snapshot_dir)
+    os.replace(tmp_path, path)
+    # the new file supersedes a compressed copy, until the next compaction moves it to the cold store
+    cold_store(snapshot_dir).remove(country)
+    _index_on_disk(country, snapshot_dir)
+    return path
+
+
+def read_header(path: str) -> dict:
+    """Reads the JSON header of a snapshot file without mapping the rest of it"""
+    with open(path, 'rb') as f:
+        prefix = f.read(PREFIX.size)
+        magic, version, header_length = PREFIX.unpack(prefix.ljust(PREFIX.size, b'\0'))
+        if magic != MAGIC or version not in READABLE_VERSIONS:
+            raise ValueError(f"{path} is not a knowledge base snapshot this version can read")
+        return json.loads(f.read(header_length))
+
+
+class KnowledgeBaseSnapshot:
+    """A read-only, memory-mapped view of one country's snapshot file, or of a snapshot decompressed in memory"""
+
+    def __init__(self, path: str, data: bytes = None):
+        self.path = path
+        self.file = None
+        if data is not None:
+            self.map = data
+        else:
+            self.file = open(path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = PREFIX.unpack_from(self.map, 0)
+        if magic != MAGIC or version not in READABLE_VERSIONS:
+            self.close()
+            raise ValueError(f"{path} is not a knowledge base snapshot this version can read")
+        self.header = json.loads(self.map[PREFIX.size:PREFIX.size + header_length])
+        self.data_start = _align(PREFIX.size + header_length)
+        self.view = memoryview(self.map)
+        self.sections = {section["header"]: section for section in self.header["sections"]}
+        self.texts = {}
+
+    @property
+    def country(self) -> str:
+        return self.header["country"]
+
+    @property
+    def kb_id(self) -> Optional[str]:
+        return self.header["kb_id"]
+
+    @property
+    def places(self) -> List[str]:
+        """The Wikivoyage pages of the places listed under Cities and Other_destinations"""
+        return self.header.get("places", [])
+
+    @property
+    def headers(self) -> List[str]:
+        return list(self.sections)
+
+    def _bytes(self, block: list) -> memoryview:
+        offset, length = block
+        return self.view[self.data_start + offset:self.data_start + offset + length]
+
+    def _u32(self, block: list) -> memoryview:
+        offset, count = block
+        return self.view[self.data_start + offset:self.data_start + offset + count * 4].cast('I')
+
+    def doc_name(self, header: str) -> Optional[str]:
+        return self.sections[header]["doc_name"]
+
+    def doc_mapping(self) -> dict:
+        """Maps each header to its Dialogflow document name, like map_doc_name_to_id"""
+        return {header: section["doc_name"] for header, section in self.sections.items() if section["doc_name"]}
+
+    def section_text(self, header: str) -> str:
+        text = self.texts.get(header)
+        if text is None:
+            text = str(self._bytes(self.sections[header]["text"]), 'utf-8')
+            self.texts[header] = text
+        return text
+
+    def sentence_spans(self, header: str) -> memoryview:
+        """Flat (start, end) character offsets of every sentence in a section"""
+        return self._u32(self.sections[header]["sentences"])
+
+    def sentences(self, header: str) -> List[str]:
+        text = self.section_text(header)
+        spans = self.sentence_spans(header)
+        return [text[spans[x]:spans[x + 1]] for x in range(0, len(spans), 2)]
+
+    def close(self) -> None:
+        if hasattr(self, 'view'):
+            self.view.release()
+        if self.file is None:
+            return
+        try:
+            self.map.close()
+        except BufferError:
+            # a caller still holds an array from this snapshot, the map is released once it is collected
+            pass
+        self.file.close()
+
+
+_lock = threading.Lock()
+# the hot tier: snapshots that are mapped (or decompressed) and ready to read, by path
+_snapshots = {}
+# cold snapshots that were read but not promoted, least recently used first, by path
+_recent_cold = OrderedDict()
+# every snapshot on disk, hot or cold, by document name -> (country, header) and knowledge base name -> country
+_documents = {}
+_knowledge_bases = {}
+_indexed = {}
+_scanned_dirs = set()
+_cold_stores = {}
+# decayed access counts per country, deciding which snapshots stay hot
+_popularity = {}
+_accesses = 0
+_tier_counts = {"hot_hits": 0, "promotions": 0, "cold_reads": 0, "recent_cold_hits": 0, "demotions": 0}
+
+
+def cold_store(snapshot_dir: str = None) -> ColdStore:
+    """The compressed store of the snapshots in a directory"""
+    directory = os.path.join(snapshot_dir or SNAPSHOT_DIR, 'cold')
+    with _lock:
+        if directory not in _cold_stores:
+            _cold_stores[directory] = ColdStore(directory)
+        return _cold_stores[directory]
+
+
+def load_snapshot(country: str, snapshot_dir: str = None) -> Optional[KnowledgeBaseSnapshot]:
+    """
+    Opens a country's snapshot. Popular countries stay hot (mapped and ready), the others are decompressed
+    from the cold store when asked for and only promoted once they are asked for more than the least
+    popular hot country
+    Args: str, str
+        country: the country to load
+        snapshot_dir (optional): the directory holding the snapshots
+    Returns: KnowledgeBaseSnapshot
+      the snapshot, or None if the country has no (readable) snapshot
+    """
+    path = snapshot_path(country, snapshot_dir)
+    with _lock:
+        popularity = _touch(path)
+        if path in _snapshots:
+            _tier_counts["hot_hits"] += 1
+            return _snapshots[path]
+        snapshot = _recent_cold.get(path)
+        if snapshot is not None:
+            _recent_cold.move_to_end(path)
+            _tier_counts["recent_cold_hits"] += 1
+    decoded = snapshot is None
+
+    if decoded:
+        try:
+            if os.path.exists(path):
+                snapshot = KnowledgeBaseSnapshot(path)
+            else:
+                data = cold_store(snapshot_dir).get(country)
+                if data is None:
+                    return None
+                snapshot = KnowledgeBaseSnapshot(path, data=data)
+        except (ValueError, OSError) as e:
+            print("LOG - Ignoring snapshot: " + str(e))
+            return None
+
+    with _lock:
+        if path in _snapshots:
+            # another thread loaded it meanwhile
+            return _snapshots[path]
+        if len(_snapshots) >= HOT_SNAPSHOTS:
+            coldest = min(_snapshots, key=lambda hot_path: _popularity.get(hot_path, 0))
+            if _popularity.get(coldest, 0) > popularity:
+                # a one-off question about a rare country should not push out a popular one
+                _tier_counts["cold_reads"] += decoded
+                _recent_cold[path] = snapshot
+                _recent_cold.move_to_end(path)
+                while len(_recent_cold) > RECENT_COLD_SNAPSHOTS:
+                    _recent_cold.popitem(last=False)
+                return snapshot
+            # demoted snapshots are not closed, a request still reading one keeps it alive until it is done
+            del _snapshots[coldest]
+            _tier_counts["demotions"] += 1
+        _snapshots[path] = snapshot
+        _recent_cold.pop(path, None)
+        _tier_counts["promotions"] += 1
+        _index(snapshot.country, snapshot.kb_id, snapshot.doc_mapping())
+        return snapshot
+
+
+def _touch(path: str) -> int:
+    global _accesses
+    _popularity[path] = _popularity.get(path, 0) + 1
+    _accesses += 1
+    if _accesses >= POPULARITY_WINDOW:
+        # halving every count lets yesterday's popular countries make way for today's
+        for key in list(_popularity):
+            _popularity[key] //= 2
+            if _popularity[key] == 0:
+                del _popularity[key]
+        _accesses = 0
+    return _popularity.get(path, 0)
+
+
+def _index(country: str, kb_id: Optional[str], docs: dict) -> None:
+    _unindex(country)
+    _indexed[country] = (kb_id, dict(docs))
+    if kb_id:
+        _knowledge_bases[kb_id] = country
+    for header, doc_name in docs.items():
+        _documents[doc_name] = (country, header)
+
+
+def _unindex(country: str) -> None:
+    kb_id, docs = _indexed.pop(country, (None, {}))
+    if kb_id and _knowledge_bases.get(kb_id) == country:
+        del _knowledge_bases[kb_id]
+    for doc_name in docs.values():
+        if _documents.get(doc_name, (None,))[0] == country:
+            del _documents[doc_name]
+
+
+def _index_on_disk(country: str, snapshot_dir: str = None) -> None:
+    # reads only the JSON header (or the cold catalog), nothing is mapped or decompressed
+    path = snapshot_path(country, snapshot_dir)
+    if os.path.exists(path):
+        try:
+            header = read_header(path)
+        except (ValueError, OSError) as e:
+            print("LOG - Ignoring snapshot: " + str(e))
+            return
+        docs = {section["header"]: section["doc_name"] for section in header["sections"] if section["doc_name"]}
+        country, kb_id = header["country"], header["kb_id"]
+    else:
+        entry = cold_store(snapshot_dir).entry(country)
+        if entry is None:
+            return
+        docs, kb_id = entry["docs"], entry["kb_id"]
+    with _lock:
+        _index(country, kb_id, docs)
+
+
+def forget_snapshot(country: str, snapshot_dir: str = None) -> None:
+    """Drops a country's snapshot so the next load sees the file on disk again"""
+    path = snapshot_path(country, snapshot_dir)
+    with _lock:
+        _unindex(country)
+        _recent_cold.pop(path, None)
+        # not closed, like a demoted snapshot: a request still reading it keeps it alive until it is done
+        _snapshots.pop(path, None)
+
+
+def _reload_snapshot(message: dict) -> None:
+    # the worker that scraped the country rewrote its snapshot file, look it up again
+    forget_snapshot(message["country"])
+    _index_on_disk(message["country"])
+
+
+on_invalidation(_reload_snapshot)
+
+
+def _scan(snapshot_dir: str = None) -> None:
+    # index every snapshot on disk once, so lookups by document or knowledge base name can be answered locally
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    with _lock:
+        if snapshot_dir in _scanned_dirs:
+            return
+        _scanned_dirs.add(snapshot_dir)
+    countries = set(cold_store(snapshot_dir).countries())
+    if os.path.isdir(snapshot_dir):
+        countries.update(file_name[:-len('.takb')].replace('_', ' ')
+                         for file_name in os.listdir(snapshot_dir) if file_name.endswith('.takb'))
+    for country in countries:
+        _index_on_disk(country, snapshot_dir)
+
+
+def document_text(doc_name: str) -> Optional[str]:
+    """
+    Serves a knowledge base document's text from a local snapshot
+    Args: str
+        doc_name: the Dialogflow document name
+    Returns: str
+      the document's text, or None if no snapshot contains it
+    """
+    _scan()
+    with _lock:
+        entry = _documents.get(doc_name)
+    if entry is None:
+        return None
+    country, header = entry
+    snapshot = load_snapshot(country)
+    if snapshot is None or header not in snapshot.sections:
+        return None
+    return snapshot.section_text(header)
+
+
+def knowledge_base_doc_mapping(kb_id: str) -> Optional[dict]:
+    """
+    Serves a knowledge base's document mapping from a local snapshot
+    Args: str
+        kb_id: the knowledge base name
+    Returns: dict
+      maps each header to its document name, or None if no snapshot was written for that knowledge base
+    """
+    _scan()
+    with _lock:
+        # the index knows the mapping without loading the snapshot, which keeps cold countries cold
+        country = _knowledge_bases.get(kb_id)
+        return dict(_indexed[country][1]) if country is not None else None
+
+
+def country_kb_id(country: str) -> Optional[str]:
+    """The knowledge base a country's snapshot belongs to, looked up without loading the snapshot"""
+    _scan()
+    with _lock:
+        return _indexed.get(country, (None, {}))[0]
+
+
+def tier_stats() -> dict:
+    with _lock:
+        return dict(_tier_counts, hot=len(_snapshots), recent_cold=len(_recent_cold), indexed=len(_indexed),
+                    hot_limit=HOT_SNAPSHOTS)
+
+
+def compact_snapshots(snapshot_dir: str = None) -> Dict[str, int]:
+    """
+    Moves every snapshot into the cold store, training a new shared dictionary on all of them
+    Args: str
+        snapshot_dir (optional): the directory holding the snapshots
+    Returns: Dict[str, int]
+      the compressed size of each country
+    """
+    _scan(snapshot_dir)
+    with _lock:
+        countries = list(_indexed)
+    snapshots = {}
+    for country in countries:
+        snapshot = load_snapshot(country, snapshot_dir)
+        if snapshot is None:
+            continue
+        snapshots[country] = (bytes(snapshot.map), [snapshot.section_text(header) for header in snapshot.headers],
+                              snapshot.kb_id, snapshot.doc_mapping())
+    sizes = cold_store(snapshot_dir).rebuild(snapshots)
+    for country in snapshots:
+        path = snapshot_path(country, snapshot_dir)
+        if os.path.exists(path):
+            forget_snapshot(country, snapshot_dir)
+            os.remove(path)
+            _index_on_disk(country, snapshot_dir)
+    return sizes
+
+
+def export_snapshot(country: str) -> str:
+    """
+    Writes a snapshot for a knowledge base that was built before snapshots existed
+    Args: str
+        country: the country to export
+    Returns: str
+      the path of the snapshot file
+    """
+    from common_functions import get_kb_name_of_country, _list_kb_documents
+    from IntentParsing import get_kb_texts
+
+    kb_id = get_kb_name_of_country(country)
+    mapping = _list_kb_documents(kb_id)
+    texts = get_kb_texts(mapping)
+    sections = {header: (texts[header], doc_name) for header, doc_name in mapping.items()}
+    return write_snapshot(country, kb_id, sections)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--compact']:
+        for name, size in compact_snapshots().items():
+            print(f"Compressed {name} to {size} bytes")
+    else:
+        for name in sys.argv[1:]:
+            print("Wrote " + export_snapshot(name))
@@ -0,0 +1,127 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List
+
+import nltk
+import locationtagger
+
+# how long a batch waits for more jobs after its first one arrives, 0 runs every job on its own
+NLP_BATCH_WAIT = float(os.environ.get('NLP_BATCH_WAIT_MS', '2')) / 1000
+NLP_MAX_BATCH = int(os.environ.get('NLP_MAX_BATCH', '64'))
+# the longest a request waits for its job, so a stuck batch fails the request instead of hanging it
+NLP_TIMEOUT = float(os.environ.get('NLP_TIMEOUT', '30'))
+
+
+class MicroBatcher:
+    """
+    Gathers jobs that arrive within a few milliseconds of each other from concurrent requests and runs them
+    through one call of a batch function on a worker thread. Identical jobs in a batch are computed once.
+    """
+
+    def __init__(self, name: str, batch_fn: Callable[[List[Hashable]], List[Any]],
+                 max_wait: float = NLP_BATCH_WAIT, max_batch: int = NLP_MAX_BATCH):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.jobs = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counts = {"jobs": 0, "batches": 0, "computed": 0}
+
+    def submit(self, item: Hashable) -> Future:
+        """
+        Queues a job for the next batch
+        Args: Hashable
+            item: the input of the job
+        Returns: Future
+          resolves to the job's result
+        """
+        future = Future()
+        if self.max_wait <= 0:
+            future.set_result(self.batch_fn([item])[0])
+            return future
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+        self.jobs.put((item, future))
+        return future
+
+    def run(self, item: Hashable, timeout: float = NLP_TIMEOUT) -> Any:
+        """Runs one job as part of a batch and waits for its result, raising TimeoutError after `timeout` seconds"""
+        return self.submit(item).result(timeout)
+
+    def run_many(self, items: List[Hashable], timeout: float = NLP_TIMEOUT) -> List[Any]:
+        """Runs several jobs of one request, they all join the same batch and share one `timeout`"""
+        futures = [self.submit(item) for item in items]
+        deadline = time.monotonic() + timeout
+        return [future.result(max(0.0, deadline - time.monotonic())) for future in futures]
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counts)
+        stats["jobs_per_batch"] = stats["jobs"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # anything going wrong with one batch (an unhashable item, a short result list) fails its jobs,
+            # the worker itself has to keep running or every later job would wait forever
+            try:
+                unique = list(dict.fromkeys(item for item, _ in batch))
+                with self.lock:
+                    self.counts["jobs"] += len(batch)
+                    self.counts["batches"] += 1
+                    self.counts["computed"] += len(unique)
+                results = dict(zip(unique, self.batch_fn(unique)))
+                for item, future in batch:
+                    if not future.done():
+                        future.set_result(results[item])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def _tag_batch(token_lists: List[tuple]) -> List[List[tuple]]:
+    # pos_tag loads the tagger model for every call, pos_tag_sents loads it once for the whole batch
+    return nltk.pos_tag_sents([list(tokens) for tokens in token_lists])
+
+
+def _locate_batch(texts: List[str]) -> list:
+    return [locationtagger.find_locations(text=text) for text in texts]
+
+
+pos_tag_batcher = MicroBatcher('pos-tag-batcher', _tag_batch)
+location_batcher = MicroBatcher('location-batcher', _locate_batch)
+
+
+def pos_tag(tokens: List[str]) -> List[tuple]:
+    """
+    Part-of-speech tags a list of tokens, batched with the tagging of concurrent requests
+    Args: List[str]
+        tokens: the tokens to tag
+    Returns: List[tuple]
+      (word, tag) pairs, the same as nltk.pos_tag
+    """
+    return pos_tag_batcher.run(tuple(tokens))
+
+
+def find_locations(text: str):
+    """The locationtagger result for a text, shared with concurrent requests asking about the same text"""
+    return location_batcher.run(text)
@@ -0,0 +1,97 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from common_functions import map_doc_name_to_id
+from IntentParsing import get_kb_texts, tag_text, get_word_hypernyms, kb_intent_response
+from response_cache import response_cache, answer_cache_key, QUERY_INDEPENDENT_INTENTS
+from user_profile import UserProfile
+
+# what new users tend to ask about first, used to fill up the list when a user has little history
+DEFAULT_INTENT_ORDER = ["Eat", "See", "Do", "Cities", "Drink", "Talk", "Buy", "Get_in", "Regions",
+                        "Other_destinations", "Stay_safe", "Stay_healthy", "Connect", "Respect"]
+
+# handlers that part-of-speech tag or run WordNet over the raw article when the knowledge answer is not enough
+TAGGED_INTENTS = {"See", "Do", "Get_in", "Buy"}
+WORDNET_INTENTS = {"Eat", "Drink", "Talk"}
+
+
+def likely_intents(user_profile: UserProfile, top_n: int) -> List[str]:
+    """
+    Predicts which header intents a user will ask about next from how often they asked about each before
+    Args: UserProfile, int
+        user_profile: the current knowledge about the user
+        top_n: how many intents to return
+    Returns: List[str]
+      the most likely intents, most likely first
+    """
+    interests = user_profile.interests
+    ranked = sorted(interests, key=lambda intent: interests[intent], reverse=True)
+    for intent in DEFAULT_INTENT_ORDER:
+        if intent not in ranked:
+            ranked.append(intent)
+    return ranked[:top_n]
+
+
+class Prefetcher:
+    """
+    Warms the caches for a user's most likely questions in the background whenever a country becomes active,
+    so the first question after a country switch is answered from memory.
+    """
+
+    def __init__(self, top_n: int = 4, max_workers: int = 2):
+        self.top_n = top_n
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.in_flight = set()
+
+    def prefetch(self, country: str, kb_id: str, user_profile: UserProfile) -> None:
+        """
+        Starts warming the caches for a country without blocking the caller
+        Args: str, str, UserProfile
+            country: the country that just became active
+            kb_id: the country's knowledge base
+            user_profile: the current knowledge about the user
+        Returns: None
+        """
+        if not kb_id:
+            return
+        intents = likely_intents(user_profile, self.top_n)
+        dislikes = user_profile.dislikes
+        key = (kb_id, tuple(intents), tuple(dislikes))
+        with self.lock:
+            if key in self.in_flight:
+                return
+            self.in_flight.add(key)
+        self.pool.submit(self._warm, key, country, kb_id, intents, dislikes)
+
+    def _warm(self, key: tuple, country: str, kb_id: str, intents: List[str], dislikes: List[str]) -> None:
+        try:
+            mapping = map_doc_name_to_id(kb_id)
+            # every article of the country arrives in one parallel wave, the costly NLP is only done for likely intents
+            articles = get_kb_texts(mapping)
+            for intent in intents:
+                if intent not in articles:
+                    continue
+                article = articles[intent]
+                if intent in TAGGED_INTENTS:
+                    tag_text(article)
+                if intent in WORDNET_INTENTS:
+                    for word in article.split():
+                        get_word_hypernyms(word.lower())
+
+                # these answers do not depend on the question, so the whole answer can be ready in advance
+                if intent in QUERY_INDEPENDENT_INTENTS:
+                    cache_key = answer_cache_key(country, intent, dislikes, '')
+                    if not response_cache.contains(cache_key):
+                        answer = kb_intent_response('', intent, country, dislikes, mapping)
+                        response_cache.set(cache_key, answer)
+        except Exception as e:
+            # a failed prefetch only means the next question takes the normal path
+            print("LOG - Prefetch failed for " + country + ": " + str(e))
+        finally:
+            with self.lock:
+                self.in_flight.discard(key)
+
+
+prefetcher = Prefetcher()
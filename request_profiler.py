@@ -0,0 +1,239 @@
+"""
+Per-request profiling for the webhook and the CLI.
+
+Enable it with the TRAVEL_AGENT_PROFILE environment variable or the webhook's /admin/profiling endpoint,
+using comma separated settings, e.g. "rate=0.05", "intent=See,rate=1" or "country=Italy,mode=sample":
+    rate     fraction of matching requests to profile (default 1 when a filter is given, otherwise 0)
+    intent   only profile requests for this intent
+    country  only profile requests about this country
+    mode     cprofile (default) or sample (a low overhead stack sampler)
+
+Each profiled request writes <dir>/<time>-<intent>.prof (cProfile) or .txt (sampler) and a .json with
+the intent, country and the timing of every stage. The directory is fixed when the process starts
+(TRAVEL_AGENT_PROFILE_DIR, default "profiles"), it cannot be changed through the admin endpoint.
+"""
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+PROFILE_DIR = os.environ.get('TRAVEL_AGENT_PROFILE_DIR', 'profiles')
+# the intent comes from the request, so only these characters of it make it into a file name
+UNSAFE_FILE_CHARACTERS = re.compile(r'[^\w-]')
+
+_local = threading.local()
+
+
+def parse_settings(spec: str) -> dict:
+    """
+    Parses a profiling spec like "intent=See,rate=0.5"
+    Args: str
+        spec: the comma separated settings
+    Returns: dict
+        the profiling settings
+    Raises: ValueError
+        if the rate is not a number between 0 and 1
+    """
+    settings = {"rate": None, "intent": None, "country": None, "mode": "cprofile"}
+    for part in spec.split(','):
+        if '=' not in part:
+            continue
+        key, value = [piece.strip() for piece in part.split('=', 1)]
+        if key in settings:
+            settings[key] = value
+    if settings["rate"] is None:
+        settings["rate"] = 1.0 if settings["intent"] or settings["country"] else 0.0
+    try:
+        rate = float(settings["rate"])
+    except ValueError:
+        raise ValueError(f"the profiling rate must be a number, not {settings['rate']!r}")
+    if not 0 <= rate <= 1:
+        raise ValueError(f"the profiling rate must be between 0 and 1, not {settings['rate']}")
+    settings["rate"] = rate
+    return settings
+
+
+class StackSampler:
+    """Samples the stack of one thread at a fixed interval, far cheaper than cProfile for slow requests"""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.running = False
+        self.thread = None
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self) -> None:
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = tuple(f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+                              for entry in traceback.extract_stack(frame))
+                self.samples[stack] += 1
+            time.sleep(self.interval)
+
+    def report(self) -> str:
+        """Collapsed stacks, one per line with their sample count (flame graph input format)"""
+        return '\n'.join(';'.join(stack) + ' ' + str(count) for stack, count in self.samples.most_common())
+
+
+class RequestProfiler:
+    """Decides which requests to profile and records their profile and stage timings"""
+
+    def __init__(self, spec: Optional[str] = None, directory: str = PROFILE_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # cProfile cannot run on two threads of one process at the same time in every Python version
+        self.cprofile_lock = threading.Lock()
+        try:
+            self.configure(spec if spec is not None else os.environ.get('TRAVEL_AGENT_PROFILE', ''))
+        except ValueError as e:
+            # a bad setting must not keep the webhook from starting, it just runs unprofiled
+            print("LOG - Ignoring the profiling settings: " + str(e))
+            self.configure('')
+
+    def configure(self, spec: str) -> dict:
+        """Replaces the current settings, used by the admin endpoint to switch profiling on and off (raises
+        ValueError for a bad spec, leaving the current settings in place)"""
+        settings = parse_settings(spec)
+        with self.lock:
+            self.settings = settings
+        return dict(settings)
+
+    @staticmethod
+    def _matches(settings: dict, intent: Optional[str], country: Optional[str]) -> bool:
+        # an intent or country that is not known yet (None) may still match once the request reveals it
+        if settings["intent"] and intent is not None and settings["intent"] != intent:
+            return False
+        if settings["country"] and country is not None and settings["country"] != country:
+            return False
+        return True
+
+    def should_profile(self, intent: Optional[str], country: Optional[str]) -> bool:
+        with self.lock:
+            settings = self.settings
+        if settings["rate"] <= 0 or not self._matches(settings, intent, country):
+            return False
+        return random.random() < settings["rate"]
+
+    @contextmanager
+    def request(self, intent: Optional[str] = None, country: Optional[str] = None):
+        """
+        Profiles the enclosed request if it matches the current settings
+        Args: str, str
+            intent (optional): the intent of the request, if it is known up front
+            country (optional): the country the request is about, if it is known up front
+        """
+        if not self.should_profile(intent, country):
+            yield
+            return
+
+        with self.lock:
+            settings = dict(self.settings)
+        _local.request = {"intent": intent, "country": country, "stages": []}
+        profiler = None
+        sampler = None
+        if settings["mode"] == "sample":
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+        elif self.cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self.cprofile_lock.release()
+            if sampler is not None:
+                sampler.stop()
+            info = _local.request
+            _local.request = None
+            # requests whose intent or country only turned out not to match are discarded
+            if self._matches(settings, info["intent"], info["country"]) and \
+                    (not settings["intent"] or info["intent"] is not None) and \
+                    (not settings["country"] or info["country"] is not None):
+                try:
+                    self._write(info, total, profiler, sampler)
+                except OSError as e:
+                    # the request was served, a profile that cannot be saved must not turn it into an error
+                    print("LOG - Could not write the request profile: " + str(e))
+
+    def _write(self, info: dict, total: float, profiler: Optional[cProfile.Profile],
+               sampler: Optional[StackSampler]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        intent = UNSAFE_FILE_CHARACTERS.sub('_', info['intent'] or 'unknown')
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-"
+                                            f"{threading.get_ident()}-{intent}")
+        if profiler is not None:
+            profiler.dump_stats(base + '.prof')
+        if sampler is not None:
+            with open(base + '.txt', 'w') as f:
+                f.write(sampler.report())
+        with open(base + '.json', 'w') as f:
+            json.dump({
+                "intent": info["intent"],
+                "country": info["country"],
+                "total_ms": round(total * 1000, 3),
+                "stages": info["stages"],
+                "profile": base + ('.prof' if profiler is not None else '.txt' if sampler is not None else '')
+            }, f, indent=2)
+
+
+def annotate(intent: Optional[str] = None, country: Optional[str] = None) -> None:
+    """
+    Records the intent or country of the current request once it is known (a no-op outside a profiled request)
+    Args: str, str
+        intent (optional): the detected intent
+        country (optional): the active country
+    Returns: None
+    """
+    info = getattr(_local, 'request', None)
+    if info is None:
+        return
+    if intent is not None:
+        info["intent"] = intent
+    if country is not None:
+        info["country"] = country
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a stage of the current request (a no-op outside a profiled request)
+    Args: str
+        name: the name of the stage, e.g. "kb_search"
+    """
+    info = getattr(_local, 'request', None)
+    if info is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        info["stages"].append({"stage": name, "ms": round((time.perf_counter() - start) * 1000, 3)})
+
+
+request_profiler = RequestProfiler()
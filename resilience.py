@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Optional, Tuple, Type
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# shared by every policy for duplicate (hedged) attempts
+hedge_pool = ThreadPoolExecutor(max_workers=32)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a backend after `failure_threshold` consecutive failures.
+    After `reset_timeout` seconds a single trial call is let through; its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+
+class RetryBudget:
+    """
+    Caps retries and hedges to a fraction of normal traffic so a struggling backend is not hit with a retry storm.
+    Every call earns `ratio` tokens, every retry or hedge spends one.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 10.0, max_tokens: float = 100.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+        self.tokens = min_tokens
+
+    def record_call(self) -> None:
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class CallPolicy:
+    """
+    Per-backend settings and state for resilient_call: deadline, retries with jittered backoff,
+    hedged duplicate attempts once a call is slower than the recent tail latency, and a circuit breaker.
+    Every error in `retry_on` (and any timeout) counts against the breaker and ends in the fallback; a call that is
+    not safe to repeat can limit its retries to the errors in `safe_to_retry`, where the backend surely did not
+    carry the request out.
+    """
+
+    def __init__(self, name: str, deadline: float = 5.0, max_attempts: int = 3, base_backoff: float = 0.1,
+                 hedge: bool = True, hedge_quantile: float = 0.95, min_hedge_delay: float = 0.05,
+                 retry_on: Tuple[Type[BaseException], ...] = (TimeoutError, ConnectionError),
+                 safe_to_retry: Optional[Tuple[Type[BaseException], ...]] = None,
+                 breaker: Optional[CircuitBreaker] = None, budget: Optional[RetryBudget] = None):
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.retry_on = retry_on + (TimeoutError, FutureTimeoutError)
+        self.safe_to_retry = self.retry_on if safe_to_retry is None else safe_to_retry
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget or RetryBudget()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=200)
+        self.counts = {"calls": 0, "failures": 0, "retries": 0, "hedges": 0, "fallbacks": 0, "rejected": 0}
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] += 1
+
+    def record_latency(self, seconds: float) -> None:
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def hedge_delay(self) -> float:
+        """How long to wait for the first attempt before sending a duplicate"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < 20:
+            # not enough history to know what slow means yet
+            return max(self.min_hedge_delay, self.deadline / 4)
+        return max(self.min_hedge_delay, latencies[int(self.hedge_quantile * (len(latencies) - 1))])
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counts)
+        stats["breaker"] = self.breaker.state
+        stats["hedge_delay_ms"] = round(self.hedge_delay() * 1000, 1)
+        return stats
+
+
+def _attempt(policy: CallPolicy, fn: Callable, args: tuple, kwargs: dict, remaining: float):
+    """Runs one attempt, adding a hedged duplicate if it is slower than the policy's tail latency"""
+    kwargs = dict(kwargs, timeout=remaining)
+    start = time.monotonic()
+    if not policy.hedge:
+        result = fn(*args, **kwargs)
+        policy.record_latency(time.monotonic() - start)
+        return result
+
+    futures = [hedge_pool.submit(fn, *args, **kwargs)]
+    done, _ = wait(futures, timeout=min(policy.hedge_delay(), remaining))
+    if len(done) == 0 and policy.budget.try_spend():
+        policy.count("hedges")
+        kwargs["timeout"] = max(0.0, remaining - (time.monotonic() - start))
+        futures.append(hedge_pool.submit(fn, *args, **kwargs))
+
+    error = None
+    for future in as_completed(futures, timeout=max(0.0, remaining - (time.monotonic() - start))):
+        try:
+            result = future.result()
+        except Exception as e:
+            error = e
+            continue
+        policy.record_latency(time.monotonic() - start)
+        return result
+    raise error
+
+
+def resilient_call(policy: CallPolicy, fn: Callable, *args, fallback: Optional[Callable] = None, **kwargs):
+    """
+    Calls fn(*args, timeout=<seconds left>, **kwargs) under the policy's deadline, retries, hedging and breaker
+    Args: CallPolicy, Callable
+        policy: the backend's policy
+        fn: the call to make, it must accept a `timeout` keyword argument
+        fallback (optional): called instead when the backend is unavailable (it may raise to give up)
+    Returns: Any
+        the result of fn, or of the fallback
+    """
+    policy.count("calls")
+    policy.budget.record_call()
+    if not policy.breaker.allow():
+        policy.count("rejected")
+        if fallback is not None:
+            policy.count("fallbacks")
+            return fallback()
+        raise CircuitOpenError(f"{policy.name} is unavailable")
+
+    deadline = time.monotonic() + policy.deadline
+    attempt = 1
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            result = _attempt(policy, fn, args, kwargs, remaining)
+        except policy.retry_on as e:
+            remaining = deadline - time.monotonic()
+            if (attempt >= policy.max_attempts or remaining <= 0 or not isinstance(e, policy.safe_to_retry)
+                    or not policy.budget.try_spend()):
+                policy.count("failures")
+                policy.breaker.record_failure()
+                if fallback is not None:
+                    policy.count("fallbacks")
+                    return fallback()
+                raise
+            policy.count("retries")
+            # full jitter keeps retries from many workers from arriving in lockstep
+            time.sleep(min(remaining, random.uniform(0, policy.base_backoff * 2 ** attempt)))
+            attempt += 1
+            continue
+        except Exception:
+            # the backend answered (e.g. "not found"), so it is healthy even though the call failed
+            policy.breaker.record_success()
+            raise
+        policy.breaker.record_success()
+        return result
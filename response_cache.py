@@ -0,0 +1,137 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, Optional
+
+from common_functions import normalize_query
+from cache_manager import cache_manager, estimate_size
+from cache_checkpoint import register_checkpoint, country_version
+from cache_invalidation import on_invalidation
+
+# intents whose answer is built from the raw article alone, so the wording of the question never matters
+QUERY_INDEPENDENT_INTENTS = {"Get_in", "Talk"}
+
+
+def dislikes_fingerprint(dislikes: List[str]) -> str:
+    """
+    Summarises a user's dislikes so users with the same dislikes share cached answers
+    Args: List[str]
+        dislikes: the words the user does not want recommended
+    Returns: str
+      a short digest that does not depend on the order the dislikes were added in
+    """
+    return hashlib.sha1('\n'.join(sorted(set(dislikes))).encode('utf-8')).hexdigest()[:16]
+
+
+def answer_cache_key(country: str, intent_name: str, dislikes: List[str], user_input: str) -> tuple:
+    """
+    Builds the cache key for a formatted knowledge base answer
+    Args: str, str, List[str], str
+        country: the country being asked about
+        intent_name: the header intent that was detected
+        dislikes: the words the user does not want recommended
+        user_input: the string that the user typed to the agent
+    Returns: tuple
+      the key, which only includes the question when the intent's answer depends on it
+    """
+    if intent_name in QUERY_INDEPENDENT_INTENTS:
+        return country, intent_name, dislikes_fingerprint(dislikes)
+    return country, intent_name, dislikes_fingerprint(dislikes), normalize_query(user_input)
+
+
+class ResponseCache:
+    """
+    A size-bounded LRU cache of formatted answers, with hit-rate metrics and per-country invalidation.
+    Its entries count towards the shared memory budget of the cache manager.
+    """
+
+    def __init__(self, max_size: int = 2048, name: str = 'responses'):
+        self.max_size = max_size
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        cache_manager.register(self)
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self.lock:
+            answer = self.entries.get(key)
+            if answer is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        cache_manager.record_access(self.name, key, answer is not None)
+        return answer
+
+    def contains(self, key: Hashable) -> bool:
+        # used by background warmers, so it does not count towards the hit rate
+        with self.lock:
+            return key in self.entries
+
+    def set(self, key: Hashable, answer: str) -> None:
+        if not cache_manager.admit(self.name, key, estimate_size(key) + estimate_size(answer)):
+            # the answer this one replaces is out of date, it must not keep being served
+            with self.lock:
+                self.entries.pop(key, None)
+            cache_manager.forget(self.name, [key])
+            return
+        evicted = []
+        with self.lock:
+            self.entries[key] = answer
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                evicted.append(self.entries.popitem(last=False)[0])
+                self.evictions += 1
+        if evicted:
+            cache_manager.forget(self.name, evicted)
+
+    def export_entries(self) -> list:
+        """(key, answer, None) for every answer, least recently used first"""
+        with self.lock:
+            return [(key, answer, None) for key, answer in self.entries.items()]
+
+    def import_entry(self, key: Hashable, answer: str, expires_at: Optional[float] = None) -> None:
+        self.set(key, answer)
+
+    def discard(self, key: Hashable) -> None:
+        """Drops an answer the cache manager evicted"""
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.evictions += 1
+
+    def invalidate_country(self, country: str) -> None:
+        """
+        Drops every answer for a country, called whenever its knowledge base is rebuilt or refreshed
+        Args: str
+            country: the country whose answers are stale
+        Returns: None
+        """
+        with self.lock:
+            stale = [key for key in self.entries if key[0] == country]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+        cache_manager.forget(self.name, stale)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0
+            }
+
+
+response_cache = ResponseCache()
+# answers are keyed by country, so they are only restored while the country's knowledge base is unchanged
+register_checkpoint(response_cache, version_of=lambda key: country_version(key[0]))
+on_invalidation(lambda message: response_cache.invalidate_country(message["country"]))
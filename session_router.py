@@ -0,0 +1,220 @@
+"""
+Routes Dialogflow webhook calls to several webhook nodes, keeping every session on one node so its
+conversation state and the caches for its country stay hot there.
+
+Sessions are placed with consistent hashing, so adding or removing a node only moves the sessions whose
+position on the ring changes hands. Those sessions are exported from their old node and imported into their
+new one before any more calls are forwarded; if the old node is gone, the new node starts them afresh.
+
+Usage: python session_router.py --spawn 3                (starts 3 local webhook nodes on the fake backend)
+       python session_router.py --nodes http://a:5002,http://b:5002
+Nodes can be added or removed at runtime: POST /admin/nodes {"node": url} and DELETE /admin/nodes {"node": url}
+Settings: ADMIN_TOKEN (see admin_auth.py), the same on the router and every node when they are not all local
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+from flask import Flask, request
+
+from admin_auth import admin_headers, admin_only
+
+
+class HashRing:
+    """A consistent hash ring, each node is placed at `replicas` points to spread sessions evenly"""
+
+    def __init__(self, nodes: List[str] = (), replicas: int = 100):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(set(self.owners.values()))
+
+    def add(self, node: str) -> None:
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+                self.owners[point] = node
+
+    def remove(self, node: str) -> None:
+        self.points = [point for point in self.points if self.owners[point] != node]
+        self.owners = {point: owner for point, owner in self.owners.items() if owner != node}
+
+    def copy(self) -> 'HashRing':
+        ring = HashRing(replicas=self.replicas)
+        ring.points = list(self.points)
+        ring.owners = dict(self.owners)
+        return ring
+
+    def node_for(self, key: str) -> Optional[str]:
+        """
+        Finds the node responsible for a key
+        Args: str
+            key: the Dialogflow session name
+        Returns: str
+            the node's base url (None when the ring is empty)
+        """
+        if len(self.points) == 0:
+            return None
+        index = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+def call_node(node: str, path: str, payload: Optional[dict] = None, timeout: float = 30.0) -> dict:
+    """Sends a JSON request to a webhook node (GET without a payload, POST with one)"""
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    headers = {"Content-Type": "application/json"}
+    if path.startswith('/admin/'):
+        headers.update(admin_headers())
+    req = urllib.request.Request(node + path, data=data, headers=headers)
+    with urllib.request.urlopen(req, timeout=timeout) as reply:
+        return json.loads(reply.read())
+
+
+class SessionRouter:
+    """Forwards webhook calls to the node owning their session and migrates sessions when nodes change"""
+
+    def __init__(self, nodes: List[str], replicas: int = 100):
+        self.ring = HashRing(nodes, replicas)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.rebalancing = False
+
+    def forward(self, payload: dict) -> dict:
+        session = payload.get("session", "default")
+        with self.condition:
+            # calls wait while sessions are being moved, so no call reaches a node that lacks its session
+            self.condition.wait_for(lambda: not self.rebalancing)
+            node = self.ring.node_for(session)
+            self.in_flight += 1
+        try:
+            if node is None:
+                return {"fulfillmentText": "Sorry, I'm not available right now. Please try again in a moment."}
+            return call_node(node, '/webhook', payload)
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def add_node(self, node: str) -> dict:
+        return self._rebalance(lambda ring: ring.add(node))
+
+    def remove_node(self, node: str) -> dict:
+        return self._rebalance(lambda ring: ring.remove(node))
+
+    def _rebalance(self, change) -> dict:
+        with self.condition:
+            self.condition.wait_for(lambda: not self.rebalancing)
+            self.rebalancing = True
+            self.condition.wait_for(lambda: self.in_flight == 0)
+            old_ring = self.ring.copy()
+            change(self.ring)
+        try:
+            return self._migrate(old_ring, self.ring)
+        finally:
+            with self.condition:
+                self.rebalancing = False
+                self.condition.notify_all()
+
+    @staticmethod
+    def _migrate(old_ring: HashRing, new_ring: HashRing) -> dict:
+        moved = 0
+        lost = 0
+        for old_node in old_ring.nodes:
+            try:
+                sessions = call_node(old_node, '/admin/sessions')["sessions"]
+            except (urllib.error.URLError, OSError) as e:
+                # the node is gone, its sessions start afresh on their new nodes
+                print("LOG - Could not reach " + old_node + " to migrate its sessions: " + str(e))
+                continue
+
+            moves: Dict[str, List[str]] = {}
+            for session in sessions:
+                new_node = new_ring.node_for(session)
+                if new_node != old_node:
+                    moves.setdefault(new_node, []).append(session)
+            for new_node, moving in moves.items():
+                exported = call_node(old_node, '/admin/sessions/export', {"sessions": moving})["sessions"]
+                if new_node is None:
+                    lost += len(exported)
+                    continue
+                try:
+                    call_node(new_node, '/admin/sessions/import', {"sessions": exported})
+                    moved += len(exported)
+                except (urllib.error.URLError, OSError) as e:
+                    print("LOG - Could not hand sessions over to " + new_node + ": " + str(e))
+                    lost += len(exported)
+        print(f"LOG - Rebalanced onto {new_ring.nodes}: {moved} sessions moved, {lost} lost")
+        return {"nodes": new_ring.nodes, "moved": moved, "lost": lost}
+
+
+def create_app(router: SessionRouter) -> Flask:
+    app = Flask(__name__)
+
+    @app.route('/webhook', methods=["POST"])
+    def webhook():
+        return router.forward(request.json)
+
+    @app.route('/admin/nodes', methods=["GET", "POST", "DELETE"])
+    @admin_only
+    def nodes():
+        if request.method == "POST":
+            return router.add_node(request.json["node"])
+        if request.method == "DELETE":
+            return router.remove_node(request.json["node"])
+        return {"nodes": router.ring.nodes}
+
+    return app
+
+
+def spawn_nodes(count: int, first_port: int) -> List[subprocess.Popen]:
+    """Starts local webhook nodes on the fake Dialogflow backend"""
+    processes = [subprocess.Popen([sys.executable, 'webhook.py', '--port', str(first_port + x), '--fake-backend'])
+                 for x in range(count)]
+    for x in range(count):
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                call_node(f"http://127.0.0.1:{first_port + x}", '/admin/sessions', timeout=1)
+                break
+            except (urllib.error.URLError, OSError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+    return processes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', default='', help='comma separated base urls of running webhook nodes')
+    parser.add_argument('--spawn', type=int, default=0, help='start this many local webhook nodes')
+    parser.add_argument('--first-node-port', type=int, default=5101)
+    parser.add_argument('--replicas', type=int, default=100, help='points per node on the hash ring')
+    parser.add_argument('--port', type=int, default=5002)
+    args = parser.parse_args()
+
+    nodes = [node for node in args.nodes.split(',') if node]
+    processes = spawn_nodes(args.spawn, args.first_node_port) if args.spawn else []
+    nodes += [f"http://127.0.0.1:{args.first_node_port + x}" for x in range(args.spawn)]
+    try:
+        create_app(SessionRouter(nodes, args.replicas)).run(port=args.port, threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,116 @@
+"""
+The conversation state of the Dialogflow sessions a webhook worker is serving.
+
+Sessions are kept least recently used first. A session that has been idle for SESSION_IDLE_TTL seconds
+(default 1800) is dropped the next time the store is used, and past SESSION_MAX sessions (default 10000) the
+least recently used one goes. Every session also counts towards the cache manager's memory budget, so a burst
+of conversations pushes cached answers out instead of growing the worker without bound. Cached answers never
+push a session out, only another session or the idle timeout does.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional
+
+from cache_manager import cache_manager
+
+SESSION_IDLE_TTL = float(os.environ.get('SESSION_IDLE_TTL', '1800'))
+SESSION_MAX = int(os.environ.get('SESSION_MAX', '10000'))
+
+
+class SessionStore:
+    """Session name -> state, evicted when idle, past its size limit or when the cache manager needs the room"""
+
+    def __init__(self, new_state: Callable[[str], dict], size_of: Callable[[dict], int],
+                 idle_ttl: float = SESSION_IDLE_TTL, max_size: int = SESSION_MAX, name: str = 'sessions'):
+        self.new_state = new_state
+        self.size_of = size_of
+        self.idle_ttl = idle_ttl
+        self.max_size = max_size
+        self.name = name
+        self.lock = threading.Lock()
+        # session -> (state, monotonic time of its last call)
+        self.entries = OrderedDict()
+        self.expired = 0
+        self.evictions = 0
+        cache_manager.register(self)
+
+    def _expire(self, now: float) -> List[str]:
+        # the least recently used sessions come first, so the scan stops at the first one still active
+        dropped = []
+        while self.entries:
+            session, (_, last_used) = next(iter(self.entries.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self.entries[session]
+            dropped.append(session)
+            self.expired += 1
+        return dropped
+
+    def _store(self, session: str, state: dict, now: float) -> List[str]:
+        dropped = self._expire(now)
+        self.entries[session] = (state, now)
+        self.entries.move_to_end(session)
+        while len(self.entries) > self.max_size:
+            dropped.append(self.entries.popitem(last=False)[0])
+            self.evictions += 1
+        return dropped
+
+    def get(self, session: str) -> dict:
+        """
+        Looks up the state of a session, creating it on the session's first call
+        Args: str
+            session: the name of the Dialogflow session
+        Returns: dict
+            the session state
+        """
+        with self.lock:
+            entry = self.entries.get(session)
+            state = entry[0] if entry is not None else self.new_state(session)
+            dropped = self._store(session, state, time.monotonic())
+        cache_manager.forget(self.name, dropped)
+        cache_manager.record_access(self.name, session, True)
+        # sized again on every call, since a conversation's profile and document mapping grow as it goes on;
+        # a session is always admitted, its state cannot be fetched again like a cached answer can
+        cache_manager.admit(self.name, session, self.size_of(state), force=True)
+        return state
+
+    def peek(self, session: str) -> Optional[dict]:
+        """The state of a session, without creating it or counting as a call"""
+        with self.lock:
+            entry = self.entries.get(session)
+            return entry[0] if entry is not None else None
+
+    def put(self, session: str, state: dict) -> None:
+        """Adds a session taken over from another node"""
+        with self.lock:
+            dropped = self._store(session, state, time.monotonic())
+        cache_manager.forget(self.name, dropped)
+        cache_manager.record_access(self.name, session, True)
+        cache_manager.admit(self.name, session, self.size_of(state), force=True)
+
+    def pop(self, session: str) -> Optional[dict]:
+        """Removes a session handed over to another node"""
+        with self.lock:
+            entry = self.entries.pop(session, None)
+        cache_manager.forget(self.name, [session])
+        return entry[0] if entry is not None else None
+
+    def names(self) -> List[str]:
+        with self.lock:
+            dropped = self._expire(time.monotonic())
+            names = list(self.entries)
+        cache_manager.forget(self.name, dropped)
+        return names
+
+    def discard(self, key: Hashable) -> None:
+        """Drops a session the cache manager evicted"""
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "idle_ttl": self.idle_ttl,
+                    "expired": self.expired, "evictions": self.evictions}
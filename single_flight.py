@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from cache_manager import cache_manager, estimate_size
+
+_MISSING = object()
+
+
+class _Call:
+    """An upstream call that is in flight, shared by every caller asking for the same key"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Ensures only one upstream call per key is in flight at a time.
+    Callers that arrive while a call is running wait for it and share its result (or its exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Runs fn(*args, **kwargs) unless a call for the same key is already running
+        Args: Hashable, Callable
+            key: identifies identical calls
+            fn: the upstream call to make
+        Returns: Any
+            the result of the (possibly shared) call
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class TTLCache:
+    """
+    A small thread-safe cache whose entries expire after a fixed number of seconds (never if ttl is None).
+    Its entries count towards the shared memory budget of the cache manager, which may refuse or evict them.
+    """
+
+    def __init__(self, ttl: Optional[float], max_size: int = 1024, name: Optional[str] = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.name = name or f"cache-{id(self)}"
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        cache_manager.register(self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key, _MISSING)
+            hit = entry is not _MISSING and (entry[0] is None or entry[0] >= time.monotonic())
+            if hit:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            else:
+                # expired entries are kept until evicted, so they can still serve as a fallback
+                self.misses += 1
+        cache_manager.record_access(self.name, key, hit)
+        return entry[1] if hit else default
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Any:
+        """Returns an entry even if it has expired, for when the upstream cannot be reached"""
+        with self.lock:
+            entry = self.entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._store(key, value, None if self.ttl is None else time.monotonic() + self.ttl)
+
+    def export_entries(self) -> list:
+        """(key, value, expiry as a wall clock time) for every entry, least recently used first"""
+        with self.lock:
+            entries = list(self.entries.items())
+        offset = time.time() - time.monotonic()
+        return [(key, value, None if expires is None else expires + offset) for key, (expires, value) in entries]
+
+    def import_entry(self, key: Hashable, value: Any, expires_at: Optional[float]) -> None:
+        """Stores an entry from export_entries, possibly made by another process"""
+        self._store(key, value, None if expires_at is None else expires_at - time.time() + time.monotonic())
+
+    def _store(self, key: Hashable, value: Any, expires: Optional[float]) -> None:
+        if not cache_manager.admit(self.name, key, estimate_size(key) + estimate_size(value)):
+            # the value this one replaces is out of date, it must not keep being served
+            self.pop(key)
+            return
+        evicted = []
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                evicted.append(self.entries.popitem(last=False)[0])
+        if evicted:
+            cache_manager.forget(self.name, evicted)
+
+    def discard(self, key: Hashable) -> None:
+        """Drops an entry the cache manager evicted"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def pop(self, key: Hashable) -> None:
+        self.discard(key)
+        cache_manager.forget(self.name, [key])
+
+    def pop_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Drops every entry whose key matches, returning how many were dropped"""
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                del self.entries[key]
+        cache_manager.forget(self.name, keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            keys = list(self.entries)
+            self.entries.clear()
+        cache_manager.forget(self.name, keys)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+
+def cached_single_flight(cache: TTLCache, flight: SingleFlight, key: Hashable, fn: Callable, *args,
+                         should_cache: Optional[Callable[[Any], bool]] = None, **kwargs) -> Any:
+    """
+    Serves a call from the cache, otherwise makes it through the single-flight layer and caches the result
+    Args: TTLCache, SingleFlight, Hashable, Callable
+        cache: where recent results are kept
+        flight: coalesces identical calls that miss the cache at the same time
+        key: identifies identical calls
+        fn: the upstream call to make
+        should_cache (optional): decides whether a result is complete enough to keep
+    Returns: Any
+        the cached or freshly fetched result
+    """
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+
+    def fetch():
+        # another caller may have filled the cache while this one was waiting to lead
+        cached = cache.get(key, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        result = fn(*args, **kwargs)
+        if should_cache is None or should_cache(result):
+            cache.set(key, result)
+        return result
+
+    return flight.do(key, fetch)
@@ -0,0 +1,51 @@
+import os
+
+from flask import Flask
+
+import admin_auth
+from admin_auth import admin_only, is_admin_request
+from request_profiler import RequestProfiler, annotate
+
+
+def app():
+    app = Flask(__name__)
+
+    @app.route('/admin/stats')
+    @admin_only
+    def stats():
+        return {"ok": True}
+
+    return app.test_client()
+
+
+def test_without_a_token_only_local_calls_are_allowed():
+    assert is_admin_request(None, '127.0.0.1', admin_token='')
+    assert is_admin_request(None, '::1', admin_token='')
+    assert not is_admin_request(None, '203.0.113.7', admin_token='')
+
+
+def test_with_a_token_every_call_needs_it():
+    assert is_admin_request('secret', '203.0.113.7', admin_token='secret')
+    assert not is_admin_request(None, '127.0.0.1', admin_token='secret')
+    assert not is_admin_request('guess', '127.0.0.1', admin_token='secret')
+
+
+def test_admin_views_reject_calls_without_the_token(monkeypatch):
+    monkeypatch.setattr(admin_auth, 'ADMIN_TOKEN', 'secret')
+    client = app()
+    assert client.get('/admin/stats').status_code == 403
+    assert client.get('/admin/stats', headers={'X-Admin-Token': 'secret'}).json == {"ok": True}
+
+    monkeypatch.setattr(admin_auth, 'ADMIN_TOKEN', None)
+    assert client.get('/admin/stats', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 403
+    assert client.get('/admin/stats', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
+
+
+def test_profiles_stay_in_the_configured_directory(tmp_path):
+    profiler = RequestProfiler("rate=1,mode=sample,dir=/tmp/elsewhere", directory=str(tmp_path))
+    assert "dir" not in profiler.settings
+    with profiler.request():
+        annotate(intent="../../escape")
+    written = os.listdir(tmp_path)
+    assert written and all(name.endswith('-______escape.json') or name.endswith('-______escape.txt')
+                           for name in written)
@@ -0,0 +1,36 @@
+import pytest
+
+import response_cache
+import single_flight
+from cache_manager import CacheManager
+from response_cache import ResponseCache
+from single_flight import TTLCache
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # entries over an eighth of the budget are never admitted
+    manager = CacheManager(budget=8000)
+    monkeypatch.setattr(single_flight, 'cache_manager', manager)
+    monkeypatch.setattr(response_cache, 'cache_manager', manager)
+    return manager
+
+
+def test_rejected_value_drops_the_value_it_replaces(manager):
+    cache = TTLCache(ttl=60, name='admission-test')
+    cache.set("Italy", "old answer")
+    cache.set("Italy", "new answer " * 200)
+    assert cache.get("Italy") is None
+    assert cache.get_stale("Italy") is None
+    assert manager.stats()["entries"] == 0
+
+
+def test_rejected_answer_drops_the_answer_it_replaces(manager):
+    cache = ResponseCache(name='admission-test-responses')
+    cache.set(("Italy", "Eat"), "old answer")
+    cache.set(("Italy", "Eat"), "new answer " * 200)
+    assert cache.get(("Italy", "Eat")) is None
+    assert manager.stats()["entries"] == 0
+
+    cache.set(("Italy", "Eat"), "short answer")
+    assert cache.get(("Italy", "Eat")) == "short answer"
@@ -0,0 +1,85 @@
+import pickle
+
+import pytest
+
+import cache_checkpoint
+import single_flight
+from cache_checkpoint import register_checkpoint, restore_checkpoint, save_checkpoint
+from cache_manager import CacheManager
+from single_flight import TTLCache
+
+
+@pytest.fixture
+def caches(monkeypatch):
+    monkeypatch.setattr(single_flight, 'cache_manager', CacheManager())
+    monkeypatch.setattr(cache_checkpoint, '_checkpointed', {})
+    versions = {"Italy": "v1", "Japan": None}
+    versioned = TTLCache(ttl=None, name='checkpoint-versioned')
+    plain = TTLCache(ttl=None, name='checkpoint-plain')
+    register_checkpoint(versioned, version_of=lambda key: versions.get(key))
+    register_checkpoint(plain)
+    return versions, versioned, plain
+
+
+def test_only_entries_known_to_be_current_are_restored(caches, tmp_path):
+    versions, versioned, plain = caches
+    for country in ("Italy", "Japan", "Peru"):
+        versioned.set(country, f"answer about {country}")
+    plain.set("Peru", "a cache without versions")
+    path = str(tmp_path / 'checkpoint.pkl')
+    save_checkpoint(path)
+
+    # Japan's version was unknown when saved, Peru's is unknown now; Italy was rebuilt
+    versions.update({"Japan": "v1", "Italy": "v2"})
+    versioned.clear()
+    plain.clear()
+    assert restore_checkpoint(path) == 1
+    assert [versioned.get(country) for country in ("Italy", "Japan", "Peru")] == [None, None, None]
+    assert plain.get("Peru") == "a cache without versions"
+
+
+def test_unchanged_knowledge_base_keeps_its_entries(caches, tmp_path):
+    _, versioned, _ = caches
+    versioned.set("Italy", "answer about Italy")
+    path = str(tmp_path / 'checkpoint.pkl')
+    save_checkpoint(path)
+    versioned.clear()
+    assert restore_checkpoint(path) == 1
+    assert versioned.get("Italy") == "answer about Italy"
+
+
+def test_a_checkpoint_that_was_not_signed_with_the_key_is_never_unpickled(caches, tmp_path):
+    _, versioned, plain = caches
+    plain.set("Peru", "answer about Peru")
+    path = str(tmp_path / 'checkpoint.pkl')
+    save_checkpoint(path)
+    with open(path, 'rb') as f:
+        signed = f.read()
+    # another local user swaps in a payload of their own
+    with open(path, 'wb') as f:
+        f.write(signed[:cache_checkpoint.SIGNATURE_SIZE] + pickle.dumps(Planted()))
+    plain.clear()
+    assert restore_checkpoint(path) == 0
+    assert not Planted.unpickled
+
+
+def test_knowledge_bases_without_a_snapshot_are_versioned_by_their_documents(monkeypatch):
+    monkeypatch.setattr(cache_checkpoint, 'knowledge_base_doc_mapping', lambda kb_id: None)
+    monkeypatch.setattr(cache_checkpoint, 'country_kb_id', lambda country: None)
+    documents = {"kb/italy": {"See": "kb/italy/documents/1"}}
+    monkeypatch.setattr(cache_checkpoint, '_live_doc_mapping', lambda kb_id: documents[kb_id])
+    monkeypatch.setattr(cache_checkpoint, '_live_kb_id', lambda country: "kb/" + country.lower())
+
+    version = cache_checkpoint.country_version("Italy")
+    assert version is not None and version == cache_checkpoint.kb_version("kb/italy")
+    documents["kb/italy"] = {"See": "kb/italy/documents/2"}
+    assert cache_checkpoint.kb_version("kb/italy") != version
+    # a knowledge base that cannot be listed has no version
+    assert cache_checkpoint.country_version("Peru") is None
+
+
+class Planted:
+    unpickled = False
+
+    def __reduce__(self):
+        return setattr, (Planted, 'unpickled', True)
@@ -0,0 +1,43 @@
+import pytest
+
+import city_kb
+from city_kb import city_knowledge_base
+from kb_job_queue import BUILDING, READY
+
+ROME_KB = "projects/test/knowledgeBases/rome"
+
+
+@pytest.fixture
+def rome(monkeypatch):
+    builds = []
+    job = {"kb_id": ROME_KB, "status": BUILDING, "sections": ["Get_in", "See"]}
+    monkeypatch.setattr(city_kb, '_places', {"Italy": [("Rome", "Rome")]})
+    monkeypatch.setattr(city_kb, 'country_kb_id', lambda key: ROME_KB if key == "Rome, Italy" else None)
+    # a paused background build only got as far as Get_in and See
+    monkeypatch.setattr(city_kb, 'knowledge_base_doc_mapping',
+                        lambda kb_id: {header: kb_id + '/documents/' + header for header in job["sections"]})
+    monkeypatch.setattr(city_kb, 'map_doc_name_to_id', city_kb.knowledge_base_doc_mapping)
+    monkeypatch.setattr(city_kb, 'build_city', lambda city, page, country: builds.append(city) or dict(job))
+    return job, builds
+
+
+def test_section_in_a_partial_snapshot_is_answered_from_the_city(rome):
+    _, builds = rome
+    key, kb_id, mapping = city_knowledge_base("Italy", "what should I see in Rome?", "See")
+    assert (key, kb_id) == ("Rome, Italy", ROME_KB) and "See" in mapping
+    assert builds == []
+
+
+def test_section_missing_from_a_partial_snapshot_resumes_the_build(rome):
+    job, builds = rome
+    assert city_knowledge_base("Italy", "where should I eat in Rome?", "Eat") is None
+    assert builds == ["Rome"]
+
+    job["sections"].append("Eat")
+    job["status"] = READY
+    assert city_knowledge_base("Italy", "where should I eat in Rome?", "Eat")[0] == "Rome, Italy"
+
+
+def test_questions_without_a_city_stay_with_the_country(rome):
+    assert city_knowledge_base("Italy", "where should I eat?", "Eat") is None
+    assert city_knowledge_base("Italy", "how do I get to Rome?", "Regions") is None
@@ -0,0 +1,37 @@
+import pytest
+
+from common_functions import make_dialogflow_request, shared_client
+from comparison import compare_countries, comparison_session
+from fake_dialogflow import FakeBackend
+
+USER_SESSION = "projects/s4395-travel-agent-bapg/agent/sessions/user-1"
+
+
+@pytest.fixture
+def backend():
+    backend = FakeBackend(countries=["Italy", "Japan", "Peru"])
+    restore = backend.install()
+    yield backend
+    restore()
+
+
+def test_each_compared_country_is_queried_on_its_own_session(backend):
+    client = shared_client('SessionsClient')
+    kb_ids = {country: kb_id for kb_id, country in backend.knowledge_bases.items()}
+
+    def answer_for_country(country):
+        response = make_dialogflow_request(comparison_session(USER_SESSION, country), client, "food", kb_ids[country])
+        return response.query_result.fulfillment_text
+
+    compare_countries(["Italy", "Japan", "Peru"], "food", answer_for_country)
+    sessions = [comparison_session(USER_SESSION, country) for country in ("Italy", "Japan", "Peru")]
+    assert backend.sessions == {session: 1 for session in sessions}
+    # the user's own session, and so its contexts, is never queried
+    assert USER_SESSION not in backend.sessions
+    assert all(session.startswith("projects/s4395-travel-agent-bapg/agent/sessions/cmp-") for session in sessions)
+
+
+def test_comparison_sessions_differ_per_user():
+    other_user = USER_SESSION[:-1] + "2"
+    assert comparison_session(USER_SESSION, "Italy") != comparison_session(other_user, "Italy")
+    assert comparison_session(USER_SESSION, "Italy") == comparison_session(USER_SESSION, "Italy")
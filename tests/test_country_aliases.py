@@ -0,0 +1,55 @@
+import pytest
+
+from comparison import countries_in_text, strip_countries
+from country_aliases import canonical_country, has_knowledge_base, normalize_key
+
+
+@pytest.mark.parametrize("name, country", [
+    ("USA", "United States"),
+    ("usa", "United States"),
+    ("the U.K.", "United Kingdom"),
+    ("Korea", "South Korea"),
+    ("italian", "Italy"),
+    ("España", "Spain"),
+    ("Österreich", "Austria"),
+    # ambiguous names still resolve the country Dialogflow extracted
+    ("US", "United States"),
+    ("America", "United States"),
+    ("the States", "United States"),
+    ("Japan", "Japan"),
+    ("Lesotho", "Lesotho"),
+])
+def test_names_resolve_to_the_knowledge_base_country(name, country):
+    assert canonical_country(name) == country
+
+
+def test_normalize_key():
+    assert normalize_key("the U.K.") == "uk"
+    assert normalize_key("  Côte   d'Ivoire ") == "cote divoire"
+
+
+@pytest.mark.parametrize("text, countries", [
+    ("What states should I visit in Mexico?", ["Mexico"]),
+    ("Is South America or Italy better for food?", ["Italy"]),
+    ("Can you tell US about Japan", ["Japan"]),
+    ("Can you tell us about Japan", ["Japan"]),
+    ("Chinese food in Japan", ["Japan"]),
+    ("USA or the UK for food?", ["United States", "United Kingdom"]),
+    ("tell me about italy and South Korea", ["Italy", "South Korea"]),
+    ("Is North Korea or Japan safer?", ["Japan"]),
+])
+def test_countries_in_text(text, countries):
+    assert countries_in_text(text) == countries
+
+
+def test_strip_countries_removes_every_alias():
+    text = "Should I go to the U.S. or Italy for food?"
+    assert strip_countries(text, countries_in_text(text)) == "Should I go to the or for food?"
+
+
+def test_partial_snapshot_is_not_a_knowledge_base(monkeypatch):
+    import country_aliases
+    monkeypatch.setattr(country_aliases, 'country_kb_id', lambda country: 'projects/test/knowledgeBases/1')
+    monkeypatch.setattr(country_aliases, 'knowledge_base_doc_mapping', lambda kb_id: {"Regions": "doc1"})
+    assert not has_knowledge_base("Atlantis")
+    assert has_knowledge_base("Italy")
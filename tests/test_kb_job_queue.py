@@ -0,0 +1,132 @@
+import pytest
+
+import kb_job_queue
+from KnowledgeBase import HEADER_LIST
+from kb_job_queue import KnowledgeBaseJobQueue, FAILED, READY
+from kb_scheduler import BACKGROUND
+
+
+class FakeKnowledgeBases:
+    """Stands in for Dialogflow and Wikivoyage, recording every section that gets scraped"""
+
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.documents = {}
+        self.scraped = []
+        self.runs = []
+        self.on_scrape = None
+
+    def create_empty_knowledge_base(self, country):
+        kb_id = f"projects/test/knowledgeBases/{country}"
+        existed = kb_id in self.documents
+        self.documents.setdefault(kb_id, {})
+        return kb_id, existed
+
+    def list_documents(self, kb_id, timeout=None):
+        return dict(self.documents[kb_id])
+
+    def scrape(self, country, kb_id, sections=None, on_section=None, should_stop=None, page=None):
+        uploaded = []
+        self.runs.append(country)
+        for key in sections:
+            if should_stop and should_stop():
+                break
+            if key == self.fail_at:
+                self.fail_at = None
+                raise ConnectionError("Wikivoyage is unreachable")
+            self.documents[kb_id][key] = f"{kb_id}/documents/{key}"
+            self.scraped.append((country, key))
+            uploaded.append(key)
+            on_section(key)
+            if self.on_scrape:
+                self.on_scrape(country, key)
+        return uploaded
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeKnowledgeBases()
+    monkeypatch.setattr(kb_job_queue, 'create_empty_knowledge_base', fake.create_empty_knowledge_base)
+    monkeypatch.setattr(kb_job_queue, '_list_kb_documents', fake.list_documents)
+    monkeypatch.setattr(kb_job_queue, 'scrape', fake.scrape)
+    monkeypatch.setattr(kb_job_queue, 'publish_invalidation', lambda *args, **kwargs: None)
+    monkeypatch.setattr(kb_job_queue, 'CURRENT_COUNTRIES', [])
+    return fake
+
+
+def test_failed_build_is_retried_from_the_sections_it_finished(fake, tmp_path):
+    fake.fail_at = "See"
+    queue = KnowledgeBaseJobQueue(state_file=str(tmp_path / 'jobs.json'))
+
+    queue.submit("Atlantis")
+    job = queue.wait("Atlantis", timeout=10)
+    assert job["status"] == FAILED
+    assert job["sections"] == HEADER_LIST[:HEADER_LIST.index("See")]
+
+    queue.submit("Atlantis")
+    job = queue.wait("Atlantis", timeout=10)
+    assert job["status"] == READY
+    assert sorted(job["sections"]) == sorted(HEADER_LIST)
+    # every section was uploaded exactly once across both attempts
+    assert sorted(key for _, key in fake.scraped) == sorted(HEADER_LIST)
+
+
+def test_existing_knowledge_base_only_gets_its_missing_sections(fake, tmp_path):
+    # another worker already uploaded the first sections, this one has no record of its build
+    kb_id, _ = fake.create_empty_knowledge_base("Atlantis")
+    for key in HEADER_LIST[:3]:
+        fake.documents[kb_id][key] = f"{kb_id}/documents/{key}"
+    queue = KnowledgeBaseJobQueue(state_file=str(tmp_path / 'jobs.json'))
+
+    queue.submit("Atlantis")
+    job = queue.wait("Atlantis", timeout=10)
+    assert job["status"] == READY
+    assert [key for _, key in fake.scraped] == HEADER_LIST[3:]
+
+
+def test_retry_state_survives_a_restart(fake, tmp_path):
+    fake.fail_at = "Eat"
+    state_file = str(tmp_path / 'jobs.json')
+    queue = KnowledgeBaseJobQueue(state_file=state_file)
+    queue.submit("Atlantis")
+    assert queue.wait("Atlantis", timeout=10)["status"] == FAILED
+
+    restarted = KnowledgeBaseJobQueue(state_file=state_file)
+    restarted.submit("Atlantis")
+    assert restarted.wait("Atlantis", timeout=10)["status"] == READY
+    assert sorted(key for _, key in fake.scraped) == sorted(HEADER_LIST)
+
+
+def test_background_build_pauses_for_an_interactive_one_and_resumes(fake, tmp_path):
+    queue = KnowledgeBaseJobQueue(state_file=str(tmp_path / 'jobs.json'), num_workers=1)
+
+    def user_asks_about_lemuria(country, key):
+        if (country, key) == ("Atlantis", HEADER_LIST[0]):
+            queue.submit("Lemuria")
+
+    fake.on_scrape = user_asks_about_lemuria
+    queue.submit("Atlantis", BACKGROUND)
+    assert queue.wait("Atlantis", timeout=20)["status"] == READY
+    assert queue.wait("Lemuria", timeout=20)["status"] == READY
+
+    # the background build stopped after the section it was on, let Lemuria through, then carried on from there
+    assert fake.scraped == [("Atlantis", HEADER_LIST[0])] + [("Lemuria", key) for key in HEADER_LIST] + \
+        [("Atlantis", key) for key in HEADER_LIST[1:]]
+
+
+def test_build_a_user_starts_waiting_on_is_no_longer_paused(fake, tmp_path):
+    queue = KnowledgeBaseJobQueue(state_file=str(tmp_path / 'jobs.json'), num_workers=1)
+
+    def users_ask_about_both(country, key):
+        if (country, key) == ("Atlantis", HEADER_LIST[0]):
+            queue.submit("Atlantis")
+            queue.submit("Lemuria")
+
+    fake.on_scrape = users_ask_about_both
+    queue.submit("Atlantis", BACKGROUND)
+    assert queue.wait("Atlantis", timeout=20)["status"] == READY
+    assert queue.wait("Lemuria", timeout=20)["status"] == READY
+
+    # Atlantis was upgraded while it ran, so it carried on in one go and Lemuria waited for it
+    assert fake.runs == ["Atlantis", "Lemuria"]
+    assert fake.scraped == [("Atlantis", key) for key in HEADER_LIST] + [("Lemuria", key) for key in HEADER_LIST]
@@ -0,0 +1,35 @@
+import common_functions
+from common_functions import detect_intent_with_knowledge, shared_client
+from fake_dialogflow import FakeBackend
+
+
+def test_default_mode_does_not_query_the_knowledge_base_before_the_intent_is_known():
+    assert common_functions.KB_QUERY_MODE == 'sequential'
+    backend = FakeBackend(countries=["Italy"])
+    restore = backend.install()
+    try:
+        kb_id = next(iter(backend.knowledge_bases))
+        for user_input in ("I don't like museums", "goodbye", "I want to go to Japan"):
+            query_result, kb_future = detect_intent_with_knowledge('mode-test', shared_client('SessionsClient'),
+                                                                   user_input, kb_id)
+            assert kb_future is None
+        assert backend.calls['detect_intent'] == 3
+    finally:
+        restore()
+
+
+def test_parallel_knowledge_base_query_runs_on_a_session_of_its_own(monkeypatch):
+    monkeypatch.setattr(common_functions, 'KB_QUERY_MODE', 'parallel')
+    backend = FakeBackend(countries=["Italy"])
+    restore = backend.install()
+    try:
+        kb_id = next(iter(backend.knowledge_bases))
+        client = shared_client('SessionsClient')
+        query_result, kb_future = detect_intent_with_knowledge('mode-test', client, "what food is there", kb_id)
+        kb_future.result()
+        user_session = common_functions.session_name(client, 'mode-test')
+        kb_session = common_functions.session_name(client, common_functions.kb_query_session('mode-test'))
+        assert kb_session != user_session
+        assert backend.sessions == {user_session: 1, kb_session: 1}
+    finally:
+        restore()
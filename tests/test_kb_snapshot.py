@@ -0,0 +1,107 @@
+import pytest
+
+import kb_snapshot
+from kb_cold_store import ColdStore
+from kb_snapshot import compact_snapshots, load_snapshot, write_snapshot
+
+
+def sections(country):
+    return {header: (f"The {header.lower()} of {country} is worth a visit for a week or more.",
+                     f"projects/test/knowledgeBases/{country}/documents/{header}")
+            for header in ("See", "Eat", "Drink", "Stay_safe", "Talk")}
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(kb_snapshot, 'HOT_SNAPSHOTS', 1)
+    monkeypatch.setattr(kb_snapshot, '_snapshots', {})
+    monkeypatch.setattr(kb_snapshot, '_recent_cold', kb_snapshot.OrderedDict())
+    monkeypatch.setattr(kb_snapshot, '_popularity', {})
+    for country in ("Italy", "Lesotho"):
+        write_snapshot(country, f"projects/test/knowledgeBases/{country}", sections(country), str(tmp_path))
+    compact_snapshots(str(tmp_path))
+    return str(tmp_path)
+
+
+def test_cold_country_is_decompressed_once_per_question(snapshot_dir, monkeypatch):
+    for _ in range(10):
+        assert load_snapshot("Italy", snapshot_dir) is not None
+    reads = []
+    original = ColdStore.get
+    monkeypatch.setattr(ColdStore, 'get', lambda store, country: reads.append(country) or original(store, country))
+
+    # Italy is more popular, so Lesotho is read without being promoted, once per section
+    for header in sections("Lesotho"):
+        assert "Lesotho" in load_snapshot("Lesotho", snapshot_dir).section_text(header)
+    assert reads == ["Lesotho"]
+    assert kb_snapshot._snapshots.keys() == {kb_snapshot.snapshot_path("Italy", snapshot_dir)}
+
+
+def test_rewritten_snapshot_replaces_the_decoded_copy(snapshot_dir):
+    for _ in range(10):
+        load_snapshot("Italy", snapshot_dir)
+    assert "worth a visit" in load_snapshot("Lesotho", snapshot_dir).section_text("Eat")
+    write_snapshot("Lesotho", "projects/test/knowledgeBases/Lesotho",
+                   {"Eat": ("Try the papa with a stew of greens and beans.", "projects/test/doc")}, snapshot_dir)
+    assert load_snapshot("Lesotho", snapshot_dir).section_text("Eat") == "Try the papa with a stew of greens and beans."
+
+
+def test_snapshot_written_after_the_scan_is_found(tmp_path, monkeypatch):
+    monkeypatch.setattr(kb_snapshot, 'SNAPSHOT_DIR', str(tmp_path))
+    for state in ('_documents', '_knowledge_bases', '_indexed', '_snapshots'):
+        monkeypatch.setattr(kb_snapshot, state, {})
+    monkeypatch.setattr(kb_snapshot, '_scanned_dirs', set())
+    assert kb_snapshot.country_kb_id("Italy") is None
+
+    write_snapshot("Italy", "projects/test/knowledgeBases/Italy", sections("Italy"))
+    assert kb_snapshot.country_kb_id("Italy") == "projects/test/knowledgeBases/Italy"
+    assert kb_snapshot.document_text("projects/test/knowledgeBases/Italy/documents/Eat") == \
+        "The eat of Italy is worth a visit for a week or more."
+    assert kb_snapshot.knowledge_base_doc_mapping("projects/test/knowledgeBases/Italy").keys() == \
+        sections("Italy").keys()
+
+
+def test_sentences_are_read_back_from_their_offsets(tmp_path):
+    write_snapshot("Peru", None, {"See": ("Machu Picchu is a long way up.\nLima has a lovely old town centre.", None)},
+                   str(tmp_path))
+    snapshot = kb_snapshot.KnowledgeBaseSnapshot(kb_snapshot.snapshot_path("Peru", str(tmp_path)))
+    assert snapshot.sentences("See") == ["Machu Picchu is a long way up.", "Lima has a lovely old town centre."]
+    snapshot.close()
+
+
+def test_compaction_by_another_process_is_picked_up(snapshot_dir):
+    store = kb_snapshot.cold_store(snapshot_dir)
+    before = {country: store.get(country) for country in ("Italy", "Lesotho")}
+
+    # another process compacts again, training a different dictionary and rewriting every file
+    other = ColdStore(store.directory)
+    other.rebuild({country: (data, [f"Fresh phrasing about the sights of {country} and its food"] * 2,
+                             store.entry(country)["kb_id"], store.entry(country)["docs"])
+                   for country, data in before.items()})
+    assert other.dictionary_id != store.dictionary_id
+
+    assert {country: store.get(country) for country in before} == before
+    assert store.dictionary_id == other.dictionary_id
+
+
+def test_a_snapshot_being_read_survives_its_replacement(snapshot_dir):
+    write_snapshot("Peru", "projects/test/knowledgeBases/Peru", sections("Peru"), snapshot_dir)
+    for _ in range(20):
+        reading = load_snapshot("Peru", snapshot_dir)
+    assert kb_snapshot.snapshot_path("Peru", snapshot_dir) in kb_snapshot._snapshots
+
+    write_snapshot("Peru", "projects/test/knowledgeBases/Peru",
+                   {"Eat": ("Try ceviche by the coast.", "projects/test/doc")}, snapshot_dir)
+    # the request that opened the old snapshot finishes reading it
+    assert reading.sentences("Drink") == ["The drink of Peru is worth a visit for a week or more."]
+    assert load_snapshot("Peru", snapshot_dir).section_text("Eat") == "Try ceviche by the coast."
+
+
+def test_version_1_snapshots_are_still_read(tmp_path):
+    path = write_snapshot("Peru", None, {"See": ("Machu Picchu is a long way up.", None)}, str(tmp_path))
+    with open(path, 'r+b') as f:
+        f.seek(4)
+        f.write((1).to_bytes(2, 'little'))
+    snapshot = kb_snapshot.KnowledgeBaseSnapshot(path)
+    assert snapshot.sentences("See") == ["Machu Picchu is a long way up."]
+    snapshot.close()
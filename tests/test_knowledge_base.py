@@ -0,0 +1,29 @@
+from bs4 import BeautifulSoup
+
+from KnowledgeBase import section_nodes, section_places, visible_strings
+
+PAGE = """
+<h2><span id="Eat">Eat</span></h2>
+<style data-mw-deduplicate="TemplateStyles:r1">.mw-parser-output .listing-metadata{display:none}</style>
+<p>Pasta is eaten at almost every meal in the north of the country.<!-- a hidden editor note --></p>
+<figure><figcaption>A plate of pasta served with plenty of fresh basil</figcaption></figure>
+<script>window.listingEditor = {enabled: true, version: 2};</script>
+<ul><li><a href="/wiki/Rome">Rome</a> has a trattoria on nearly every street, near <a href="/wiki/Lazio">Lazio</a>.</li>
+<li><a href="/wiki/File:Pizza.jpg">image</a> <a href="/wiki/Naples">Naples</a> is where pizza comes from, of course.</li></ul>
+<h2><span id="Drink">Drink</span></h2>
+<p>Espresso is drunk standing at the bar in most of the cafes.</p>
+"""
+
+
+def test_section_text_leaves_out_styles_scripts_comments_and_captions():
+    soup = BeautifulSoup(PAGE, 'html.parser')
+    text = ''.join(string for node in section_nodes(soup, "Eat") for string in visible_strings(node))
+    assert "Pasta is eaten at almost every meal in the north of the country." in text
+    assert "Rome has a trattoria on nearly every street" in text
+    for hidden in ("listing-metadata", "listingEditor", "hidden editor note", "basil", "Espresso"):
+        assert hidden not in text
+
+
+def test_section_places_takes_the_first_article_link_of_each_item():
+    soup = BeautifulSoup(PAGE, 'html.parser')
+    assert section_places(soup, "Eat") == ["Rome", "Naples"]
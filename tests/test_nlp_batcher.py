@@ -0,0 +1,36 @@
+import concurrent.futures
+import time
+
+import pytest
+
+try:
+    from nlp_batcher import MicroBatcher
+except OSError as e:
+    # locationtagger loads the spaCy model when it is imported
+    pytest.skip(f"nlp_batcher needs the spaCy model: {e}", allow_module_level=True)
+
+
+def test_jobs_arriving_together_share_a_batch():
+    calls = []
+    batcher = MicroBatcher('test-batcher', lambda items: calls.append(items) or [item * 2 for item in items],
+                           max_wait=0.05)
+    assert batcher.run_many([1, 2, 2, 3]) == [2, 4, 4, 6]
+    assert calls == [[1, 2, 3]]
+
+
+def test_a_failing_batch_fails_its_jobs_and_the_worker_keeps_going():
+    # a result list shorter than the batch breaks outside batch_fn itself
+    batcher = MicroBatcher('test-batcher', lambda items: [] if 'short' in items else list(items), max_wait=0.01)
+    with pytest.raises(KeyError):
+        batcher.run('short')
+    with pytest.raises(TypeError):
+        batcher.run(['unhashable'])
+    assert batcher.run('fine', timeout=1) == 'fine'
+
+
+def test_a_stuck_batch_times_out():
+    batcher = MicroBatcher('test-batcher', lambda items: time.sleep(0.5) or list(items), max_wait=0.01)
+    start = time.monotonic()
+    with pytest.raises(concurrent.futures.TimeoutError):
+        batcher.run_many(['a', 'b'], timeout=0.1)
+    assert time.monotonic() - start < 0.4
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import common_functions
+from common_functions import KB_UNAVAILABLE, RETRYABLE_ERRORS, kb_search_cache, search_knowledge_base_by_intent, \
+    shared_client
+from fake_dialogflow import FakeBackend
+from resilience import CallPolicy, CircuitBreaker, OPEN
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = FakeBackend(countries=["Italy"])
+    restore = backend.install()
+    monkeypatch.setattr(common_functions, 'detect_intent_policy',
+                        CallPolicy('detect_intent', deadline=0.3, base_backoff=0.0, hedge=False,
+                                   retry_on=RETRYABLE_ERRORS,
+                                   breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.1)))
+    kb_search_cache.clear()
+    yield backend
+    restore()
+    kb_search_cache.clear()
+
+
+def italy(backend):
+    kb_id = next(iter(backend.knowledge_bases))
+    mapping = {document.display_name: name for name, document in backend.documents[kb_id].items()}
+    return kb_id, mapping
+
+
+def search(backend, question="what food should I eat"):
+    kb_id, mapping = italy(backend)
+    return search_knowledge_base_by_intent('outage-test', shared_client('SessionsClient'), question, kb_id, "Eat",
+                                           mapping)
+
+
+def test_search_during_an_outage_is_not_cached(backend):
+    backend.error_rate = 1.0
+    for _ in range(3):
+        assert search(backend) is KB_UNAVAILABLE
+    assert common_functions.detect_intent_policy.breaker.state == OPEN
+    assert kb_search_cache.stats()["size"] == 0
+
+    # once Dialogflow is back, the next question gets a real answer, and only that is cached
+    backend.error_rate = 0.0
+    time.sleep(0.15)
+    answer = search(backend)
+    assert answer is not KB_UNAVAILABLE and 'pasta' in answer
+    assert kb_search_cache.stats()["size"] == 1
+
+
+def test_search_past_the_deadline_is_not_cached(backend):
+    backend.slow_rate = 1.0
+    start = time.monotonic()
+    assert search(backend) is KB_UNAVAILABLE
+    assert time.monotonic() - start < 1.0
+    assert kb_search_cache.stats()["size"] == 0
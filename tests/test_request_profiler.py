@@ -0,0 +1,27 @@
+import pytest
+
+from request_profiler import RequestProfiler, parse_settings
+
+
+@pytest.mark.parametrize("spec", ["rate=fast", "rate=2", "rate=-0.5", "rate=nan"])
+def test_bad_rates_are_rejected(spec):
+    with pytest.raises(ValueError):
+        parse_settings(spec)
+
+
+def test_a_bad_setting_leaves_profiling_off(monkeypatch, tmp_path):
+    monkeypatch.setenv('TRAVEL_AGENT_PROFILE', 'rate=often')
+    profiler = RequestProfiler(directory=str(tmp_path))
+    assert profiler.settings["rate"] == 0.0
+    with pytest.raises(ValueError):
+        profiler.configure("rate=5")
+    assert profiler.settings["rate"] == 0.0
+
+
+def test_a_profile_that_cannot_be_written_does_not_fail_the_request(tmp_path):
+    # the profile directory cannot be created under a file
+    (tmp_path / 'file').write_text('')
+    profiler = RequestProfiler("rate=1", directory=str(tmp_path / 'file' / 'profiles'))
+    with profiler.request():
+        served = True
+    assert served
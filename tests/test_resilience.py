@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from resilience import CallPolicy, CircuitBreaker, CircuitOpenError, RetryBudget, resilient_call, OPEN, CLOSED
+
+
+class FlakyBackend:
+    """A call that fails, stalls or answers as scripted, recording how often it was made"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, timeout=None):
+        with self.lock:
+            self.calls += 1
+            step = self.script.pop(0) if self.script else 'ok'
+        if step == 'fail':
+            raise ConnectionError("backend unavailable")
+        if step == 'stall':
+            # like gRPC, a call that outlives its timeout raises once the timeout is up
+            time.sleep(timeout)
+            raise TimeoutError("deadline exceeded")
+        if isinstance(step, float):
+            time.sleep(step)
+        return 'answer'
+
+
+def policy(**kwargs):
+    settings = dict(deadline=1.0, base_backoff=0.0, hedge=False)
+    settings.update(kwargs)
+    return CallPolicy('test', **settings)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    backend = FlakyBackend(['fail'] * 10)
+    test_policy = policy(max_attempts=1, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60))
+
+    for _ in range(3):
+        assert resilient_call(test_policy, backend, fallback=lambda: 'fallback') == 'fallback'
+    assert test_policy.breaker.state == OPEN
+
+    # an open breaker answers from the fallback without calling the backend
+    assert resilient_call(test_policy, backend, fallback=lambda: 'fallback') == 'fallback'
+    assert backend.calls == 3
+    assert test_policy.counts["rejected"] == 1
+    with pytest.raises(CircuitOpenError):
+        resilient_call(test_policy, backend)
+
+
+def test_half_open_trial_closes_the_breaker():
+    backend = FlakyBackend(['fail', 'fail'])
+    test_policy = policy(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.05))
+    for _ in range(2):
+        resilient_call(test_policy, backend, fallback=lambda: None)
+    assert test_policy.breaker.state == OPEN
+
+    time.sleep(0.1)
+    assert resilient_call(test_policy, backend) == 'answer'
+    assert test_policy.breaker.state == CLOSED
+
+
+def test_failures_are_retried_within_the_budget():
+    backend = FlakyBackend(['fail'] * 10)
+    test_policy = policy(max_attempts=10, budget=RetryBudget(ratio=0.0, min_tokens=2))
+
+    assert resilient_call(test_policy, backend, fallback=lambda: 'fallback') == 'fallback'
+    # the first attempt plus the two retries the budget allowed
+    assert backend.calls == 3
+    assert test_policy.counts["retries"] == 2
+
+
+def test_slow_attempt_is_hedged():
+    backend = FlakyBackend([0.5, 'ok'])
+    test_policy = policy(hedge=True, min_hedge_delay=0.05, deadline=2.0)
+    test_policy.hedge_delay = lambda: 0.05
+
+    start = time.monotonic()
+    assert resilient_call(test_policy, backend) == 'answer'
+    assert time.monotonic() - start < 0.4
+    assert test_policy.counts["hedges"] == 1
+    assert backend.calls == 2
+
+
+def test_deadline_bounds_a_stalled_backend():
+    backend = FlakyBackend(['stall'] * 10)
+    test_policy = policy(deadline=0.2, max_attempts=3)
+
+    start = time.monotonic()
+    assert resilient_call(test_policy, backend, fallback=lambda: 'fallback') == 'fallback'
+    assert time.monotonic() - start < 0.5
+    assert test_policy.counts["fallbacks"] == 1
+
+
+def test_unsafe_call_is_only_retried_when_it_was_not_carried_out():
+    test_policy = policy(max_attempts=3, safe_to_retry=(ConnectionError,))
+
+    backend = FlakyBackend(['fail', 'ok'])
+    assert resilient_call(test_policy, backend) == 'answer'
+    assert backend.calls == 2
+
+    # a timed out call may have been carried out, so it goes to the fallback instead of being made again
+    backend = FlakyBackend(['stall', 'ok'])
+    test_policy.deadline = 0.1
+    assert resilient_call(test_policy, backend, fallback=lambda: 'fallback') == 'fallback'
+    assert backend.calls == 1
+    assert test_policy.counts["failures"] == 1
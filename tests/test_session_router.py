@@ -0,0 +1,113 @@
+import io
+import urllib.error
+
+import admin_auth
+import session_router
+from session_router import HashRing, SessionRouter, call_node, create_app
+
+SESSIONS = [f"projects/test/agent/sessions/user-{x}" for x in range(3000)]
+
+
+def test_ring_spreads_sessions_evenly():
+    ring = HashRing(["http://a", "http://b", "http://c"])
+    owners = [ring.node_for(session) for session in SESSIONS]
+    for node in ring.nodes:
+        assert 0.2 < owners.count(node) / len(SESSIONS) < 0.47
+    assert HashRing().node_for(SESSIONS[0]) is None
+
+
+def test_adding_a_node_only_moves_sessions_onto_it():
+    ring = HashRing(["http://a", "http://b", "http://c"])
+    before = {session: ring.node_for(session) for session in SESSIONS}
+    grown = ring.copy()
+    grown.add("http://d")
+    moved = [session for session in SESSIONS if grown.node_for(session) != before[session]]
+    assert all(grown.node_for(session) == "http://d" for session in moved)
+    assert 0.15 < len(moved) / len(SESSIONS) < 0.35
+    # the copy is independent of the ring it was made from
+    assert ring.nodes == ["http://a", "http://b", "http://c"]
+
+
+def test_removing_a_node_only_moves_its_sessions():
+    ring = HashRing(["http://a", "http://b", "http://c"])
+    shrunk = ring.copy()
+    shrunk.remove("http://b")
+    for session in SESSIONS:
+        if ring.node_for(session) != "http://b":
+            assert shrunk.node_for(session) == ring.node_for(session)
+        else:
+            assert shrunk.node_for(session) in ("http://a", "http://c")
+
+
+class FakeNodes:
+    """Webhook nodes holding sessions, answering call_node like the webhook's admin endpoints"""
+
+    def __init__(self, ring, sessions, down=()):
+        self.down = set(down)
+        self.sessions = {node: {} for node in ring.nodes}
+        for session in sessions:
+            self.sessions[ring.node_for(session)][session] = {"session": session, "country": "Italy"}
+
+    def call(self, node, path, payload=None, timeout=30.0):
+        if node in self.down:
+            raise urllib.error.URLError("connection refused")
+        held = self.sessions.setdefault(node, {})
+        if path == '/admin/sessions':
+            return {"sessions": list(held)}
+        if path == '/admin/sessions/export':
+            return {"sessions": {session: held.pop(session) for session in payload["sessions"] if session in held}}
+        if path == '/admin/sessions/import':
+            held.update(payload["sessions"])
+            return {"imported": len(payload["sessions"])}
+        raise AssertionError(path)
+
+
+def test_migration_moves_every_session_to_its_new_owner(monkeypatch):
+    old_ring = HashRing(["http://a", "http://b"])
+    nodes = FakeNodes(old_ring, SESSIONS[:500])
+    monkeypatch.setattr(session_router, 'call_node', nodes.call)
+    new_ring = old_ring.copy()
+    new_ring.add("http://c")
+
+    result = SessionRouter._migrate(old_ring, new_ring)
+    assert result["lost"] == 0
+    assert result["moved"] == len(nodes.sessions["http://c"]) > 0
+    for node, held in nodes.sessions.items():
+        assert all(new_ring.node_for(session) == node for session in held)
+        assert all(state["country"] == "Italy" for state in held.values())
+    assert sum(len(held) for held in nodes.sessions.values()) == 500
+
+
+def test_sessions_of_an_unreachable_node_start_afresh(monkeypatch):
+    old_ring = HashRing(["http://a", "http://b", "http://c"])
+    nodes = FakeNodes(old_ring, SESSIONS[:500], down=["http://b"])
+    monkeypatch.setattr(session_router, 'call_node', nodes.call)
+    router = SessionRouter(["http://a", "http://b", "http://c"])
+    kept = {node: dict(held) for node, held in nodes.sessions.items()}
+
+    result = router.remove_node("http://b")
+    assert router.ring.nodes == ["http://a", "http://c"]
+    assert result == {"nodes": ["http://a", "http://c"], "moved": 0, "lost": 0}
+    assert nodes.sessions["http://a"] == kept["http://a"] and nodes.sessions["http://c"] == kept["http://c"]
+
+
+def test_admin_calls_carry_the_admin_token(monkeypatch):
+    sent = []
+
+    def urlopen(req, timeout):
+        sent.append(req)
+        return io.BytesIO(b'{}')
+
+    monkeypatch.setattr(session_router.urllib.request, 'urlopen', urlopen)
+    monkeypatch.setattr(admin_auth, 'ADMIN_TOKEN', 'secret')
+    call_node("http://a", '/admin/sessions')
+    call_node("http://a", '/webhook', {"session": "s"})
+    assert sent[0].get_header('X-admin-token') == 'secret'
+    assert sent[1].get_header('X-admin-token') is None
+
+
+def test_router_admin_endpoint_needs_the_token(monkeypatch):
+    monkeypatch.setattr(admin_auth, 'ADMIN_TOKEN', 'secret')
+    client = create_app(SessionRouter(["http://a"])).test_client()
+    assert client.get('/admin/nodes').status_code == 403
+    assert client.get('/admin/nodes', headers={'X-Admin-Token': 'secret'}).json == {"nodes": ["http://a"]}
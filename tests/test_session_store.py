@@ -0,0 +1,98 @@
+import pytest
+
+import session_store
+from cache_manager import CacheManager
+from session_store import SessionStore
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = CacheManager(budget=10000)
+    monkeypatch.setattr(session_store, 'cache_manager', manager)
+    return manager
+
+
+def store(**kwargs):
+    return SessionStore(lambda session: {"session": session, "turns": 0}, lambda state: 100, **kwargs)
+
+
+def test_idle_sessions_expire(manager, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(session_store.time, 'monotonic', lambda: clock[0])
+    sessions = store(idle_ttl=60)
+    sessions.get("a")["turns"] += 1
+    clock[0] += 30
+    sessions.get("b")
+    clock[0] += 40
+    # a was last used 70 seconds ago, b only 40
+    assert sessions.names() == ["b"]
+    assert sessions.get("a")["turns"] == 0
+    assert sessions.stats()["expired"] == 1
+    assert manager.stats()["caches"]["sessions"]["used_bytes"] == 200
+
+
+def test_least_recently_used_session_goes_past_the_limit(manager):
+    sessions = store(max_size=2)
+    sessions.get("a")
+    sessions.get("b")
+    sessions.get("a")
+    sessions.get("c")
+    assert sessions.names() == ["a", "c"]
+    assert manager.stats()["entries"] == 2
+
+
+class Answers:
+    name = 'answers'
+
+    def __init__(self):
+        self.discarded = []
+
+    def discard(self, key):
+        self.discarded.append(key)
+
+    def stats(self):
+        return {}
+
+
+def test_sessions_take_their_share_of_the_cache_budget(manager):
+    answers = Answers()
+    manager.register(answers)
+    for x in range(90):
+        assert manager.admit('answers', x, 100)
+    sessions = store()
+    for x in range(20):
+        sessions.get(f"session-{x}")
+    # sessions are always admitted, the least recently used answers made room for them
+    assert len(sessions.names()) == 20
+    assert answers.discarded == list(range(10))
+    assert manager.stats()["used_bytes"] <= 10000
+
+
+def test_cached_entries_never_push_a_session_out(manager):
+    answers = Answers()
+    manager.register(answers)
+    sessions = store()
+    for x in range(60):
+        sessions.get(f"session-{x}")
+    for x in range(40):
+        assert manager.admit('answers', x, 100)
+    # the budget is full, new answers only push out older answers, never a conversation
+    for x in range(40, 80):
+        assert manager.admit('answers', x, 100)
+    assert answers.discarded == list(range(40))
+    assert len(sessions.names()) == 60
+    assert sessions.stats()["evictions"] == 0
+
+
+def test_an_answer_is_rejected_when_sessions_hold_the_budget(manager):
+    answers = Answers()
+    manager.register(answers)
+    sessions = store()
+    for x in range(100):
+        sessions.get(f"session-{x}")
+    assert not manager.admit('answers', 0, 100)
+    assert len(sessions.names()) == 100
+    # another session still makes room for itself
+    sessions.get("session-100")
+    assert len(sessions.names()) == 100
+    assert "session-0" not in sessions.names()
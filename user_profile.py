@@ -0,0 +1,134 @@
+import struct
+from array import array
+from typing import List, Optional
+
+from KnowledgeBase import HEADER_LIST
+
+# bounds on what is remembered per user, so the memory of a session stays constant however long it runs
+MAX_COUNTRIES = 32
+MAX_DISLIKES = 256
+
+# index of every header intent in the interest counters
+HEADER_INDEX = {header: index for index, header in enumerate(HEADER_LIST)}
+
+# version, name length, number of countries, number of dislikes, then one counter per header
+_HEADER = struct.Struct('<BHHH')
+_VERSION = 1
+
+
+class UserProfile:
+    """
+    What the chatbot knows about one user: their name, the countries they looked at (most recent last),
+    the words they dislike and how often they asked about each header.
+    Countries and dislikes are ordered sets (dicts without values), so updates and lookups are O(1).
+    """
+    __slots__ = ('name', '_countries', '_dislikes', '_interests')
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._countries = {}
+        self._dislikes = {}
+        self._interests = array('I', bytes(4 * len(HEADER_LIST)))
+
+    @property
+    def countries(self) -> List[str]:
+        return list(self._countries)
+
+    @property
+    def last_country(self) -> Optional[str]:
+        return next(reversed(self._countries), None)
+
+    def visit_country(self, country: str) -> None:
+        """Makes a country the most recent one, forgetting the oldest if too many are remembered"""
+        self._countries.pop(country, None)
+        self._countries[country] = None
+        if len(self._countries) > MAX_COUNTRIES:
+            del self._countries[next(iter(self._countries))]
+
+    @property
+    def dislikes(self) -> List[str]:
+        return list(self._dislikes)
+
+    def dislikes_word(self, word: str) -> bool:
+        return word in self._dislikes
+
+    def add_dislike(self, word: str) -> bool:
+        """
+        Remembers a word the user does not want recommended
+        Args: str
+            word: the disliked word
+        Returns: bool
+          whether the word was new
+        """
+        if word in self._dislikes:
+            return False
+        self._dislikes[word] = None
+        if len(self._dislikes) > MAX_DISLIKES:
+            del self._dislikes[next(iter(self._dislikes))]
+        return True
+
+    def record_interest(self, intent_name: str) -> None:
+        index = HEADER_INDEX.get(intent_name)
+        if index is not None:
+            self._interests[index] += 1
+
+    def interest(self, intent_name: str) -> int:
+        index = HEADER_INDEX.get(intent_name)
+        return 0 if index is None else self._interests[index]
+
+    @property
+    def interests(self) -> dict:
+        """The headers the user asked about, with how often"""
+        return {header: count for header, count in zip(HEADER_LIST, self._interests) if count > 0}
+
+    def to_dict(self) -> dict:
+        """The JSON layout user files have always used"""
+        return {"name": self.name, "countries": self.countries, "interests": self.interests,
+                "dislikes": self.dislikes}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'UserProfile':
+        """
+        Builds a profile from a user file (a missing file loads as an empty dict)
+        Args: dict
+            data: the user data, as written by to_dict
+        Returns: UserProfile
+          the profile
+        """
+        profile = cls(data.get("name", ""))
+        for country in data.get("countries", []):
+            profile.visit_country(country)
+        for word in data.get("dislikes", []):
+            profile.add_dislike(word)
+        for intent_name, count in data.get("interests", {}).items():
+            index = HEADER_INDEX.get(intent_name)
+            if index is not None:
+                profile._interests[index] = count
+        return profile
+
+    def to_bytes(self) -> bytes:
+        """A compact binary form, for holding or shipping many profiles"""
+        name = self.name.encode('utf-8')
+        strings = '\0'.join(list(self._countries) + list(self._dislikes)).encode('utf-8')
+        return _HEADER.pack(_VERSION, len(name), len(self._countries), len(self._dislikes)) + \
+            self._interests.tobytes() + name + strings
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'UserProfile':
+        version, name_length, num_countries, num_dislikes = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError(f"unsupported user profile version {version}")
+        offset = _HEADER.size
+        profile = cls()
+        profile._interests = array('I')
+        profile._interests.frombytes(data[offset:offset + 4 * len(HEADER_LIST)])
+        offset += 4 * len(HEADER_LIST)
+        profile.name = data[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+        strings = data[offset:].decode('utf-8').split('\0') if num_countries + num_dislikes > 0 else []
+        profile._countries = dict.fromkeys(strings[:num_countries])
+        profile._dislikes = dict.fromkeys(strings[num_countries:])
+        return profile
+
+    def __repr__(self) -> str:
+        return f"UserProfile({self.to_dict()!r})"
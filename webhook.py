@@ -1,204 +1,400 @@
+import argparse
+import base64
 import os
 import re
+import threading
 
-from google.cloud import dialogflow_v2beta1 as dialogflow
 from google.protobuf.json_format import MessageToDict
-from KnowledgeBase import create_knowledge_base, HEADER_LIST
-from chatbot import search_knowledge_base_by_intent, add_disliked_item
+from KnowledgeBase import HEADER_LIST
+from chatbot import answer_header_intent, answer_comparison, add_disliked_item, default_kb_search
 from common_functions import *
 from IntentParsing import *
+from kb_job_queue import kb_job_queue, READY
+from cache_manager import cache_manager, estimate_size
+from cache_checkpoint import start_checkpointing
+import cache_invalidation
+import kb_snapshot
+from prefetcher import prefetcher
+from country_aliases import canonical_country, has_knowledge_base
+from comparison import countries_in_text
+from city_kb import city_knowledge_base, prebuild_popular_cities
+from fetch_planner import needs_kb_response
+import nlp_batcher
+from user_profile import UserProfile
+from session_store import SessionStore
+from request_profiler import request_profiler, stage
+from admin_auth import admin_only
 
 from flask import Flask, request
 
 app = Flask(__name__)
 
-filename = None
-country = None
-current_kbid = None
-current_kbid_doc_mapping = None
-is_first_request = True
-flag = False
-last_country = None
-session = None
-
-user_dict = {"name": "", "countries": [], "interests": {}, "dislikes": []}
+def new_session_state(session: str) -> dict:
+    """
+    Creates the state that is carried between the webhook calls of one Dialogflow session
+    Args: str
+        session: the name of the Dialogflow session
+    Returns: dict
+        the session state
+    """
+    return {
+        "lock": threading.Lock(),
+        "session": session,
+        "filename": None,
+        "country": None,
+        "current_kbid": None,
+        "current_kbid_doc_mapping": None,
+        "is_first_request": True,
+        "last_country": None,
+        "user_profile": UserProfile()
+    }
+
+
+def session_state_size(state: dict) -> int:
+    """The memory a session's state holds, counted towards the cache budget"""
+    return estimate_size({key: value for key, value in state.items() if key not in ("lock", "user_profile")}) + \
+        len(state["user_profile"].to_bytes())
+
+
+# conversation state for the Dialogflow sessions this worker is serving, so concurrent users never share a context
+sessions = SessionStore(new_session_state, session_state_size)
+
+
+def get_session_state(session: str) -> dict:
+    return sessions.get(session)
+
+
+def export_session_state(state: dict) -> dict:
+    """
+    Serializes a session's state so another webhook node can take the session over
+    Args: dict
+        state: the session state
+    Returns: dict
+        a JSON-compatible copy of the state
+    """
+    exported = {key: value for key, value in state.items() if key not in ("lock", "user_profile")}
+    exported["user_profile"] = base64.b64encode(state["user_profile"].to_bytes()).decode('ascii')
+    return exported
+
+
+def import_session_state(exported: dict) -> dict:
+    """
+    Rebuilds a session's state from export_session_state
+    Args: dict
+        exported: the serialized state
+    Returns: dict
+        the session state
+    """
+    state = new_session_state(exported["session"])
+    state.update({key: value for key, value in exported.items() if key in state and key != "user_profile"})
+    state["user_profile"] = UserProfile.from_bytes(base64.b64decode(exported["user_profile"]))
+    return state
 
 
 @app.route('/webhook', methods=["POST"])
 def webhook():
-    response = {'fulfillmentText': ""}
-
-    global filename
-    global country
-    global current_kbid
-    global current_kbid_doc_mapping
-    global user_dict
-    global is_first_request
-    global flag
-    global last_country
-    global session
-    global session_id
-
     # get request
     payload = request.json
+    state = get_session_state(payload.get("session", "default"))
+
+    intent_name = payload["queryResult"].get("intent", {}).get("displayName")
+    country_name = payload["queryResult"].get("parameters", {}).get("geo-country") or state["country"]
+
+    # calls for one session are handled in order, different sessions run concurrently
+    with state["lock"], request_profiler.request(intent_name, country_name):
+        try:
+            return handle_webhook_request(payload, state)
+        except UNAVAILABLE_ERRORS as e:
+            print("LOG - Dialogflow unavailable: " + str(e))
+            return {"fulfillmentText": UNAVAILABLE_REPLY}
+
+
+def handle_webhook_request(payload: dict, state: dict) -> dict:
+    """
+    Answers one Dialogflow webhook call
+    Args: dict, dict
+        payload: the webhook request sent by Dialogflow
+        state: the state of the session the request belongs to
+    Returns: dict
+        the webhook response
+    """
+    filename = state["filename"]
+    country = state["country"]
+    current_kbid = state["current_kbid"]
+    current_kbid_doc_mapping = state["current_kbid_doc_mapping"]
+    is_first_request = state["is_first_request"]
+    last_country = state["last_country"]
+    session = state["session"]
+    user_profile = state["user_profile"]
+    try:
+        response = {'fulfillmentText': ""}
+
+        # every session shares one client, whose channel multiplexes the concurrent requests of all users
+        session_client = shared_client('SessionsClient')
+        # Dialogflow already matched this turn on the user's session, the extra queries get a session of their own
+        kb_session = kb_query_session(session)
+
+        user_input = payload["queryResult"]["queryText"]
+        parameters_dict = payload["queryResult"]['parameters']
+
+        fulfill = ''
+
+        is_existing_country_intent = False
+
+        # a question about several countries is answered for all of them, without switching the active country
+        compared = countries_in_text(user_input)
+        if len(compared) > 1:
+            intent_name = payload["queryResult"].get("intent", {}).get("displayName")
+            with stage("compare"):
+                response["fulfillmentText"] = answer_comparison(session, session_client, user_input, compared,
+                                                                user_profile, intent_name)
+            if filename:
+                save_user_data(filename, user_profile.to_dict())
+            return response
 
-    # set up session
-    session_client = dialogflow.SessionsClient()
-
-    user_input = payload["queryResult"]["queryText"]
-    parameters_dict = payload["queryResult"]['parameters']
-
-    fulfill = ''
-
-    is_existing_country_intent = False
-
-    # person detected
-    if 'person' in parameters_dict and 'name' in parameters_dict['person']:
-            user_name = parameters_dict['person']['name']
-            print("Log - Detected name: " + user_name)
-            filename = f"{user_name}.json"
-            if not os.path.exists(filename):
-                user_dict["name"] = user_name
-                save_user_data(filename, user_dict)
-                response["fulfillmentText"] = f"Nice to meet you {user_name}, what country are you interested in visiting?"
-            else:
-                user_dict = load_user_data(filename)
-
-                # user has previous countries in their JSON
-                if len(user_dict["countries"]) > 0:
-                    last_country = user_dict["countries"][-1]
-                    response["fulfillmentText"] = f"Welcome back {user_name}, let's continue researching your trip to {last_country}!"
+        # person detected
+        if 'person' in parameters_dict and 'name' in parameters_dict['person']:
+                user_name = parameters_dict['person']['name']
+                print("Log - Detected name: " + user_name)
+                filename = f"{user_name}.json"
+                if not os.path.exists(filename):
+                    user_profile.name = user_name
+                    save_user_data(filename, user_profile.to_dict())
+                    response["fulfillmentText"] = f"Nice to meet you {user_name}, what country are you interested in visiting?"
+                else:
+                    user_profile = UserProfile.from_dict(load_user_data(filename))
 
-                    is_existing_country_intent = True
+                    # user has previous countries in their JSON
+                    if user_profile.last_country is not None:
+                        last_country = user_profile.last_country
+                        response["fulfillmentText"] = f"Welcome back {user_name}, let's continue researching your trip to {last_country}!"
 
-                    session = session_client.session_path(PROJECT_ID, user_name)
+                        is_existing_country_intent = True
 
-                    # avoid showing the response from this extra request to the user
-                    parameters_dict['geo-country'] = last_country
+                        # avoid showing the response from this extra request to the user
+                        parameters_dict['geo-country'] = last_country
 
-                # existing user has never indicated interest in a country
-                else:
-                    response["fulfillmentText"] = f"Welcome back {user_name}, please let me know the name of a country you are interested in."
-                    session = session_client.session_path(PROJECT_ID, user_name)
+                    # existing user has never indicated interest in a country
+                    else:
+                        response["fulfillmentText"] = f"Welcome back {user_name}, please let me know the name of a country you are interested in."
 
-            # only update user info at start of conversation
-            is_first_request = False
+                # only update user info at start of conversation
+                is_first_request = False
 
-    # new country detected, so you should switch context
-    if 'geo-country' in parameters_dict and parameters_dict['geo-country'] != '':
-        country = parameters_dict['geo-country']
-        print("LOG - Detected country: " + country)
+        # new country detected, so you should switch context
+        if 'geo-country' in parameters_dict and parameters_dict['geo-country'] != '':
+            country = canonical_country(parameters_dict['geo-country'])
+            print("LOG - Detected country: " + country)
 
-        if country in CURRENT_COUNTRIES:
-            current_kbid = get_kb_name_of_country(country)
-            print("KBID Detected: " + current_kbid)
-        else:
-            # build a knowledge base for that country if it does not already exist
-            current_kbid = create_knowledge_base(country)
-            print("KBID Created: " + current_kbid)
-            CURRENT_COUNTRIES.append(country)
-            response["fulfillmentText"] += "Warning: populating the knowledge base may take a few minutes"
-
-        current_kbid_doc_mapping = map_doc_name_to_id(current_kbid)
-        if country in user_dict["countries"]:
-            user_dict["countries"].remove(country)
-        user_dict["countries"].append(country)
-
-    if filename:
-        save_user_data(filename, user_dict)
-
-    # extract what information the user would like to know
-    query_result = payload["queryResult"]
-
-    if "fulfillmentText" in query_result:
-        fulfill = query_result["fulfillmentText"]
-    if 'intent' in payload["queryResult"]:
-        print("DEBUG LOG  - IN INTENT")
-        intent_name = query_result['intent']['displayName']
-        print("LOG - Detected user intent: " + intent_name)
-        # dislike
-        if intent_name == "Dislike":
-            add_disliked_item(parameters_dict['Disliked'], user_dict)
-            response["fulfillmentText"] = fulfill
-            return response
-        # close
-        elif intent_name == "Close":
-            response["fulfillmentText"] = fulfill
-            return response
+            if has_knowledge_base(country):
+                current_kbid = get_kb_name_of_country(country)
+                print("KBID Detected: " + current_kbid)
+            else:
+                # build the knowledge base in the background, a scrape takes far longer than Dialogflow will wait
+                job = kb_job_queue.submit(country)
+                current_kbid = job["kb_id"]
+                print("LOG - Knowledge base build " + job["status"] + " for " + country)
+                response["fulfillmentText"] += "Warning: populating the knowledge base may take a few minutes"
+
+            with stage("switch_country"):
+                current_kbid_doc_mapping = map_doc_name_to_id(current_kbid) if current_kbid else {}
+            user_profile.visit_country(country)
+
+            # get ready for the questions this user usually asks while Dialogflow delivers the reply
+            prefetcher.prefetch(country, current_kbid, user_profile)
+            prebuild_popular_cities(country)
+
+        if filename:
+            save_user_data(filename, user_profile.to_dict())
+
+        # extract what information the user would like to know
+        query_result = payload["queryResult"]
+
+        if "fulfillmentText" in query_result:
+            fulfill = query_result["fulfillmentText"]
+        if 'intent' in payload["queryResult"]:
+            print("DEBUG LOG  - IN INTENT")
+            intent_name = query_result['intent']['displayName']
+            print("LOG - Detected user intent: " + intent_name)
+            # dislike
+            if intent_name == "Dislike":
+                add_disliked_item(parameters_dict['Disliked'], user_profile)
+                response["fulfillmentText"] = fulfill
+                return response
+            # close
+            elif intent_name == "Close":
+                response["fulfillmentText"] = fulfill
+                return response
 
-        elif is_existing_country_intent:
-            return response
+            elif is_existing_country_intent:
+                return response
 
-        elif intent_name == "Welcome Intent":
-            response["fulfillmentText"] = "What country are you interested in visiting?"
-            return response
+            elif intent_name == "Welcome Intent":
+                response["fulfillmentText"] = "What country are you interested in visiting?"
+                return response
 
-        # default
-        elif intent_name == "Default Fallback":
-            print("EXPERIMENTAL DEFAULT FALLBACK")
-
-            response2 = make_dialogflow_request(session, session_client, user_input, current_kbid)
-            answers = response2.query_result.knowledge_answers.answers
-            if len(answers) > 0:
-                answer = answers[0].answer
-                x = 0
-                found_result = False
-                while x < len(nltk.sent_tokenize(answer)) and not found_result:
-                    sentence = nltk.sent_tokenize(answer)[x]
-                    has_word_in_common = False
-                    for word in nltk.word_tokenize(user_input):
-                        if len(word) > 4 and sentence.lower().find(word.lower()) != -1:
-                            has_word_in_common = True
-                    if len(sentence.split()) < 100 and has_word_in_common:
-                        response["fulfillmentText"] = f"Here's what I found about that on the web: {sentence}"
-                        return response
-                    x += 1
+            # default
+            elif intent_name == "Default Fallback":
+                print("EXPERIMENTAL DEFAULT FALLBACK")
 
-                response["fulfillmentText"] = f"Sorry, can you rephrase your question?"
-                return response
-            else:
-                response["fulfillmentText"] = f"Sorry, I didn't get that."
+                # gives the same answers as the command line chatbot, and its fallback when the knowledge
+                # base could not be reached
+                response["fulfillmentText"] = default_kb_search(kb_session, session_client, user_input, current_kbid)
                 return response
 
-        # other
-        else:
-            # check if we should reference the knowledge base of a certain header
-            if intent_name in HEADER_LIST and country:
-                if "fulfillmentText" in query_result:
-                    fulfill = query_result["fulfillmentText"]
-                else:
-                    fulfill = ""
+            # other
+            else:
+                # check if we should reference the knowledge base of a certain header
+                if intent_name in HEADER_LIST and country:
+                    if "fulfillmentText" in query_result:
+                        fulfill = query_result["fulfillmentText"]
+                    else:
+                        fulfill = ""
+
+                    user_profile.record_interest(intent_name)
+                    if filename:
+                        save_user_data(filename, user_profile.to_dict())
+                    print("DEBUG LOG - HERE 1")
+
+                    # while a knowledge base is still being built, only answer from sections that are uploaded
+                    if current_kbid is None or not has_knowledge_base(country):
+                        job = kb_job_queue.submit(country)
+                        current_kbid = job["kb_id"]
+                        if current_kbid is None or (job["status"] != READY and intent_name not in job["sections"]):
+                            response["fulfillmentText"] = f"I'm still gathering information about that for {country}, please ask me again in a minute."
+                            return response
+
+                    # a question naming one of the country's cities is answered from the city's knowledge base once built
+                    city = city_knowledge_base(country, user_input, intent_name)
+                    if city is not None:
+                        place, place_kbid, place_mapping = city
+                        content = answer_header_intent(kb_session, session_client, user_input, place, place_kbid,
+                                                       intent_name, user_profile, place_mapping)
+                        response["fulfillmentText"] = f"{fulfill} {content}"
+                        return response
 
-                if intent_name in user_dict["interests"]:
-                    user_dict["interests"][intent_name] += 1
-                else:
-                    user_dict["interests"][intent_name] = 1
-                if filename:
-                    save_user_data(filename, user_dict)
-                print("DEBUG LOG - HERE 1")
-
-                current_kbid_doc_mapping = map_doc_name_to_id(current_kbid)
-                kb_response = search_knowledge_base_by_intent(session, session_client, user_input, current_kbid,
-                                                                intent_name, current_kbid_doc_mapping)
-                if kb_response is None:
-                    print("DEBUG LOG - HERE 2")
-                    kb_response = ''
-                    content = kb_intent_response(kb_response, intent_name, country, user_dict, current_kbid_doc_mapping)
-                    if content is None:
-                        content = " "
+                    # Dialogflow already classified this turn, so overlap the knowledge base query with the mapping
+                    # lookup, but only when this intent's handler reads the knowledge base answer at all; nothing
+                    # is guessed here, so this does not depend on KB_QUERY_MODE
+                    kb_future = None
+                    if needs_kb_response(intent_name):
+                        kb_future = speculation_pool.submit(make_dialogflow_request, kb_session, session_client, user_input,
+                                                            current_kbid)
+                    content = answer_header_intent(kb_session, session_client, user_input, country, current_kbid,
+                                                   intent_name, user_profile, current_kbid_doc_mapping, kb_future)
                     response["fulfillmentText"] = f"{fulfill} {content}"
                     return response
                 else:
-                    print("DEBUG LOG - HERE 3")
-                    content = kb_intent_response(kb_response, intent_name, country, user_dict, current_kbid_doc_mapping)
-                    response["fulfillmentText"] = f"{fulfill} {content}"
+                    response["fulfillmentText"] = fulfill
                     return response
-            else:
-                response["fulfillmentText"] = fulfill
-                return response
-    else:
-        response["fulfillmentText"] = fulfill
-        return response
+        else:
+            response["fulfillmentText"] = fulfill
+            return response
+    finally:
+        state.update({
+            "filename": filename,
+            "country": country,
+            "current_kbid": current_kbid,
+            "current_kbid_doc_mapping": current_kbid_doc_mapping,
+            "is_first_request": is_first_request,
+            "last_country": last_country,
+            "session": session,
+            "user_profile": user_profile
+        })
+
+
+@app.route('/kb-status/<country>', methods=["GET"])
+def kb_status(country):
+    # lets operators poll an on-demand knowledge base build
+    country = canonical_country(country)
+    job = kb_job_queue.status(country)
+    if job is None:
+        return {"country": country, "status": READY if has_knowledge_base(country) else None}
+    return job
+
+
+@app.route('/admin/kb-queue', methods=["GET", "POST"])
+@admin_only
+def kb_queue():
+    # queue depths and wait times of knowledge base work, POST {"refresh": ["Italy"]} queues background rescrapes
+    if request.method == "POST":
+        for country in (request.json or {}).get("refresh", []):
+            kb_job_queue.refresh(country)
+    return kb_job_queue.metrics()
+
+
+@app.route('/admin/profiling', methods=["GET", "POST"])
+@admin_only
+def profiling():
+    # switch request profiling on or off without a restart, e.g. POST {"spec": "intent=See,rate=0.2"}
+    if request.method == "POST":
+        try:
+            return request_profiler.configure((request.json or {}).get("spec", ""))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+    return dict(request_profiler.settings)
+
+
+@app.route('/admin/cache-stats', methods=["GET"])
+@admin_only
+def cache_stats():
+    return {"caches": cache_manager.stats(),
+            "pos_tag_batches": nlp_batcher.pos_tag_batcher.stats(),
+            "location_batches": nlp_batcher.location_batcher.stats(),
+            "invalidations": cache_invalidation.stats(),
+            "snapshots": kb_snapshot.tier_stats()}
+
+
+@app.route('/admin/resilience', methods=["GET"])
+@admin_only
+def resilience_stats():
+    return {policy.name: policy.stats() for policy in (detect_intent_policy, documents_policy, knowledge_bases_policy)}
+
+
+@app.route('/admin/sessions', methods=["GET"])
+@admin_only
+def list_sessions():
+    return {"sessions": sessions.names()}
+
+
+@app.route('/admin/sessions/export', methods=["POST"])
+@admin_only
+def export_sessions():
+    # hands sessions over to another node (see session_router.py), they are forgotten here
+    exported = {}
+    for session in request.json.get("sessions", []):
+        state = sessions.peek(session)
+        if state is None:
+            continue
+        # wait for a call that is still being answered for this session
+        with state["lock"]:
+            exported[session] = export_session_state(state)
+            sessions.pop(session)
+    return {"sessions": exported}
+
+
+@app.route('/admin/sessions/import', methods=["POST"])
+@admin_only
+def import_sessions():
+    imported = {session: import_session_state(exported)
+                for session, exported in request.json.get("sessions", {}).items()}
+    for session, state in imported.items():
+        sessions.put(session, state)
+    return {"imported": len(imported)}
+
 
 if __name__ == '__main__':
-    app.run(port=5002)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5002)
+    parser.add_argument('--fake-backend', action='store_true',
+                        help='answer from the in-process fake Dialogflow backend, for local cluster testing')
+    args = parser.parse_args()
+    if args.fake_backend:
+        from fake_dialogflow import FakeBackend
+        FakeBackend(latency=0.02).install()
+    else:
+        # start from the caches the previous run left behind (a fake backend's answers are not worth keeping)
+        start_checkpointing()
+    # knowledge bases built or refreshed by other workers on this machine
+    cache_invalidation.start_listening()
+    app.run(port=args.port)
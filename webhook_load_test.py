@@ -0,0 +1,193 @@
+"""
+Load generator for the webhook. Starts webhook.py against the fake Dialogflow backend, replays synthesized
+Dialogflow webhook payloads from many concurrent sessions and sweeps the concurrency level, reporting
+latency percentiles, error rates and throughput for each level.
+Usage: python webhook_load_test.py [--levels 1,2,4,8,16,32] [--turns 6] [--latency 0.02] [--output report.json]
+       add --error-rate 0.05 --slow-rate 0.02 to inject Dialogflow failures and tail latency
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from fake_dialogflow import FakeBackend
+
+COUNTRIES = ['Italy', 'France', 'Japan', 'Mexico', 'India', 'Canada', 'Egypt', 'Croatia']
+
+QUESTIONS = {
+    "Eat": "What kind of food should I eat there?",
+    "Drink": "What should I drink there?",
+    "See": "What should I see there?",
+    "Do": "What should I do there?",
+    "Talk": "What languages do they speak?",
+    "Buy": "What is the local currency?",
+    "Cities": "What cities do you recommend?",
+    "Regions": "What regions should I visit?",
+    "Other_destinations": "What other places should I go to?",
+    "Get_in": "How do I get there?",
+    "Stay_safe": "How do I stay safe there?",
+    "Stay_healthy": "How do I stay healthy there?",
+    "Connect": "How do I get internet there?",
+    "Respect": "What customs should I respect?",
+}
+
+
+def make_payload(session: str, intent: str, query_text: str, parameters: dict) -> dict:
+    """
+    Builds a webhook request shaped like the ones Dialogflow sends
+    Args: str, str, str, dict
+        session: the Dialogflow session the turn belongs to
+        intent: the display name of the matched intent
+        query_text: what the user typed
+        parameters: the extracted parameters
+    Returns: dict
+        the webhook request body
+    """
+    return {
+        "session": session,
+        "queryResult": {
+            "queryText": query_text,
+            "parameters": dict({"geo-country": ""}, **parameters),
+            "intent": {"displayName": intent},
+            "fulfillmentText": ""
+        }
+    }
+
+
+def make_conversation(session: str, turns: int, rng: random.Random) -> List[dict]:
+    """Synthesizes one user's conversation: pick a country, then ask about random headers"""
+    country = rng.choice(COUNTRIES)
+    payloads = [make_payload(session, "Country", f"I want to visit {country}", {"geo-country": country})]
+    for intent in rng.choices(list(QUESTIONS), k=turns - 1):
+        payloads.append(make_payload(session, intent, QUESTIONS[intent], {}))
+    return payloads
+
+
+def post(url: str, payload: dict, timeout: float) -> float:
+    """Sends one webhook call and returns its latency in milliseconds, raising on any failure"""
+    data = json.dumps(payload).encode('utf-8')
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(req, timeout=timeout) as reply:
+        body = json.loads(reply.read())
+    elapsed = (time.perf_counter() - start) * 1000
+    if "fulfillmentText" not in body:
+        raise ValueError("response has no fulfillmentText")
+    return elapsed
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_level(url: str, concurrency: int, sessions_per_level: int, turns: int, timeout: float, seed: int) -> dict:
+    """
+    Runs `sessions_per_level` conversations with at most `concurrency` of them in flight at once
+    Returns: dict
+        latency percentiles, error rate and throughput for this level
+    """
+    rng = random.Random(seed)
+    conversations = [make_conversation(f"projects/load/agent/sessions/c{concurrency}-s{x}", turns, rng)
+                     for x in range(sessions_per_level)]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def run_conversation(payloads: List[dict]) -> None:
+        for payload in payloads:
+            try:
+                elapsed = post(url, payload, timeout)
+                with lock:
+                    latencies.append(elapsed)
+            except (urllib.error.URLError, ValueError, OSError) as e:
+                with lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_conversation, conversations))
+    duration = time.perf_counter() - start
+
+    total = len(latencies) + len(errors)
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": len(errors),
+        "error_rate": len(errors) / total if total else 0.0,
+        "throughput_rps": total / duration if duration > 0 else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p90_ms": percentile(latencies, 0.90),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": max(latencies) if latencies else 0.0,
+        "sample_errors": errors[:5]
+    }
+
+
+def find_saturation(results: List[dict], min_gain: float = 0.1) -> dict:
+    """The first level after which more concurrency adds less than `min_gain` throughput"""
+    for previous, current in zip(results, results[1:]):
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 + min_gain):
+            return previous
+    return results[-1]
+
+
+def start_webhook(port: int):
+    from werkzeug.serving import make_server
+    from webhook import app
+
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--levels', default='1,2,4,8,16,32', help='comma separated concurrency levels')
+    parser.add_argument('--sessions', type=int, default=32, help='conversations per level')
+    parser.add_argument('--turns', type=int, default=6, help='webhook calls per conversation')
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated Dialogflow RPC latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake RPCs that fail')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of fake RPCs that are very slow')
+    parser.add_argument('--slow-latency', type=float, default=2.0, help='latency of a slow fake RPC in seconds')
+    parser.add_argument('--timeout', type=float, default=30.0, help='per request timeout in seconds')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--url', help='load an already running webhook instead of starting one on the fake backend')
+    parser.add_argument('--seed', type=int, default=4395)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        FakeBackend(latency=args.latency, error_rate=args.error_rate, slow_rate=args.slow_rate,
+                    slow_latency=args.slow_latency).install()
+        server = start_webhook(args.port)
+        url = f"http://127.0.0.1:{args.port}/webhook"
+
+    results = []
+    print(f"{'conc':>5}{'reqs':>7}{'err%':>7}{'rps':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for level in [int(level) for level in args.levels.split(',')]:
+        result = run_level(url, level, args.sessions, args.turns, args.timeout, args.seed)
+        results.append(result)
+        print(f"{level:>5}{result['requests']:>7}{result['error_rate'] * 100:>7.1f}{result['throughput_rps']:>9.1f}"
+              f"{result['p50_ms']:>9.1f}{result['p90_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['max_ms']:>9.1f}")
+        for error in result["sample_errors"]:
+            print("      " + error)
+
+    saturation = find_saturation(results)
+    print(f"throughput saturates at concurrency {saturation['concurrency']} "
+          f"({saturation['throughput_rps']:.1f} requests/s)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"levels": results, "saturation_concurrency": saturation["concurrency"]}, f, indent=2)
+    if server is not None:
+        server.shutdown()